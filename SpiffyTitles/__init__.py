@@ -27,9 +27,27 @@ __contributors__ = {}
 __url__ = ''
 
 from . import config
+from . import cache
+from . import concurrency
+from . import domains
+from . import eventloop
+from . import htmltitle
+from . import links
+from . import policy
+from . import templates
+from . import transport
 from . import plugin
 from importlib import reload
 # In case we're being reloaded.
+reload(cache)
+reload(concurrency)
+reload(domains)
+reload(eventloop)
+reload(htmltitle)
+reload(links)
+reload(policy)
+reload(templates)
+reload(transport)
 reload(plugin)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
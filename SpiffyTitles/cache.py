@@ -0,0 +1,133 @@
+"""
+Link caches used by SpiffyTitles.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LinkCache:
+    """Thread-safe TTL cache with least-recently-used eviction.
+
+    Entries are indexed by key, so lookups and inserts are O(1). Every entry
+    carries its own expiry time, and once *max_entries* is reached the least
+    recently used entry is evicted to make room.
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value cached for *key*, or None if missing or expired."""
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires <= now:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, lifetime: float):
+        """Cache *value* under *key* for *lifetime* seconds."""
+        if lifetime <= 0:
+            return
+
+        expires = time.time() + lifetime
+
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class DiskCache:
+    """SQLite-backed cache tier that survives plugin reloads and bot restarts.
+
+    Values are stored as JSON next to their absolute expiry time. The database
+    runs in WAL mode so the occasional write never blocks readers.
+    """
+
+    purge_interval = 100
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS links (
+                                key TEXT PRIMARY KEY,
+                                value TEXT NOT NULL,
+                                expires REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS links_expires ON links (expires)")
+        self.purge()
+
+    def get(self, key):
+        """Return ``(value, expires)`` for *key*, or None if missing or expired."""
+        with self._lock:
+            row = self._db.execute("SELECT value, expires FROM links WHERE key = ?",
+                                   (key,)).fetchone()
+
+        if row is None or row[1] <= time.time():
+            return None
+
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, value, lifetime: float):
+        """Store *value* under *key* for *lifetime* seconds."""
+        if lifetime <= 0:
+            return
+
+        payload = json.dumps(value)
+        expires = time.time() + lifetime
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO links (key, value, expires) "
+                             "VALUES (?, ?, ?)", (key, payload, expires))
+            self._writes += 1
+            purge = self._writes % self.purge_interval == 0
+
+        if purge:
+            self.purge()
+
+    def purge(self):
+        """Delete every expired entry."""
+        with self._lock:
+            self._db.execute("DELETE FROM links WHERE expires <= ?", (time.time(),))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM links")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
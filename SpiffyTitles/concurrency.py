@@ -0,0 +1,342 @@
+"""
+Concurrency helpers used by SpiffyTitles.
+"""
+import asyncio
+import contextvars
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into a single call.
+
+    The first caller for a key runs the function. Callers arriving while it
+    is still running wait on the same future and get its result (or its
+    exception) instead of starting their own call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key)
+            future.set_exception(e)
+            raise
+
+        self._finish(key)
+        future.set_result(result)
+
+        return result
+
+    def in_flight(self):
+        """Return the number of calls currently running."""
+        with self._lock:
+            return len(self._calls)
+
+    def _finish(self, key):
+        with self._lock:
+            self._calls.pop(key, None)
+
+
+class Batcher:
+    """Collects keys requested within a short window into one batched call.
+
+    ``fetch(keys)`` must return a dict mapping keys to values; keys missing
+    from it resolve to None. A batch is sent *window* seconds after its
+    first key arrives, or as soon as it holds *max_batch* keys. Keys already
+    waiting or being fetched are not requested twice.
+    """
+
+    def __init__(self, fetch, window: float = 0.05, max_batch: int = 50):
+        self.fetch = fetch
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._sent = {}
+        self._timer = None
+
+    def submit(self, keys):
+        """Queue *keys* for the next batch, returning a Future for each."""
+        futures = {}
+        full = False
+
+        with self._lock:
+            for key in keys:
+                future = self._pending.get(key) or self._sent.get(key)
+
+                if future is None:
+                    future = Future()
+                    self._pending[key] = future
+
+                futures[key] = future
+
+            if len(self._pending) >= self.max_batch:
+                full = True
+            elif self._pending and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            self.flush()
+
+        return futures
+
+    def get(self, key, timeout=None):
+        """Return the value for *key*, waiting for its batch."""
+        return self.submit([key])[key].result(timeout)
+
+    def flush(self):
+        """Send every waiting key now, in batches of at most max_batch."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            batch, self._pending = self._pending, {}
+            self._sent.update(batch)
+
+        keys = list(batch)
+
+        for start in range(0, len(keys), self.max_batch):
+            chunk = keys[start:start + self.max_batch]
+
+            try:
+                results = self.fetch(chunk)
+            except BaseException as e:
+                for key in chunk:
+                    self._resolve(key, batch[key], exception=e)
+            else:
+                for key in chunk:
+                    self._resolve(key, batch[key], result=results.get(key))
+
+    def _resolve(self, key, future, result=None, exception=None):
+        with self._lock:
+            self._sent.pop(key, None)
+
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on one event loop.
+
+    The first caller for a key awaits the coroutine; callers arriving while
+    it runs await the same task. Not thread-safe: use it from the loop only.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self._calls.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._calls.pop(key, None))
+
+        # A waiter being cancelled must not cancel the shared call
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+class LookupState:
+    """Scratch state of the lookup being run by the current caller.
+
+    Backed by a context variable, so each thread and each asyncio task sees
+    its own value.
+    """
+
+    def __init__(self):
+        self._failure = contextvars.ContextVar("failure", default=None)
+        self._deadline = contextvars.ContextVar("deadline", default=None)
+        self._payload = contextvars.ContextVar("payload", default=None)
+
+    @property
+    def failure(self):
+        return self._failure.get()
+
+    @failure.setter
+    def failure(self, reason):
+        self._failure.set(reason)
+
+    @property
+    def deadline(self):
+        return self._deadline.get()
+
+    @deadline.setter
+    def deadline(self, deadline):
+        self._deadline.set(deadline)
+
+    @property
+    def payload(self):
+        return self._payload.get()
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload.set(payload)
+
+
+async def run_in_thread(fn, *args):
+    """Run ``fn(*args)`` on the loop's default executor and return its result.
+
+    Like :func:`asyncio.to_thread`, except that context variables set by
+    *fn*, such as the LookupState of the lookup, are visible to the calling
+    task afterwards.
+    """
+    context = contextvars.copy_context()
+    result = await asyncio.get_running_loop().run_in_executor(None, context.run, fn, *args)
+
+    for variable, value in context.items():
+        variable.set(value)
+
+    return result
+
+
+class QueueFull(Exception):
+    """Raised by TitleExecutor.submit when its queue is full."""
+
+
+class TitleExecutor:
+    """Long-lived pool of worker threads for title lookups.
+
+    At most *max_workers* jobs run at once, and at most *per_host* of them
+    for the same host; jobs for a host already at its limit wait while later
+    jobs for other hosts go ahead. At most *max_queue* jobs may wait, beyond
+    that :meth:`submit` raises QueueFull. Workers are started on demand.
+    """
+
+    def __init__(self, max_workers: int = 4, per_host: int = 2,
+                 max_queue: int = 64, name: str = "TitleExecutor"):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.max_queue = max_queue
+        self.name = name
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._hosts = Counter()
+        self._threads = []
+        self._active = 0
+        self._idle = 0
+        self._shutdown = False
+
+    def submit(self, host, fn, *args, **kwargs):
+        """Schedule ``fn(*args, **kwargs)`` as a job for *host*, returning a Future."""
+        future = Future()
+
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot submit after shutdown")
+
+            if len(self._queue) >= self.max_queue:
+                raise QueueFull("%s queue is full (%s jobs)" % (self.name, len(self._queue)))
+
+            self._queue.append((host, future, fn, args, kwargs))
+
+            # An idle worker may not have woken up yet for the jobs already
+            # queued, so only count on it for one of them
+            if len(self._queue) > self._idle and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name="%s-%s" % (self.name, len(self._threads)))
+                self._threads.append(thread)
+                thread.start()
+
+            self._cond.notify_all()
+
+        return future
+
+    def stats(self):
+        """Return queue depth, active jobs, started workers and jobs per host."""
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "active": self._active,
+                "workers": len(self._threads),
+                "hosts": dict(self._hosts),
+            }
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    @property
+    def active_workers(self):
+        return self._active
+
+    def shutdown(self, wait: bool = True):
+        """Cancel every queued job and stop the workers once they are idle."""
+        with self._cond:
+            self._shutdown = True
+            queued, self._queue = self._queue, deque()
+            threads = list(self._threads)
+            self._cond.notify_all()
+
+        for host, future, fn, args, kwargs in queued:
+            future.cancel()
+
+        if wait:
+            for thread in threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+    def _next_job(self):
+        for index, job in enumerate(self._queue):
+            if self._hosts[job[0]] < self.per_host:
+                del self._queue[index]
+                return job
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+
+                while job is None:
+                    if self._shutdown:
+                        return
+
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                    job = self._next_job()
+
+                host, future, fn, args, kwargs = job
+                self._hosts[host] += 1
+                self._active += 1
+
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = fn(*args, **kwargs)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                with self._cond:
+                    self._hosts[host] -= 1
+                    if not self._hosts[host]:
+                        del self._hosts[host]
+                    self._active -= 1
+                    self._cond.notify_all()
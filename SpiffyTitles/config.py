@@ -7,6 +7,7 @@
 
 import supybot.conf as conf
 import supybot.registry as registry
+from . import templates
 try:
     from supybot.i18n import PluginInternationalization
     _ = PluginInternationalization('SpiffyTitles')
@@ -25,6 +26,30 @@ def configure(advanced):
     conf.registerPlugin('SpiffyTitles', True)
 
 
+class Template(registry.String):
+    """Value must be a valid Jinja template."""
+    __slots__ = ()
+    errormsg = _('Value should be a valid Jinja template, not %r.')
+
+    def setValue(self, v, **kwargs):
+        try:
+            templates.validate(v)
+        except templates.TemplateSyntaxError:
+            self.error(v)
+
+        super().setValue(v, **kwargs)
+
+
+class TitleEngine(registry.OnlySomeStrings):
+    """Value must be either 'threads' or 'asyncio'."""
+    validStrings = ('threads', 'asyncio')
+
+
+class WikipediaBackend(registry.OnlySomeStrings):
+    """Value must be either 'action' or 'rest'."""
+    validStrings = ('action', 'rest')
+
+
 SpiffyTitles = conf.registerPlugin('SpiffyTitles')
 
 conf.registerGlobalValue(SpiffyTitles, 'maxRetries',
@@ -33,15 +58,36 @@ conf.registerGlobalValue(SpiffyTitles, 'maxRetries',
 conf.registerGlobalValue(SpiffyTitles, 'wallClockTimeoutInSeconds',
      registry.Integer(8, _("""Timeout for getting a title. If you set this too high, the bot will time out.""")))
 
+conf.registerGlobalValue(SpiffyTitles, 'messageTimeoutInSeconds',
+     registry.Float(15.0, _("""Time limit for looking up every link in a message, including retries and fallbacks. Titles found in time are still shown. 0 means no limit.""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'apiTimeoutInSeconds',
+     registry.PositiveInteger(5, _("""Timeout for each request to a provider's API (YouTube, Reddit, Wikipedia, ...).""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'apiTimeouts',
+     registry.SpaceSeparatedListOfStrings([], _("""Override apiTimeoutInSeconds for some providers with a space-separated list of provider=seconds pairs, e.g. "youtube=3 reddit=10".""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'titleEngine',
+     TitleEngine('threads', _("""How links are looked up. 'threads' uses a worker thread per link; 'asyncio' fetches pages for the default handler on a single event loop thread and only uses worker threads for API handlers.""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'titleFetchWorkers',
+     registry.PositiveInteger(4, _("""Maximum number of titles fetched at the same time, across all channels.""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'titleFetchWorkersPerHost',
+     registry.PositiveInteger(2, _("""Maximum number of titles fetched at the same time from a single host.""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'titleFetchQueueSize',
+     registry.PositiveInteger(64, _("""Maximum number of links waiting to be looked up. Links beyond this are skipped.""")))
+
 # Language
 conf.registerGlobalValue(SpiffyTitles, 'language',
      registry.String("en-US", _("""Language code""")))
 
 conf.registerGlobalValue(SpiffyTitles, 'imdbTemplate',
-     registry.String("^ {{Title}}{% if Year %} ({{Year}}){% endif %}{% if Type %} - {{Type}}{% endif %}{% if Cast %} :: {{Cast}}{% endif %} :: https://www.imdb.com/title/{{imdbID}}/", _("""Template used for IMDB links.""")))
+     Template("^ {{Title}}{% if Year %} ({{Year}}){% endif %}{% if Type %} - {{Type}}{% endif %}{% if Cast %} :: {{Cast}}{% endif %} :: https://www.imdb.com/title/{{imdbID}}/", _("""Template used for IMDB links.""")))
 
 conf.registerGlobalValue(SpiffyTitles, 'coubTemplate',
-     registry.String("^ {%if not_safe_for_work %}NSFW{% endif %} [{{channel.title}}] {{title}} :: {{views_count}} views :: {{likes_count}} likes :: {{recoubs_count}} recoubs", _("""Uses Coub API to get additional information about coub.com links""")))
+     Template("^ {%if not_safe_for_work %}NSFW{% endif %} [{{channel.title}}] {{title}} :: {{views_count}} views :: {{likes_count}} likes :: {{recoubs_count}} recoubs", _("""Uses Coub API to get additional information about coub.com links""")))
 
 # enable/disable toggles
 conf.registerChannelValue(SpiffyTitles, 'coubHandlerEnabled',
@@ -72,22 +118,22 @@ conf.registerChannelValue(SpiffyTitles, 'useBold',
 
 # Title template - show a warning if redirects to a different domain
 conf.registerChannelValue(SpiffyTitles, 'defaultTitleTemplate',
-     registry.String("{% if redirect %}({{real_domain}}) {% endif %}^ {{title}}", _("""Template used for default title responses""")))
+     Template("{% if redirect %}({{real_domain}}) {% endif %}^ {{title}}", _("""Template used for default title responses""")))
 
 # YouTube template
 conf.registerChannelValue(SpiffyTitles, 'youtubeTitleTemplate',
-     registry.String("^ {{yt_logo}} :: {{title}} {%if timestamp%} @ {{timestamp}}{% endif %} :: Duration: {{duration}} :: Views: {{view_count}} uploaded by {{channel_title}} :: {{like_count}} likes :: {{dislike_count}} dislikes :: {{favorite_count}} favorites", _("""Template used for YouTube title responses""")))
+     Template("^ {{yt_logo}} :: {{title}} {%if timestamp%} @ {{timestamp}}{% endif %} :: Duration: {{duration}} :: Views: {{view_count}} uploaded by {{channel_title}} :: {{like_count}} likes :: {{dislike_count}} dislikes :: {{favorite_count}} favorites", _("""Template used for YouTube title responses""")))
 
 # Vimeo template
 conf.registerChannelValue(SpiffyTitles, 'vimeoTitleTemplate',
-     registry.String("^ {{title}} :: Duration: {{duration}} :: {{stats_number_of_plays}} plays :: {{stats_number_of_comments}} comments", _("""Template used for Vimeo title responses""")))
+     Template("^ {{title}} :: Duration: {{duration}} :: {{stats_number_of_plays}} plays :: {{stats_number_of_comments}} comments", _("""Template used for Vimeo title responses""")))
 
 conf.registerChannelValue(SpiffyTitles, 'vimeoHandlerEnabled',
      registry.Boolean(True, _("""Enable additional information about Vimeo videos""")))
 
 # dailymotion template
 conf.registerChannelValue(SpiffyTitles, 'dailymotionVideoTitleTemplate',
-     registry.String("^ [{{ownerscreenname}}] {{title}} :: Duration: {{duration}} :: {{views_total}} views", _("""Template used for Vimeo title responses""")))
+     Template("^ [{{ownerscreenname}}] {{title}} :: Duration: {{duration}} :: {{views_total}} views", _("""Template used for Vimeo title responses""")))
 
 conf.registerChannelValue(SpiffyTitles, 'dailymotionHandlerEnabled',
      registry.Boolean(True, _("""Enable additional information about dailymotion videos""")))
@@ -100,6 +146,12 @@ conf.registerGlobalValue(SpiffyTitles, 'userAgents',
 conf.registerGlobalValue(SpiffyTitles, 'mimeTypes',
                          registry.CommaSeparatedListOfStrings(["text/html"], _("""Acceptable mime types for displaying titles""")))
 
+conf.registerGlobalValue(SpiffyTitles, 'stopDownloadAfterHead',
+                         registry.Boolean(True, _("""Stop downloading a page as soon as the end of its <head> has been received, since the title is in there.""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'maxDownloadSizeInBytes',
+                         registry.PositiveInteger(1048576, _("""Stop downloading a page after this many bytes, whether or not its <head> is complete.""")))
+
 # Ignored domain pattern
 conf.registerChannelValue(SpiffyTitles, 'ignoredDomainPattern',
                          registry.Regexp("", _("""Domains matching this patterns will be ignored""")))
@@ -124,10 +176,10 @@ conf.registerGlobalValue(SpiffyTitles, 'imgurClientSecret',
                         registry.String("", _("""imgur client secret"""), private=True))
 
 conf.registerChannelValue(SpiffyTitles, 'imgurTemplate',
-                        registry.String("^{%if section %} [{{section}}] {% endif -%}{%- if title -%} {{title}} :: {% endif %}{{type}} {{width}}x{{height}} {{file_size}} :: {{view_count}} views :: {%if nsfw == None %}not sure if safe for work{% elif nsfw == True %}not safe for work!{% else %}safe for work{% endif %}", _("""imgur template""")))
+                        Template("^{%if section %} [{{section}}] {% endif -%}{%- if title -%} {{title}} :: {% endif %}{{type}} {{width}}x{{height}} {{file_size}} :: {{view_count}} views :: {%if nsfw == None %}not sure if safe for work{% elif nsfw == True %}not safe for work!{% else %}safe for work{% endif %}", _("""imgur template""")))
 
 conf.registerChannelValue(SpiffyTitles, 'imgurAlbumTemplate',
-                        registry.String("^{%if section %} [{{section}}] {% endif -%}{%- if title -%} {{title}} :: {% endif %}{{image_count}} images :: {{view_count}} views :: {%if nsfw == None %}not sure if safe for work{% elif nsfw == True %}not safe for work!{% else %}safe for work{% endif %}", _("""imgur template""")))
+                        Template("^{%if section %} [{{section}}] {% endif -%}{%- if title -%} {{title}} :: {% endif %}{{image_count}} images :: {{view_count}} views :: {%if nsfw == None %}not sure if safe for work{% elif nsfw == True %}not safe for work!{% else %}safe for work{% endif %}", _("""imgur template""")))
 
 # Youtube API
 conf.registerGlobalValue(SpiffyTitles, 'youtubeDeveloperKey',
@@ -137,12 +189,30 @@ conf.registerGlobalValue(SpiffyTitles, 'youtubeDeveloperKey',
 conf.registerGlobalValue(SpiffyTitles, 'linkCacheLifetimeInSeconds',
                         registry.Integer(60, _("""Link cache lifetime in seconds""")))
 
+conf.registerGlobalValue(SpiffyTitles, 'negativeCacheLifetimeInSeconds',
+                        registry.Integer(30, _("""How long to remember links that timed out, returned an error, were not HTML or had no title. Reposts of these links are answered from the cache instead of being fetched again. 0 disables this.""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'linkCacheMaxEntries',
+                        registry.PositiveInteger(1000, _("""Maximum number of links kept in the link cache. The least recently used links are evicted first. You must reload SpiffyTitles for this setting to take effect.""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'persistentLinkCacheEnabled',
+                        registry.Boolean(True, _("""Also keep cached links in a database in the bot's data directory, so they survive reloads and restarts. You must reload SpiffyTitles for this setting to take effect.""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'shortenerDomains',
+                        registry.SpaceSeparatedListOfStrings(["t.co", "bit.ly", "redd.it", "goo.gl", "tinyurl.com", "ow.ly", "buff.ly", "is.gd", "dlvr.it", "amzn.to", "lnkd.in"], _("""Link shortener domains. Their redirects are followed without downloading any page, and the destination is handed to the handler for its domain. You must reload SpiffyTitles for this setting to take effect.""")))
+
+conf.registerGlobalValue(SpiffyTitles, 'shortenerCacheLifetimeInSeconds',
+                        registry.Integer(86400, _("""How long to remember where a short link leads. 0 disables this.""")))
+
 conf.registerChannelValue(SpiffyTitles, 'onDemandTitleError',
                         registry.String("Error retrieving title.", _("""This error message is used when there is a problem getting an on-demand title""")))
                         
 conf.registerGlobalValue(SpiffyTitles, 'linkMessageIgnorePattern',
                         registry.Regexp("", _("""Messages matching this pattern will be ignored.""")))
                         
+conf.registerGlobalValue(SpiffyTitles, 'patternTimeoutInSeconds',
+                        registry.Float(0.0, _("""If greater than 0, run linkMessageIgnorePattern, ignoredDomainPattern, whitelistDomainPattern and ignoredTitlePattern in a subprocess and give up on them after this many seconds. Protects the bot from patterns with catastrophic backtracking, at the cost of starting a process for every check. A pattern that times out counts as not matching.""")))
+
 conf.registerChannelValue(SpiffyTitles, 'ignoreActionLinks',
      registry.Boolean(True, _("""Ignores URLs that appear in an action such as /me""")))
 
@@ -158,6 +228,9 @@ conf.registerGroup(SpiffyTitles, 'wikipedia')
 conf.registerChannelValue(SpiffyTitles.wikipedia, 'enabled',
                         registry.Boolean(True, _("""Whether to fetch extracts for Wikipedia articles.""")))
 
+conf.registerChannelValue(SpiffyTitles.wikipedia, 'backend',
+                        WikipediaBackend('action', _("""Where extracts come from. 'action' queries api.php with apiParams and titleParam; 'rest' reads the smaller, edge-cached page summary from /api/rest_v1/page/summary/, which ignores apiParams and titleParam.""")))
+
 conf.registerChannelValue(SpiffyTitles.wikipedia, 'apiParams',
                         registry.SpaceSeparatedListOfStrings([], _("""Add or override API query parameters with a space-separated list of key=value pairs.""")))
 
@@ -176,7 +249,7 @@ conf.registerChannelValue(SpiffyTitles.wikipedia, 'removeParentheses',
                         registry.Boolean(True, _("""Remove parenthesized text from output.""")))
 
 conf.registerChannelValue(SpiffyTitles.wikipedia, 'extractTemplate',
-                        registry.String("^ {{extract}}", _("""Wikipedia template.""")))
+                        Template("^ {{extract}}", _("""Wikipedia template.""")))
 
 
 conf.registerGroup(SpiffyTitles, 'reddit')
@@ -184,17 +257,23 @@ conf.registerGroup(SpiffyTitles, 'reddit')
 conf.registerChannelValue(SpiffyTitles.reddit, 'enabled',
                         registry.Boolean(True, _("""Whether to add additional info about Reddit links.""")))
 
+conf.registerGlobalValue(SpiffyTitles.reddit, 'clientID',
+                        registry.String("", _("""Reddit app client ID. When set with clientSecret, Reddit is queried through oauth.reddit.com with an app-only token, which has a higher rate limit."""), private=True))
+
+conf.registerGlobalValue(SpiffyTitles.reddit, 'clientSecret',
+                        registry.String("", _("""Reddit app client secret"""), private=True))
+
 conf.registerChannelValue(SpiffyTitles.reddit, 'linkThreadTemplate',
-     registry.String("/r/{{subreddit}}{% if title %} :: {{title}}{% endif %} :: {{score}} points ({{percent}}) :: {{comments}} comments :: Posted {{age}} by {{author}}{% if url %} :: {{url}} ({{domain}}){% endif %}", _("""Template used for Reddit link thread title responses""")))
+     Template("/r/{{subreddit}}{% if title %} :: {{title}}{% endif %} :: {{score}} points ({{percent}}) :: {{comments}} comments :: Posted {{age}} by {{author}}{% if url %} :: {{url}} ({{domain}}){% endif %}", _("""Template used for Reddit link thread title responses""")))
 
 conf.registerChannelValue(SpiffyTitles.reddit, 'textThreadTemplate',
-     registry.String("/r/{{subreddit}}{% if title %} :: {{title}}{% endif %}{% if extract %} :: {{extract}}{% endif %} :: {{score}} points ({{percent}}) :: {{comments}} comments :: Posted {{age}} by {{author}}", _("""Template used for Reddit text thread title responses""")))
+     Template("/r/{{subreddit}}{% if title %} :: {{title}}{% endif %}{% if extract %} :: {{extract}}{% endif %} :: {{score}} points ({{percent}}) :: {{comments}} comments :: Posted {{age}} by {{author}}", _("""Template used for Reddit text thread title responses""")))
 
 conf.registerChannelValue(SpiffyTitles.reddit, 'commentTemplate',
-     registry.String("/r/{{subreddit}}{% if extract %} :: {{extract}}{% endif %} :: {{score}} points :: Posted {{age}} by {{author}} on \"{{title}}\"", _("""Template used for Reddit comment title responses""")))
+     Template("/r/{{subreddit}}{% if extract %} :: {{extract}}{% endif %} :: {{score}} points :: Posted {{age}} by {{author}} on \"{{title}}\"", _("""Template used for Reddit comment title responses""")))
 
 conf.registerChannelValue(SpiffyTitles.reddit, 'userTemplate',
-     registry.String("/u/{{user}}{% if gold %} :: (GOLD{% if mod %}, MOD{% endif %}){% endif %} :: Joined: {{created}} :: Link karma: {{link_karma}} :: Comment karma: {{comment_karma}}", _("""Template used for Reddit user page title responses""")))
+     Template("/u/{{user}}{% if gold %} :: (GOLD{% if mod %}, MOD{% endif %}){% endif %} :: Joined: {{created}} :: Link karma: {{link_karma}} :: Comment karma: {{comment_karma}}", _("""Template used for Reddit user page title responses""")))
 
 conf.registerChannelValue(SpiffyTitles.reddit, 'maxChars',
                         registry.Integer(400, _("""Length of response (title/extract will be cut to fit).""")))
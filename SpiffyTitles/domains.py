@@ -0,0 +1,202 @@
+"""
+Domain name lookups: handler dispatch and registrable (base) domains.
+
+Both are answered by a DomainTrie, which stores domain names by their labels
+from right to left, so finding the most specific entry for a host costs one
+dictionary lookup per label.
+"""
+import re
+
+ip_address_pattern = re.compile(r"^[\d.]+$|:")
+
+# Public suffixes, one rule per line, in the format of the Public Suffix List.
+# Top-level domains are always public suffixes, so only deeper rules are
+# listed: the second-level registries of common country code domains and the
+# hosting platforms whose subdomains belong to different people.
+public_suffix_rules = """
+ac.uk co.uk gov.uk ltd.uk me.uk net.uk nhs.uk org.uk plc.uk police.uk sch.uk
+asn.au com.au edu.au gov.au id.au net.au org.au
+ac.nz co.nz geek.nz gen.nz govt.nz kiwi.nz net.nz org.nz school.nz
+ac.jp ad.jp co.jp ed.jp go.jp gr.jp lg.jp ne.jp or.jp
+ac.kr co.kr go.kr ne.kr or.kr re.kr
+com.br edu.br gov.br net.br org.br
+com.cn edu.cn gov.cn net.cn org.cn
+com.hk edu.hk gov.hk net.hk org.hk
+com.tw edu.tw gov.tw idv.tw net.tw org.tw
+com.sg edu.sg gov.sg net.sg org.sg
+co.in firm.in gen.in gov.in ind.in net.in org.in
+ac.za co.za gov.za net.za org.za
+com.mx edu.mx gob.mx net.mx org.mx
+com.ar gob.ar net.ar org.ar
+ac.il co.il gov.il net.il org.il
+bel.tr biz.tr com.tr edu.tr gen.tr net.tr org.tr
+com.ua in.ua kiev.ua net.ua org.ua
+com.ru net.ru org.ru
+com.pl net.pl org.pl
+co.at or.at
+com.es nom.es org.es
+com.pt
+com.gr
+com.my net.my org.my
+com.ph net.ph org.ph
+com.vn net.vn
+co.id or.id web.id
+co.th in.th
+*.ck *.bd *.np
+appspot.com blogspot.com cloudfront.net azurewebsites.net herokuapp.com
+firebaseapp.com web.app github.io gitlab.io netlify.app vercel.app pages.dev workers.dev
+s3.amazonaws.com neocities.org
+"""
+
+
+class DomainTrie:
+    """Maps domain names to values, looked up by the most specific match.
+
+    A key is either a domain, which matches that exact host, or a wildcard
+    like ``*.example.com``, which matches every subdomain of example.com but
+    not example.com itself. When several keys match a host, the exact one
+    wins, then the deepest wildcard.
+    """
+
+    class Node:
+        __slots__ = ("children", "value", "wildcard")
+
+        def __init__(self):
+            self.children = {}
+            self.value = None
+            self.wildcard = None
+
+    def __init__(self, items=()):
+        self._root = self.Node()
+        self._size = 0
+
+        for key, value in items:
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        labels = split_labels(key)
+        wildcard = labels[-1:] == ["*"]
+
+        if wildcard:
+            labels.pop()
+
+        node = self._root
+
+        for label in labels:
+            node = node.children.setdefault(label, self.Node())
+
+        if wildcard:
+            self._size += node.wildcard is None
+            node.wildcard = value
+        else:
+            self._size += node.value is None
+            node.value = value
+
+    def __getitem__(self, key):
+        labels = split_labels(key)
+        wildcard = labels[-1:] == ["*"]
+
+        if wildcard:
+            labels.pop()
+
+        node = self._root
+
+        for label in labels:
+            node = node.children.get(label)
+
+            if node is None:
+                raise KeyError(key)
+
+        value = node.wildcard if wildcard else node.value
+
+        if value is None:
+            raise KeyError(key)
+
+        return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+
+        return True
+
+    def __len__(self):
+        return self._size
+
+    def match(self, host):
+        """Return the value of the most specific key matching *host*, or None."""
+        labels = split_labels(host)
+        node = self._root
+        best = None
+
+        for label in labels:
+            if node.wildcard is not None:
+                best = node.wildcard
+
+            node = node.children.get(label)
+
+            if node is None:
+                return best
+
+        if node.value is not None:
+            return node.value
+
+        return best
+
+    def suffix_length(self, host):
+        """Return how many labels of *host* the longest key ending it covers.
+
+        Unlike :meth:`match`, a key here also matches every host under it,
+        as rules do in the Public Suffix List. Returns 0 when no key does.
+        """
+        node = self._root
+        length = 0
+
+        for depth, label in enumerate(split_labels(host)):
+            if node.wildcard is not None:
+                length = depth + 1
+
+            node = node.children.get(label)
+
+            if node is None:
+                break
+
+            if node.value is not None:
+                length = depth + 1
+
+        return length
+
+
+def split_labels(domain):
+    """Return the labels of *domain*, lowercased, from right to left."""
+    labels = domain.rstrip(".").lower().split(".")
+    labels.reverse()
+
+    return labels
+
+
+public_suffixes = DomainTrie((rule, True) for rule in public_suffix_rules.split())
+
+
+def get_base_domain(host):
+    """Return the registrable domain of *host*, e.g. bbc.co.uk for www.bbc.co.uk.
+
+    IP addresses and hosts that are themselves public suffixes are returned
+    as they are.
+    """
+    host = host.rstrip(".").lower()
+
+    if not host or ip_address_pattern.search(host):
+        return host
+
+    labels = host.split(".")
+
+    # Every top-level domain is a public suffix
+    depth = max(public_suffixes.suffix_length(host), 1)
+
+    if len(labels) <= depth:
+        return host
+
+    return ".".join(labels[-(depth + 1):])
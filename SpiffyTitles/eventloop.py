@@ -0,0 +1,143 @@
+"""
+asyncio event loop thread that drives pycurl transfers without blocking.
+"""
+import asyncio
+import threading
+
+import pycurl
+
+
+class EventLoop:
+    """An asyncio event loop running in its own thread, with a ``CurlMulti``.
+
+    Coroutines are handed over with :meth:`submit`, which returns a
+    ``concurrent.futures.Future`` that any thread can wait on. Inside those
+    coroutines, ``await loop.perform(curl)`` runs a configured pycurl handle
+    on the shared multi handle. libcurl reports the sockets it wants watched
+    and the timeouts it needs, and the loop calls back into it when they are
+    ready, so an outstanding transfer costs a few kilobytes instead of a
+    thread.
+    """
+
+    def __init__(self, name: str = "EventLoop"):
+        self.loop = asyncio.new_event_loop()
+        self._transfers = {}
+        self._timer = None
+        self._multi = pycurl.CurlMulti()
+        self._multi.setopt(pycurl.M_SOCKETFUNCTION, self._watch_socket)
+        self._multi.setopt(pycurl.M_TIMERFUNCTION, self._set_timer)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, coroutine):
+        """Schedule *coroutine* on the loop from any thread."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def perform(self, curl):
+        """Run the transfer set up on *curl*, raising pycurl.error on failure.
+
+        Must be awaited from a coroutine running on this loop.
+        """
+        done = self.loop.create_future()
+        self._transfers[curl] = done
+        self._multi.add_handle(curl)
+
+        try:
+            await done
+        finally:
+            if self._transfers.pop(curl, None) is not None:
+                # Cancelled before libcurl finished the transfer
+                self._multi.remove_handle(curl)
+
+    def pending(self):
+        """Return the number of transfers in progress."""
+        return len(self._transfers)
+
+    def close(self, timeout: float = 5):
+        """Cancel every running coroutine and wait for the work it handed to
+        the default executor, then stop the loop and its thread."""
+        if self.loop.is_running():
+            future = asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop)
+
+            try:
+                future.result(timeout)
+            finally:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._thread.join(timeout)
+
+        for curl in list(self._transfers):
+            self._multi.remove_handle(curl)
+
+        self._transfers.clear()
+        self._multi.close()
+        self.loop.close()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _cancel_tasks(self):
+        tasks = [task for task in asyncio.all_tasks(self.loop)
+                 if task is not asyncio.current_task()]
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.loop.shutdown_default_executor()
+
+    def _watch_socket(self, event, fd, multi, data):
+        """``M_SOCKETFUNCTION``: libcurl tells us which sockets to watch."""
+        if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            self.loop.add_reader(fd, self._socket_ready, fd, pycurl.CSELECT_IN)
+        else:
+            self.loop.remove_reader(fd)
+
+        if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            self.loop.add_writer(fd, self._socket_ready, fd, pycurl.CSELECT_OUT)
+        else:
+            self.loop.remove_writer(fd)
+
+    def _set_timer(self, timeout_ms):
+        """``M_TIMERFUNCTION``: libcurl asks to be called back after a delay."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if timeout_ms >= 0:
+            self._timer = self.loop.call_later(timeout_ms / 1000, self._timer_expired)
+
+    def _socket_ready(self, fd, event):
+        self._multi.socket_action(fd, event)
+        self._collect()
+
+    def _timer_expired(self):
+        self._timer = None
+        self._multi.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        self._collect()
+
+    def _collect(self):
+        """Resolve the futures of every finished transfer."""
+        while True:
+            queued, succeeded, failed = self._multi.info_read()
+
+            for curl in succeeded:
+                self._finish(curl, None)
+
+            for curl, errno, message in failed:
+                self._finish(curl, pycurl.error(errno, message))
+
+            if not queued:
+                break
+
+    def _finish(self, curl, error):
+        done = self._transfers.pop(curl, None)
+        self._multi.remove_handle(curl)
+
+        if done is None or done.done():
+            return
+
+        if error is None:
+            done.set_result(None)
+        else:
+            done.set_exception(error)
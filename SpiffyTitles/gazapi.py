@@ -5,11 +5,22 @@ Example *gazelle.conf* section for token auth::
     [redacted]
     url = https://redacted.site
     api_token = YOUR_TOKEN_HERE
+    # optional: at most rate_limit calls every rate_period seconds
+    rate_limit = 10
+    rate_period = 10
+    # optional: seconds a call may take, rate limit wait included, when the
+    # caller doesn't pass its own timeout
+    timeout = 30
 """
 import configparser
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Optional, Dict, Any
 
+from .concurrency import SingleFlight
+
 
 class LoginException(Exception):
     """Raised when form‑login fails."""
@@ -19,12 +30,55 @@ class RequestException(Exception):
     """Raised when *ajax.php* returns anything but `{status: 'success'}`."""
 
 
+class TokenBucket:
+    """Allows *rate* calls per *period* seconds, in bursts of up to *rate*.
+
+    :meth:`acquire` takes a token, waiting for the bucket to refill when it
+    is empty, so calls beyond the limit are queued instead of rejected.
+    """
+
+    def __init__(self, rate: int, period: float, clock=time.monotonic, sleep=time.sleep):
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(rate)
+        self._updated = clock()
+
+    def acquire(self, max_wait: float) -> None:
+        """Take a token, raising RequestException if it takes over *max_wait* seconds."""
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.fill_rate)
+            self._updated = now
+            # Tokens below zero are owed to callers already waiting
+            wait = max(0.0, (1 - self._tokens) / self.fill_rate)
+
+            if wait > max_wait:
+                raise RequestException(f"Rate limit would delay the call by {wait:.1f}s")
+
+            self._tokens -= 1
+
+        if wait:
+            self.sleep(wait)
+
+
 class GazAPI:
     """Simple helper around the Gazelle JSON API.
     Authentication is done via an API token.
+
+    Calls share a pooled session and are queued by a token bucket within
+    the site's rate limit. When a *cache* (anything with ``get`` and
+    ``put(key, value, lifetime)``) is given, the fields read from
+    ``torrentgroup``, ``torrent``, ``artist`` and ``collage`` responses are
+    kept in it, along with the group of every torrent seen in them.
     """
 
-    def __init__(self, config_file: str, site: str):
+    cached_actions = ("torrentgroup", "torrent", "artist", "collage")
+
+    def __init__(self, config_file: str, site: str, cache=None, cache_lifetime: float = 3600):
         cfg = configparser.ConfigParser()
         if not cfg.read(config_file):
             raise FileNotFoundError(
@@ -41,14 +95,56 @@ class GazAPI:
         if not self.api_token:
             raise LoginException(f"api_token missing from '{site}' section")
 
-    def request(self, action: str, **kwargs: Any):
-        """Perform a JSON request to `/ajax.php`."""
+        self.timeout: float = section.getfloat("timeout", 30)
+        self.bucket = TokenBucket(section.getint("rate_limit", 5),
+                                  section.getfloat("rate_period", 10))
+        self.cache = cache
+        self.cache_lifetime = cache_lifetime
+        self.in_flight = SingleFlight()
+
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = self.api_token
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, action: str, timeout: Optional[float] = None, **kwargs: Any):
+        """Perform a JSON request to `/ajax.php`.
+
+        *timeout* bounds the whole call, waiting for the rate limit included,
+        and defaults to the site's timeout. Concurrent calls for the same
+        cached action and arguments share one request. A ``torrent`` call is
+        answered from the cached group when a previous response said which
+        group the torrent belongs to.
+        """
+        if action not in self.cached_actions:
+            return self.fetch(action, timeout, **kwargs)
+
+        cached = self.get_cached(action, kwargs)
+
+        if cached is not None:
+            return cached
+
+        return self.in_flight.do(self.cache_key(action, **kwargs),
+                                 self.fetch_and_cache, action, kwargs, timeout)
+
+    def fetch(self, action: str, timeout: Optional[float] = None, **kwargs: Any):
+        """Call `/ajax.php` within the rate limit, returning its response."""
         ajax_url = f"{self.site_url}/ajax.php"
         params = {"action": action, **kwargs}
-        headers = {"Authorization": self.api_token}
 
-        response = requests.get(
-            ajax_url, params=params, headers=headers, allow_redirects=False, timeout=30
+        if timeout is None:
+            timeout = self.timeout
+
+        started = time.monotonic()
+        self.bucket.acquire(timeout)
+        timeout -= time.monotonic() - started
+
+        if timeout <= 0:
+            raise RequestException(f"No time left for Gazelle API call '{action}'")
+
+        response = self.session.get(
+            ajax_url, params=params, allow_redirects=False, timeout=timeout
         )
         try:
             payload = response.json()
@@ -60,3 +156,80 @@ class GazAPI:
                 f"Gazelle API call '{action}' failed: {payload.get('status')}"
             )
         return payload["response"]
+
+    def cache_key(self, action: str, **kwargs: Any):
+        return (self.site_url, action) + tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+    def get_cached(self, action: str, kwargs: Dict[str, Any]):
+        if self.cache is None:
+            return None
+
+        if action == "torrent":
+            group_id = self.cache.get(self.cache_key("torrent", **kwargs))
+
+            if group_id is None:
+                return None
+
+            return self.cache.get(self.cache_key("torrentgroup", id=group_id))
+
+        return self.cache.get(self.cache_key(action, **kwargs))
+
+    def fetch_and_cache(self, action: str, kwargs: Dict[str, Any],
+                        timeout: Optional[float] = None):
+        result = self.fetch(action, timeout, **kwargs)
+
+        if self.cache is None:
+            return result
+
+        trimmed = trim_response(action, result)
+
+        if action not in ("torrentgroup", "torrent"):
+            self.cache.put(self.cache_key(action, **kwargs), trimmed, self.cache_lifetime)
+
+            return trimmed
+
+        # Torrents are cached as an index into the cached groups
+        group_id = trimmed["group"].get("id")
+
+        if action == "torrentgroup":
+            torrents = result.get("torrents") or []
+            group_id = kwargs.get("id") if group_id is None else group_id
+        else:
+            torrents = [result.get("torrent") or {}]
+
+        if group_id is None:
+            return trimmed
+
+        self.cache.put(self.cache_key("torrentgroup", id=group_id), trimmed, self.cache_lifetime)
+
+        for torrent in torrents:
+            if torrent.get("id") is not None:
+                self.cache.put(self.cache_key("torrent", id=torrent["id"]), group_id,
+                               self.cache_lifetime)
+
+        return trimmed
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def trim_artists(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep only the artist names of a `musicInfo` block."""
+    artists = (info or {}).get("artists") or []
+
+    return {"artists": [{"name": artist["name"]} for artist in artists]}
+
+
+def trim_response(action: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep only the fields titles are built from."""
+    if action in ("torrentgroup", "torrent"):
+        group = response["group"]
+        trimmed = {key: group[key] for key in ("id", "name", "year", "categoryName", "tags")
+                   if key in group}
+
+        if "musicInfo" in group:
+            trimmed["musicInfo"] = trim_artists(group["musicInfo"])
+
+        return {"group": trimmed}
+
+    return {"name": response["name"]}
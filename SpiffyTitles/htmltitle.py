@@ -0,0 +1,106 @@
+"""
+Fast <title> extraction that works on the raw bytes of a document.
+
+Building a full DOM for every page just to read its title is expensive, so
+this module scans the start of the document with a handful of regular
+expressions instead. Whenever the markup is unusual enough that the result
+could differ from what the HTML parser would give, AmbiguousMarkup is raised
+and the caller falls back to the full parser.
+"""
+import codecs
+import re
+from html import unescape
+
+
+class AmbiguousMarkup(Exception):
+    """Raised when only a full parse can tell what the title is."""
+
+
+head_end_pattern = re.compile(rb"</head\s*>|<body[\s>]", re.IGNORECASE)
+
+# Elements whose content must not be searched for titles
+skipped_pattern = re.compile(rb"<(script|style|noscript|template)\b.*?</\1\s*>|<!--.*?-->",
+                             re.IGNORECASE | re.DOTALL)
+unclosed_pattern = re.compile(rb"<(?:script|style|noscript|template|svg|math)\b|<!--",
+                              re.IGNORECASE)
+
+title_open_pattern = re.compile(rb"<title\b", re.IGNORECASE)
+title_pattern = re.compile(rb"<title\b[^>]*>(.*?)</title\s*>", re.IGNORECASE | re.DOTALL)
+charset_pattern = re.compile(rb"<meta\b[^>]*?charset\s*=\s*[\"']?\s*([\w.:-]+)", re.IGNORECASE)
+
+unsupported_boms = (codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE,
+                    codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+
+
+def get_title(html):
+    """Return the last non-empty <title> in the head of *html*, or None.
+
+    *html* may be bytes or str. Raises AmbiguousMarkup when the markup needs
+    a full parse.
+    """
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+        encoding = "utf-8"
+    else:
+        encoding = None
+
+    match = head_end_pattern.search(html)
+    head = html[:match.start()] if match else html
+
+    if encoding is None:
+        encoding = get_encoding(html, head)
+
+    head = skipped_pattern.sub(b"", head)
+
+    if unclosed_pattern.search(head):
+        raise AmbiguousMarkup("unclosed comment or foreign element in head")
+
+    titles = title_pattern.findall(head)
+
+    if len(titles) != len(title_open_pattern.findall(head)):
+        raise AmbiguousMarkup("unclosed title")
+
+    if not titles:
+        if match and title_open_pattern.search(html, match.start()):
+            raise AmbiguousMarkup("title outside of head")
+        return None
+
+    for raw_title in reversed(titles):
+        if b"<" in raw_title:
+            raise AmbiguousMarkup("markup inside title")
+
+        try:
+            title = unescape(raw_title.decode(encoding)).strip()
+        except UnicodeDecodeError:
+            raise AmbiguousMarkup("title is not valid %s" % encoding)
+
+        if title:
+            return title
+
+
+def get_encoding(html, head):
+    """Return the encoding declared by *html*, defaulting to UTF-8.
+
+    Only ASCII-compatible encodings can be scanned as bytes; anything else
+    raises AmbiguousMarkup.
+    """
+    if html.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+
+    if html.startswith(unsupported_boms):
+        raise AmbiguousMarkup("byte order mark")
+
+    match = charset_pattern.search(head)
+
+    if match is None:
+        return "utf-8"
+
+    try:
+        encoding = codecs.lookup(match.group(1).decode("ascii")).name
+    except (LookupError, UnicodeDecodeError):
+        raise AmbiguousMarkup("unknown charset")
+
+    if encoding.startswith(("utf-16", "utf-32")):
+        raise AmbiguousMarkup("charset %s" % encoding)
+
+    return encoding
@@ -0,0 +1,249 @@
+"""
+Canonical forms of links, used to key the link cache and in-flight lookups.
+
+Two links that only differ by tracking parameters, host case, default ports,
+trailing slashes or fragments get the same title, so they should share a
+cache entry. Providers with handlers get stricter rules that keep only the
+parts of the link their handler actually reads.
+
+Links found in a message are wrapped in a Link once, and the parsed parts are
+read from it everywhere after that.
+"""
+import functools
+import re
+from urllib.parse import parse_qs, parse_qsl, quote, unquote, urlencode, urlsplit, urlunsplit
+
+from . import domains
+
+default_ports = {"http": 80, "https": 443}
+
+tracking_parameters = frozenset([
+    "fbclid", "gclid", "dclid", "gbraid", "wbraid", "msclkid", "yclid", "twclid",
+    "igshid", "mc_cid", "mc_eid", "_hsenc", "_hsmi", "mkt_tok", "ref_src", "ref_url",
+])
+tracking_prefixes = ("utm_",)
+
+youtube_id_pattern = re.compile(r"^[\w-]{11}$")
+reddit_pattern = re.compile(
+    r"^/r/(?P<subreddit>[^/]+)/comments/(?P<thread>[^/]+)(?:/(?P<slug>[^/]+)(?:/(?P<comment>\w+))?)?/?$")
+wikipedia_pattern = re.compile(r"^/wiki/(?P<page>[^/]+)$")
+
+# Query parameters read by the gazelle handlers, per page
+gazelle_parameters = {
+    "/torrents.php": ("id", "torrentid"),
+    "/requests.php": ("id",),
+    "/forums.php": ("threadid", "forumid"),
+    "/collages.php": ("id",),
+    "/artist.php": ("id",),
+}
+
+
+class Link(str):
+    """A URL parsed once, usable anywhere the URL string is.
+
+    The query dict, base domain and canonical key are only worked out the
+    first time they are read.
+    """
+    __slots__ = ("scheme", "netloc", "host", "path", "query", "fragment",
+                 "_params", "_base_domain", "_key")
+
+    def __new__(cls, url: str):
+        link = super().__new__(cls, url)
+        parts = urlsplit(url)
+        link.scheme = parts.scheme.lower()
+        link.netloc = parts.netloc
+        link.host = (parts.hostname or "").lower()
+        link.path = parts.path
+        link.query = parts.query
+        link.fragment = parts.fragment
+        link._params = None
+        link._base_domain = None
+        link._key = None
+
+        return link
+
+    @classmethod
+    def of(cls, url):
+        """Return *url* if it is already a Link, or a new Link for it."""
+        if isinstance(url, cls):
+            return url
+
+        return cls(url)
+
+    @property
+    def url(self) -> str:
+        """The link as a plain string."""
+        return str.__str__(self)
+
+    @property
+    def params(self) -> dict:
+        """The query string as returned by parse_qs."""
+        if self._params is None:
+            self._params = parse_qs(self.query)
+
+        return self._params
+
+    @property
+    def base_domain(self) -> str:
+        """The registrable domain of the host, see domains.get_base_domain."""
+        if self._base_domain is None:
+            self._base_domain = domains.get_base_domain(self.host)
+
+        return self._base_domain
+
+    @property
+    def key(self) -> str:
+        """The canonical form of the link, see canonicalize."""
+        if self._key is None:
+            self._key = canonicalize(self.url)
+
+        return self._key
+
+    def __repr__(self):
+        return "Link(%s)" % (str.__repr__(self))
+
+
+@functools.lru_cache(maxsize=4096)
+def canonicalize(url: str) -> str:
+    """Return the canonical form of *url*, or *url* itself if it can't be parsed."""
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+
+    if not scheme or not host:
+        return url
+
+    if ":" in host:
+        host = "[%s]" % (host)
+
+    if port is not None and port != default_ports.get(scheme):
+        host = "%s:%s" % (host, port)
+
+    query = [(key, value) for (key, value) in parse_qsl(parts.query, keep_blank_values=True)
+             if not is_tracking_parameter(key)]
+
+    rule = provider_rules.match(parts.hostname)
+
+    if rule is not None:
+        canonical = rule(host, parts.path, query, parts.fragment)
+
+        if canonical is not None:
+            return canonical
+
+    path = parts.path or "/"
+
+    if len(path) > 1:
+        path = path.rstrip("/") or "/"
+
+    return urlunsplit((scheme, host, path, urlencode(query), ""))
+
+
+def is_tracking_parameter(key):
+    key = key.lower()
+
+    return key in tracking_parameters or key.startswith(tracking_prefixes)
+
+
+def youtube_rule(host, path, query, fragment):
+    params = dict(query)
+
+    if host == "youtu.be":
+        video_id = path.strip("/")
+    elif path.startswith(("/shorts/", "/embed/", "/live/")):
+        video_id = path.split("/")[2]
+    else:
+        video_id = params.get("v", "")
+
+    if not youtube_id_pattern.match(video_id):
+        return None
+
+    # The timestamp is part of the rendered title
+    canonical = "https://www.youtube.com/watch?v=%s" % (video_id)
+
+    if params.get("t"):
+        canonical += "&" + urlencode({"t": params["t"]})
+
+    return canonical
+
+
+def reddit_rule(host, path, query, fragment):
+    match = reddit_pattern.match(path)
+
+    if match is None:
+        return None
+
+    canonical = "https://www.reddit.com/r/%s/comments/%s/" % (match.group("subreddit").lower(),
+                                                              match.group("thread"))
+
+    if match.group("comment"):
+        canonical += "x/%s" % (match.group("comment"))
+
+    return canonical
+
+
+def wikipedia_rule(host, path, query, fragment):
+    match = wikipedia_pattern.match(path)
+
+    if match is None:
+        return None
+
+    page = wikipedia_title(match.group("page")).replace(" ", "_")
+    host = wikipedia_host(host)
+    canonical = "https://%s/wiki/%s" % (host, quote(page, safe="_:,()'!*~-./"))
+
+    # Section links can be rendered differently, see wikipedia.ignoreSectionLinks
+    if fragment:
+        canonical += "#" + fragment
+
+    return canonical
+
+
+def wikipedia_title(page):
+    """Return the title of a Wikipedia page as MediaWiki normalizes it.
+
+    *page* is the last path segment of an article link: it is unquoted,
+    underscores become spaces and the first letter is uppercased, so
+    ``foo_bar`` and ``Foo%20bar`` both give ``Foo bar``.
+    """
+    title = " ".join(unquote(page).replace("_", " ").split())
+
+    return title[:1].upper() + title[1:]
+
+
+def wikipedia_host(host):
+    """Return the desktop host of a Wikipedia language edition."""
+    return host.replace(".m.wikipedia.org", ".wikipedia.org")
+
+
+def gazelle_rule(host, path, query, fragment):
+    names = gazelle_parameters.get(path)
+
+    if names is None:
+        return None
+
+    params = dict(query)
+
+    for name in names:
+        if params.get(name):
+            return "https://%s%s?%s" % (host, path, urlencode({name: params[name]}))
+
+    return None
+
+
+provider_rules = domains.DomainTrie([
+    ("youtube.com", youtube_rule),
+    ("*.youtube.com", youtube_rule),
+    ("youtu.be", youtube_rule),
+    ("reddit.com", reddit_rule),
+    ("*.reddit.com", reddit_rule),
+    ("*.wikipedia.org", wikipedia_rule),
+    ("redacted.sh", gazelle_rule),
+    ("*.redacted.sh", gazelle_rule),
+    ("orpheus.network", gazelle_rule),
+    ("*.orpheus.network", gazelle_rule),
+])
@@ -7,33 +7,44 @@
 ###
 
 from supybot.commands import *
+import supybot.conf as conf
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
+import asyncio
 import re
 import requests
-import io
 import pycurl
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError, wait
 try:
     from urllib.parse import urlencode
-    from urllib.parse import urlparse, parse_qsl, parse_qs
+    from urllib.parse import parse_qsl
 except ImportError:
-    from urllib.parse import urlencode, urlparse, parse_qsl, parse_qs
+    from urllib.parse import urlencode, parse_qsl
 from bs4 import BeautifulSoup
 import random
 import json
-from urllib.parse import urlparse, parse_qs, parse_qsl
+from urllib.parse import parse_qsl, quote
 import datetime
-from jinja2 import Template
 from datetime import timedelta
 import unicodedata
 import supybot.ircdb as ircdb
 import supybot.log as log
 import pytz
+from . import cache
+from . import concurrency
+from . import domains
+from . import eventloop
 from . import gazapi
+from . import htmltitle
+from . import links
+from . import policy
+from . import templates
+from . import transport
 from html import unescape
 import os
+import sqlite3
+import time
 
 
 try:
@@ -45,12 +56,26 @@ except ImportError:
     _ = lambda x: x
 
 
+# ISO 8601 durations as returned by the YouTube API, e.g. PT4M41S
+duration_pattern = re.compile(r"""
+           (?P<sign>    -?) P
+        (?:(?P<years>  \d+) Y)?
+        (?:(?P<months> \d+) M)?
+        (?:(?P<days>   \d+) D)?
+    (?:                     T
+        (?:(?P<hours>  \d+) H)?
+        (?:(?P<minutes>\d+) M)?
+        (?:(?P<seconds>\d+) S)?
+    )?
+    """, re.VERBOSE)
+title_prefix_pattern = re.compile(r'^\s*\^\s*')
+spaces_pattern = re.compile(" +")
+
+
 class SpiffyTitles(callbacks.Plugin):
     """Displays link titles when posted in a channel"""
     threaded = True
     callBefore = ["Web"]
-    link_cache = []
-    handlers = {}
     handler_whitelist_aliases = {
         "handler_apl": set(["apl", "gazelle", "orpheus"]),
         "handler_coub": set(["coub"]),
@@ -60,16 +85,48 @@ class SpiffyTitles(callbacks.Plugin):
         "handler_imgur": set(["imgur"]),
         "handler_imgur_image": set(["imgur"]),
         "handler_reddit": set(["reddit"]),
+        "handler_shortener": set(["default", "shortener"]),
         "handler_redacted": set(["gazelle", "redacted"]),
         "handler_vimeo": set(["vimeo"]),
         "handler_wikipedia": set(["wikipedia"]),
         "handler_youtube": set(["youtube"]),
     }
     wall_clock_timeout = 8
+    max_shortener_redirects = 5
     max_request_retries = 3
-    title_fetch_workers = 4
     imgur_client = None
     bad_url_title = "^ <bad url>"
+    payload_renderers = {
+        "template": "render_template_payload",
+        "text": "render_text_payload",
+        "wikipedia": "render_wikipedia_payload",
+        "reddit": "render_reddit_payload",
+    }
+    reddit_fields = ("id", "name", "is_gold", "is_mod", "author", "subreddit", "url", "title",
+                     "domain", "score", "upvote_ratio", "num_comments", "created_utc",
+                     "link_karma", "comment_karma", "is_self", "selftext", "body")
+    reddit_patterns = (
+        ("thread", re.compile(
+            r"^/r/(?P<subreddit>[^/]+)/comments/(?P<thread>[^/]+)(?:/[^/]+/?)?$")),
+        ("comment", re.compile(
+            r"^/r/(?P<subreddit>[^/]+)/comments/(?P<thread>[^/]+)/[^/]+/(?P<comment>\w+)$")),
+        ("user", re.compile(r"^/u(?:ser)?/(?P<user>[^/]+)/?$")),
+    )
+    reddit_batch_window = 0.05
+    reddit_batch_size = 100
+    reddit_public_url = "https://www.reddit.com"
+    reddit_oauth_url = "https://oauth.reddit.com"
+    reddit_token_url = "https://www.reddit.com/api/v1/access_token"
+    reddit_max_retry_wait = 1
+
+    youtube_batch_window = 0.05
+    youtube_fields = "items(id,snippet(title,channelTitle),contentDetails/duration,statistics)"
+    policy_global_settings = ("channelWhitelist", "channelBlacklist",
+                              "urlRegularExpression", "linkMessageIgnorePattern",
+                              "patternTimeoutInSeconds")
+    policy_channel_settings = ("ignoreActionLinks", "requireCapability",
+                               "ignoredDomainPattern", "whitelistDomainPattern",
+                               "ignoredTitlePattern", "handlerWhitelist")
 
     def __init__(self, irc):
         self.__parent = super(SpiffyTitles, self)
@@ -77,13 +134,132 @@ class SpiffyTitles(callbacks.Plugin):
 
         self.wall_clock_timeout = self.registryValue("wallClockTimeoutInSeconds")
         self.default_handler_enabled = self.registryValue("defaultHandlerEnabled")
+        self.link_cache = cache.LinkCache(self.registryValue("linkCacheMaxEntries"))
+        self.disk_cache = self.open_disk_cache()
+        self.lookup_state = concurrency.LookupState()
+        self.in_flight = concurrency.SingleFlight()
+        self.title_executor = concurrency.TitleExecutor(
+            max_workers=self.registryValue("titleFetchWorkers"),
+            per_host=self.registryValue("titleFetchWorkersPerHost"),
+            max_queue=self.registryValue("titleFetchQueueSize"),
+            name="SpiffyTitles")
+        self.event_loop = None
+        self.async_in_flight = concurrency.AsyncSingleFlight()
+
+        if self.registryValue("titleEngine") == "asyncio":
+            self.event_loop = eventloop.EventLoop("SpiffyTitles-asyncio")
+        self.curl_pool = transport.CurlPool()
+        self.api_session = transport.ApiSession()
+        self.handlers = domains.DomainTrie()
+        self.redirects = cache.LinkCache(self.registryValue("linkCacheMaxEntries"))
+        self.handler_names = {}
+        self.youtube_videos = cache.LinkCache(self.registryValue("linkCacheMaxEntries"))
+        self.wikipedia_extracts = cache.LinkCache(self.registryValue("linkCacheMaxEntries"))
+        self.wikipedia_titles = cache.LinkCache(self.registryValue("linkCacheMaxEntries"))
+        self.gazelle_responses = cache.LinkCache(self.registryValue("linkCacheMaxEntries"))
+        self.gazelle_apis = []
+        self.youtube_batcher = concurrency.Batcher(self.fetch_youtube_videos,
+                                                   window=self.youtube_batch_window)
+        self.reddit_batcher = concurrency.Batcher(self.fetch_reddit_things,
+                                                  window=self.reddit_batch_window,
+                                                  max_batch=self.reddit_batch_size)
+        self.reddit_token = None
+        self.reddit_rate_limit = transport.RateLimitPacer()
+        self.policies = policy.PolicyCache(self.build_channel_policy)
+        self.invalidate_policies = self.policies.invalidate
+        self.policy_values = {}
 
         self.add_handlers()
 
+    def die(self):
+        if self.event_loop is not None:
+            self.event_loop.close()
+
+        self.title_executor.shutdown(wait=False)
+        self.curl_pool.close()
+        self.api_session.close()
+
+        for api in self.gazelle_apis:
+            api.close()
+
+        for value in self.policy_values.values():
+            value.removeCallback(self.invalidate_policies)
+
+        if self.disk_cache is not None:
+            self.disk_cache.close()
+            self.disk_cache = None
+
+        self.__parent.die()
+
+    def get_channel_policy(self, channel):
+        """
+        Returns the settings snapshot for a channel
+        """
+        return self.policies.get(channel)
+
+    def build_channel_policy(self, channel):
+        """
+        Reads every per-message setting for a channel into a ChannelPolicy
+        and subscribes to changes of those settings
+        """
+        for name in self.policy_global_settings:
+            self.watch_policy_value(self.registryValue(name, value=False))
+
+        for name in self.policy_channel_settings:
+            self.watch_policy_value(self.registryValue(name, value=False))
+            self.watch_policy_value(self.registryValue(name, channel=channel, value=False))
+
+        try:
+            url_pattern = re.compile(self.registryValue("urlRegularExpression"))
+        except re.error as e:
+            log.error("SpiffyTitles: invalid urlRegularExpression: %s" % (e))
+            url_pattern = None
+
+        return policy.ChannelPolicy(
+            ignore_action_links=self.registryValue("ignoreActionLinks", channel=channel),
+            required_capability=str(self.registryValue("requireCapability", channel=channel)),
+            channel_allowed=self.is_channel_allowed(channel) if channel else False,
+            url_pattern=url_pattern,
+            message_ignore_pattern=self.registryValue("linkMessageIgnorePattern"),
+            ignored_domain_pattern=self.registryValue("ignoredDomainPattern", channel=channel),
+            whitelist_domain_pattern=self.registryValue("whitelistDomainPattern",
+                                                        channel=channel),
+            ignored_title_pattern=self.registryValue("ignoredTitlePattern", channel=channel),
+            pattern_timeout=self.registryValue("patternTimeoutInSeconds"),
+            handler_whitelist=frozenset(handler.strip().lower()
+                                        for handler in self.registryValue("handlerWhitelist",
+                                                                          channel=channel)
+                                        if len(handler.strip())))
+
+    def watch_policy_value(self, value):
+        """
+        Rebuilds the channel policies whenever this registry value changes.
+        Channel values don't inherit callbacks from their parent, so each one
+        is subscribed when first used.
+        """
+        if id(value) not in self.policy_values:
+            value.addCallback(self.invalidate_policies)
+            self.policy_values[id(value)] = value
+
+    def open_disk_cache(self):
+        """
+        Opens the persistent link cache in the bot's data directory, if enabled
+        """
+        if not self.registryValue("persistentLinkCacheEnabled"):
+            return None
+
+        path = conf.supybot.directories.data.dirize("SpiffyTitles.db")
+
+        try:
+            return cache.DiskCache(path)
+        except sqlite3.Error as e:
+            log.error("SpiffyTitles: unable to open link cache %s: %s" % (path, e))
+
     def add_handlers(self):
         """
         Adds all handlers
         """
+        self.add_shortener_handlers()
         self.add_youtube_handlers()
         self.add_imdb_handlers()
         self.add_imgur_handlers()
@@ -94,23 +270,29 @@ class SpiffyTitles(callbacks.Plugin):
         self.add_reddit_handlers()
         self.add_gazelle_handlers()
 
+    def add_shortener_handlers(self):
+        for domain in self.registryValue("shortenerDomains"):
+            self.handlers[domain] = self.handler_shortener
+
     def add_dailymotion_handlers(self):
-        self.handlers["www.dailymotion.com"] = self.handler_dailymotion
         self.handlers["dailymotion.com"] = self.handler_dailymotion
+        self.handlers["*.dailymotion.com"] = self.handler_dailymotion
         self.handlers["dai.ly"] = self.handler_dailymotion
 
     def add_vimeo_handlers(self):
         self.handlers["vimeo.com"] = self.handler_vimeo
+        self.handlers["*.vimeo.com"] = self.handler_vimeo
 
     def add_coub_handlers(self):
         self.handlers["coub.com"] = self.handler_coub
+        self.handlers["*.coub.com"] = self.handler_coub
 
     def add_wikipedia_handlers(self):
-        self.handlers["wikipedia.org"] = self.handler_wikipedia
+        self.handlers["*.wikipedia.org"] = self.handler_wikipedia
 
     def add_reddit_handlers(self):
         self.handlers["reddit.com"] = self.handler_reddit
-        self.handlers["www.reddit.com"] = self.handler_reddit
+        self.handlers["*.reddit.com"] = self.handler_reddit
 
     def add_gazelle_handlers(self):
         config_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'gazelle.conf')
@@ -118,55 +300,62 @@ class SpiffyTitles(callbacks.Plugin):
             log.warning("SpiffyTitles: %s is missing; gazelle handlers disabled", config_path)
             return
 
-        self.api_red = gazapi.GazAPI(config_path, 'redacted')
+        lifetime = self.registryValue("linkCacheLifetimeInSeconds")
+
+        self.api_red = gazapi.GazAPI(config_path, 'redacted', cache=self.gazelle_responses,
+                                     cache_lifetime=lifetime)
         self.handlers["redacted.sh"] = self.handler_redacted
+        self.handlers["*.redacted.sh"] = self.handler_redacted
 
-        self.api_apl = gazapi.GazAPI(config_path, 'orpheus')
+        self.api_apl = gazapi.GazAPI(config_path, 'orpheus', cache=self.gazelle_responses,
+                                     cache_lifetime=lifetime)
         self.handlers["orpheus.network"] = self.handler_apl
+        self.handlers["*.orpheus.network"] = self.handler_apl
+        self.gazelle_apis = [self.api_red, self.api_apl]
 
-
-    def handler_redacted(self, url, info, channel):
+    def handler_redacted(self, link, channel):
         """
         Queries gazelle API for additional information about tracker links.
 
         This handler is for any compatible gazelle site.
         """
-        args = self.gazelle_parse_url(url)
+        args = self.gazelle_parse_url(link)
 
         if args:
             result = self.gazelle_info(args, self.api_red)
-            return "^ " + unescape(result)
+            return self.render_lookup_payload("text", {"title": "^ " + unescape(result)},
+                                              channel)
 
 
-    def handler_apl(self, url, info, channel):
+    def handler_apl(self, link, channel):
         """
         Queries gazelle API for additional information about tracker links.
 
         This handler is for any compatible gazelle site.
         """
-        args = self.gazelle_parse_url(url)
+        args = self.gazelle_parse_url(link)
 
         if args:
             result = self.gazelle_info(args, self.api_apl)
-            return "^ " + unescape(result)
+            return self.render_lookup_payload("text", {"title": "^ " + unescape(result)},
+                                              channel)
 
-    def gazelle_parse_url(self, url):
-        """Take url and return api arguments to make api call."""
-        url = urlparse(url)
-        query = parse_qs(url.query)
+    def gazelle_parse_url(self, link):
+        """Take a Link and return api arguments to make api call."""
+        query = link.params
         api_args = {}
 
-        if url.path == '/torrents.php':
+        if link.path == '/torrents.php':
             if 'id' in query:
                 api_args = {'action': 'torrentgroup', 'id': query['id'][0]}
             elif 'torrentid' in query:
                 api_args = {'action': 'torrent', 'id': query['torrentid'][0]}
 
-        elif url.path == '/requests.php':
+        elif link.path == '/requests.php':
             if 'id' in query:
                 api_args = {'action': 'request', 'id': query['id'][0]}
 
-        elif url.path == '/forums.php':
+        elif link.path == '/forums.php':
             api_args = {'action': 'forum'}
             if 'threadid' in query:
                 api_args['type'] = 'viewthread'
@@ -177,11 +366,11 @@ class SpiffyTitles(callbacks.Plugin):
             else:
                 api_args = {}
 
-        elif url.path == '/collages.php':
+        elif link.path == '/collages.php':
             if 'id' in query:
                 api_args = {'action': 'collage', 'id': query['id'][0]}
 
-        elif url.path == '/artist.php':
+        elif link.path == '/artist.php':
             if 'id' in query:
                 api_args = {'action': 'artist', 'id': query['id'][0]}
 
@@ -211,7 +400,8 @@ class SpiffyTitles(callbacks.Plugin):
 
     def gazelle_info(self, args, api):
         """From api arguments get a title for the page."""
-        r = api.request(**args)
+        timeout = self.get_request_timeout("gazelle", "gazelle %s" % (args["action"]))
+        r = api.request(timeout=timeout, **args)
         if args['action'] == 'artist':
             title = "Artist's page for %s" % r['name']
 
@@ -242,34 +432,30 @@ class SpiffyTitles(callbacks.Plugin):
             title = "Uncaught title"
         return title
 
-    def handler_dailymotion(self, url, info, channel):
+    def handler_dailymotion(self, link, channel):
         """
         Handles dailymotion links
         """
         dailymotion_handler_enabled = self.registryValue("dailymotionHandlerEnabled",
                                                          channel=channel)
-        log.debug("SpiffyTitles: calling dailymotion handler for %s" % url)
+        log.debug("SpiffyTitles: calling dailymotion handler for %s" % link)
         title = None
         video_id = None
 
         """ Get video ID """
         if dailymotion_handler_enabled:
-            if "/video/" in info.path:
-                video_id = info.path.lstrip("/video/").split("_")[0]
+            if "/video/" in link.path:
+                video_id = link.path.lstrip("/video/").split("_")[0]
 
-            if info.netloc == "dai.ly":
-                video_id = info.path.lstrip("/")
+            if link.netloc == "dai.ly":
+                video_id = link.path.lstrip("/")
 
             if video_id is not None:
                 fields = "id,title,owner.screenname,duration,views_total"
                 api_url = "https://api.dailymotion.com/video/%s?fields=%s" % (video_id, fields)
                 log.debug("SpiffyTitles: looking up dailymotion info: %s", api_url)
-                agent = self.get_user_agent()
-                headers = {
-                    "User-Agent": agent
-                }
 
-                request = requests.get(api_url, headers=headers)
+                request = self.api_get("dailymotion", api_url)
 
                 ok = request.status_code == requests.codes.ok
 
@@ -278,14 +464,12 @@ class SpiffyTitles(callbacks.Plugin):
 
                     if response is not None and "title" in response:
                         video = response
-                        dailymotion_template = \
-                            Template(self.registryValue("dailymotionVideoTitleTemplate",
-                                                        channel=channel))
                         video["views_total"] = "{:,}".format(int(video["views_total"]))
                         video["duration"] = self.get_duration_from_seconds(video["duration"])
                         video["ownerscreenname"] = video["owner.screenname"]
 
-                        title = dailymotion_template.render(video)
+                        title = self.render_lookup_template("dailymotionVideoTitleTemplate",
+                                                            video, channel)
                     else:
                         log.debug("SpiffyTitles: received unexpected payload from video: %s" %
                                   api_url)
@@ -294,24 +478,24 @@ class SpiffyTitles(callbacks.Plugin):
                               (request.status_code, request.text[:200]))
 
         if title is None:
-            log.debug("SpiffyTitles: could not get dailymotion info for %s" % url)
+            log.debug("SpiffyTitles: could not get dailymotion info for %s" % link)
 
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
         else:
             return title
 
-    def handler_vimeo(self, url, domain, channel):
+    def handler_vimeo(self, link, channel):
         """
         Handles Vimeo links
         """
         vimeo_handler_enabled = self.registryValue("vimeoHandlerEnabled", channel=channel)
-        log.debug("SpiffyTitles: calling vimeo handler for %s" % url)
+        log.debug("SpiffyTitles: calling vimeo handler for %s" % link)
         title = None
         video_id = None
 
         """ Get video ID """
         if vimeo_handler_enabled:
-            result = re.search(r'^(http(s)://)?(www\.)?(vimeo\.com/)?(\d+)', url)
+            result = re.search(r'^(http(s)://)?(www\.)?(vimeo\.com/)?(\d+)', link)
 
             if result is not None:
                 video_id = result.group(5)
@@ -319,12 +503,8 @@ class SpiffyTitles(callbacks.Plugin):
             if video_id is not None:
                 api_url = "https://vimeo.com/api/v2/video/%s.json" % video_id
                 log.debug("SpiffyTitles: looking up vimeo info: %s", api_url)
-                agent = self.get_user_agent()
-                headers = {
-                    "User-Agent": agent
-                }
 
-                request = requests.get(api_url, headers=headers)
+                request = self.api_get("vimeo", api_url)
 
                 ok = request.status_code == requests.codes.ok
 
@@ -333,8 +513,6 @@ class SpiffyTitles(callbacks.Plugin):
 
                     if response is not None and "title" in response[0]:
                         video = response[0]
-                        vimeo_template = Template(self.registryValue("vimeoTitleTemplate",
-                                                  channel=channel))
 
                         """
                         Some videos do not have this information available
@@ -353,7 +531,8 @@ class SpiffyTitles(callbacks.Plugin):
 
                         video["duration"] = self.get_duration_from_seconds(video["duration"])
 
-                        title = vimeo_template.render(video)
+                        title = self.render_lookup_template("vimeoTitleTemplate", video,
+                                                            channel)
                     else:
                         log.debug("SpiffyTitles: received unexpected payload from video: %s" %
                                   api_url)
@@ -362,35 +541,27 @@ class SpiffyTitles(callbacks.Plugin):
                                                                                request.text[:200]))
 
         if title is None:
-            log.debug("SpiffyTitles: could not get vimeo info for %s" % url)
+            log.debug("SpiffyTitles: could not get vimeo info for %s" % link)
 
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
         else:
             return title
 
-    def handler_coub(self, url, domain, channel):
+    def handler_coub(self, link, channel):
         """
         Handles coub.com links
         """
         coub_handler_enabled = self.registryValue("coubHandlerEnabled", channel=channel)
-        log.debug("SpiffyTitles: calling coub handler for %s" % url)
+        log.debug("SpiffyTitles: calling coub handler for %s" % link)
         title = None
 
         """ Get video ID """
-        if coub_handler_enabled and "/view/" in url:
-            video_id = url.split("/view/")[1]
-
-            """ Remove any query strings """
-            if "?" in video_id:
-                video_id = video_id.split("?")[0]
+        if coub_handler_enabled and "/view/" in link.path:
+            video_id = link.path.split("/view/")[1]
 
             api_url = "http://coub.com/api/v2/coubs/%s" % video_id
-            agent = self.get_user_agent()
-            headers = {
-                "User-Agent": agent
-            }
 
-            request = requests.get(api_url, headers=headers)
+            request = self.api_get("coub", api_url)
 
             ok = request.status_code == requests.codes.ok
 
@@ -399,22 +570,21 @@ class SpiffyTitles(callbacks.Plugin):
 
                 if response:
                     video = response
-                    coub_template = Template(self.registryValue("coubTemplate"))
 
                     video["likes_count"] = "{:,}".format(int(video["likes_count"]))
                     video["recoubs_count"] = "{:,}".format(int(video["recoubs_count"]))
                     video["views_count"] = "{:,}".format(int(video["views_count"]))
 
-                    title = coub_template.render(video)
+                    title = self.render_lookup_template("coubTemplate", video, channel)
             else:
                 log.error("SpiffyTitles: coub handler returned %s: %s" %
                           (request.status_code, request.text[:200]))
 
         if title is None:
             if coub_handler_enabled:
-                log.debug("SpiffyTitles: %s does not appear to be a video link!" % url)
+                log.debug("SpiffyTitles: %s does not appear to be a video link!" % link)
 
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
         else:
             return title
 
@@ -424,6 +594,7 @@ class SpiffyTitles(callbacks.Plugin):
 
         # Albums, galleries, etc
         self.handlers["imgur.com"] = self.handler_imgur
+        self.handlers["*.imgur.com"] = self.handler_imgur
 
     def initialize_imgur_client(self, channel):
         """
@@ -457,7 +628,8 @@ class SpiffyTitles(callbacks.Plugin):
         Observe each channel message and look for links
         """
         channel = msg.args[0]
-        ignore_actions = self.registryValue("ignoreActionLinks", channel=msg.args[0])
+        channel_policy = self.get_channel_policy(channel)
+        ignore_actions = channel_policy.ignore_action_links
         is_channel = irc.isChannel(channel)
         is_ctcp = ircmsgs.isCtcp(msg)
         message = msg.args[1]
@@ -465,8 +637,7 @@ class SpiffyTitles(callbacks.Plugin):
         bot_nick = irc.nick
         origin_nick = msg.nick
         is_message_from_self = origin_nick.lower() == bot_nick.lower()
-        requires_capability = len(str(self.registryValue("requireCapability",
-                                                         channel=msg.args[0]))) > 0
+        requires_capability = len(channel_policy.required_capability) > 0
 
         if is_message_from_self:
             return
@@ -488,9 +659,9 @@ class SpiffyTitles(callbacks.Plugin):
             return
 
         if is_channel:
-            channel_is_allowed = self.is_channel_allowed(channel)
-            urls = self.get_urls_from_message(message)
-            ignore_match = self.message_matches_ignore_pattern(message)
+            channel_is_allowed = channel_policy.channel_allowed
+            urls = self.get_urls_from_message(message, channel)
+            ignore_match = self.message_matches_ignore_pattern(message, channel)
 
             if ignore_match:
                 log.debug("SpiffyTitles: ignoring message due to linkMessagePattern match")
@@ -525,29 +696,64 @@ class SpiffyTitles(callbacks.Plugin):
         """
         titles = []
         include_bad_urls = len(urls) > 1
-        titles_by_index = {}
+        titles_by_key = {}
 
         if not urls:
             return titles
 
-        max_workers = min(self.title_fetch_workers, len(urls))
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {
-                executor.submit(self.get_title_by_message_url, url, channel): (index, url)
-                for index, url in enumerate(urls, start=1)
-            }
+        message_links = [links.Link.of(url) for url in urls]
+
+        # The same link pasted twice in a message is only looked up once, even
+        # when the copies only differ by tracking parameters or letter case
+        unique_links = {}
+
+        for link in message_links:
+            unique_links.setdefault(link.key, link)
+
+        unique_links = list(unique_links.values())
+        deadline = self.get_message_deadline()
 
-            for future in as_completed(futures):
-                index, url = futures[future]
+        if len(unique_links) > 1:
+            self.prefetch_youtube_videos(unique_links, channel)
+            self.prefetch_reddit_things(unique_links, channel)
 
+        futures = {}
+
+        for link in unique_links:
+            if self.event_loop is not None:
+                future = self.event_loop.submit(
+                    self.get_title_by_message_url_async(link, channel, deadline))
+            else:
                 try:
-                    titles_by_index[index] = future.result()
-                except Exception as e:
-                    log.error("SpiffyTitles: error getting title for %s: %s" % (url, e))
-                    titles_by_index[index] = None
+                    future = self.title_executor.submit(link.host,
+                                                        self.get_title_by_message_url,
+                                                        link, channel, deadline)
+                except concurrency.QueueFull as e:
+                    log.warning("SpiffyTitles: not looking up %s: %s" % (link, e))
+                    continue
+
+            futures[future] = link
+
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        done, not_done = wait(futures, timeout=timeout)
+
+        for future in not_done:
+            # Too late for this message; whatever resolved is posted without it
+            log.debug("SpiffyTitles: message deadline passed before %s resolved" %
+                      (futures[future]))
+            future.cancel()
+
+        for future in done:
+            link = futures[future]
+
+            try:
+                titles_by_key[link.key] = future.result()
+            except Exception as e:
+                log.error("SpiffyTitles: error getting title for %s: %s" % (link, e))
+                titles_by_key[link.key] = None
 
-        for index in range(1, len(urls) + 1):
-            title = titles_by_index.get(index)
+        for index, link in enumerate(message_links, start=1):
+            title = titles_by_key.get(link.key)
 
             if title is not None and title:
                 titles.append((index, title))
@@ -556,26 +762,70 @@ class SpiffyTitles(callbacks.Plugin):
 
         return titles
 
-    def get_title_by_message_url(self, url, channel):
+    def get_title_by_message_url(self, url, channel, deadline=None):
         """
         Return a title for one URL, applying message-time filters.
         """
-        info = urlparse(url)
-        domain = info.netloc
+        link = links.Link.of(url)
+
+        if not self.is_message_url_allowed(link, channel):
+            return
+
+        title = self.get_title_by_url(link, channel, deadline)
+
+        return self.get_visible_title(title, channel)
+
+    async def get_title_by_message_url_async(self, url, channel, deadline=None):
+        """
+        Event loop version of get_title_by_message_url. Default handler
+        lookups run on the loop; the API handlers block, so they are handed
+        to the title executor's threads. Operator patterns may run in a
+        subprocess, so they are checked off the loop too.
+        """
+        link = links.Link.of(url)
+
+        if not await concurrency.run_in_thread(self.is_message_url_allowed, link, channel):
+            return
+
+        handler, is_default_handler = self.get_handler_for_url(link)
+
+        if is_default_handler:
+            title = await self.get_title_by_url_async(link, channel, deadline)
+        else:
+            future = self.title_executor.submit(link.host,
+                                                self.get_title_by_url, link, channel, deadline)
+
+            try:
+                title = await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+
+        return await concurrency.run_in_thread(self.get_visible_title, title, channel)
+
+    def is_message_url_allowed(self, link, channel):
+        """
+        Applies the domain blacklist and whitelist to a link from a message
+        """
+        domain = link.netloc
         is_ignored = self.is_ignored_domain(domain, channel)
 
         if is_ignored:
-            log.debug("SpiffyTitles: URL ignored due to domain blacklist match: %s" % url)
-            return
+            log.debug("SpiffyTitles: URL ignored due to domain blacklist match: %s" % link)
+            return False
 
         is_whitelisted_domain = self.is_whitelisted_domain(domain, channel)
-        whitelist_pattern = self.registryValue("whitelistDomainPattern", channel=channel)
+        whitelist_pattern = self.get_channel_policy(channel).whitelist_domain_pattern
         if whitelist_pattern and not is_whitelisted_domain:
-            log.debug("SpiffyTitles: URL ignored due to domain whitelist mismatch: %s" % url)
-            return
+            log.debug("SpiffyTitles: URL ignored due to domain whitelist mismatch: %s" % link)
+            return False
 
-        title = self.get_title_by_url(url, channel)
+        return True
 
+    def get_visible_title(self, title, channel):
+        """
+        Drops empty titles and titles matching ignoredTitlePattern
+        """
         if title is not None and title:
             ignore_match = self.title_matches_ignore_pattern(title, channel)
 
@@ -605,14 +855,17 @@ class SpiffyTitles(callbacks.Plugin):
         """
         Remove the normal snarfer prefix when titles are joined together.
         """
-        return re.sub(r'^\s*\^\s*', '', title).strip()
+        return title_prefix_pattern.sub('', title).strip()
 
-    def get_title_by_url(self, url, channel):
+    def get_title_by_url(self, url, channel, deadline=None):
         """
-        Retrieves the title of a website based on the URL provided
+        Retrieves the title of a website based on the URL provided. deadline
+        is a time.monotonic() value by which the handler, its retries and
+        its fallbacks must give up.
         """
         title = None
-        handler, info, is_default_handler = self.get_handler_for_url(url)
+        link = links.Link.of(url)
+        handler, is_default_handler = self.get_handler_for_url(link)
 
         if handler is None:
             return title
@@ -626,45 +879,178 @@ class SpiffyTitles(callbacks.Plugin):
         Check if we have this link cached according to the cache lifetime. If so, serve
         link from the cache instead of calling handlers.
         """
-        cached_link = self.get_link_from_cache(url)
+        cached_link = self.get_link_from_cache(link)
 
         if cached_link is not None:
-            title = cached_link["title"]
-        else:
-            if is_default_handler:
-                title = handler(url, channel)
+            return self.get_cached_title(cached_link, channel)
+
+        """
+        Concurrent lookups of the same link share a single handler call. Each
+        caller renders the shared result with its own channel's settings.
+        """
+        cached_link = self.in_flight.do(link.key, self.fetch_title_by_url, handler, link,
+                                        channel, deadline)
+
+        return self.get_cached_title(cached_link, channel)
+
+    async def get_title_by_url_async(self, link, channel, deadline=None):
+        """
+        Event loop version of get_title_by_url for links using the default
+        handler
+        """
+        if not self.is_handler_allowed(self.handler_default, channel):
+            log.debug("SpiffyTitles: handler default is not allowed in %s" % (channel))
+            return None
+
+        # The link cache may read from SQLite
+        cached_link = await concurrency.run_in_thread(self.get_link_from_cache, link)
+
+        if cached_link is not None:
+            return self.get_cached_title(cached_link, channel)
+
+        cached_link = await self.async_in_flight.do(link.key, self.fetch_default_title_async,
+                                                    link, channel, deadline)
+
+        return self.get_cached_title(cached_link, channel)
+
+    async def fetch_default_title_async(self, link, channel, deadline=None):
+        """
+        Calls the default handler on the event loop and caches the result,
+        writing the cache from a worker thread
+        """
+        self.lookup_state.failure = None
+        self.lookup_state.payload = None
+        self.lookup_state.deadline = deadline
+        title = await self.handler_default_async(link, channel)
+
+        return await concurrency.run_in_thread(self.cache_lookup_result, link, title, channel)
+
+    def fetch_title_by_url(self, handler, link, channel, deadline=None):
+        """
+        Calls the handler for a link and caches the result, returning the
+        cache entry. The deadline is kept in the lookup state, where the
+        handler's requests, retries and fallbacks check it.
+        """
+        self.lookup_state.failure = None
+        self.lookup_state.payload = None
+        self.lookup_state.deadline = deadline
+
+        try:
+            title = handler(link, channel)
+        except requests.exceptions.Timeout as e:
+            remaining = self.get_remaining_time()
+
+            # Cut short by the message deadline, which says nothing about the link
+            if remaining is not None and remaining <= 0:
+                log.debug("SpiffyTitles: deadline passed looking up %s: %s" % (link, e))
+                self.set_lookup_failure("deadline")
             else:
-                title = handler(url, info, channel)
+                log.error("SpiffyTitles: API request for %s timed out: %s" % (link, e))
+                self.set_lookup_failure("timeout")
+
+            title = None
+        except requests.exceptions.ConnectionError as e:
+            log.error("SpiffyTitles: API connection for %s failed: %s" % (link, e))
+            self.set_lookup_failure("connection")
+            title = None
+
+        return self.cache_lookup_result(link, title, channel)
 
+    def cache_lookup_result(self, url, title, channel):
+        """
+        Caches a handler's title along with the payload it was rendered from,
+        or caches why there was none. Returns the cache entry, or None.
+        """
         if title is not None:
             title = self.get_formatted_title(title, channel)
 
-            # Update link cache
-            log.debug("SpiffyTitles: caching %s" % (url))
-            now = datetime.datetime.now()
-            self.link_cache.append({
-                "url": url,
-                "timestamp": now,
-                "title": title
-            })
+            return self.add_link_to_cache(url, title, payload=self.lookup_state.payload)
+        elif self.lookup_state.failure is not None:
+            return self.add_failure_to_cache(url, self.lookup_state.failure)
+
+    def get_cached_title(self, cached_link, channel):
+        """
+        Returns the title of a cache entry for a channel. Entries that kept
+        their provider payload are rendered with the channel's templates and
+        formatting; older entries only have the title they were cached with.
+        """
+        if cached_link is None:
+            return None
+
+        payload = cached_link.get("payload")
+
+        if payload is None:
+            return cached_link["title"]
+
+        kind, data = payload
+        title = self.render_payload(kind, data, channel)
+
+        if title is not None:
+            title = self.get_formatted_title(title, channel)
 
         return title
 
-    def get_handler_for_url(self, url):
-        info = urlparse(url)
-        domain = info.netloc
+    def render_lookup_payload(self, kind, data, channel):
+        """
+        Renders a provider payload for the channel of the current lookup and
+        keeps it in the lookup state, so the cache can render it again for
+        other channels. Handlers return the result as their title.
+        """
+        self.lookup_state.payload = (kind, data)
+
+        return self.render_payload(kind, data, channel)
+
+    def render_payload(self, kind, data, channel):
+        """
+        Renders a payload stored by render_lookup_payload
+        """
+        renderer = self.payload_renderers.get(kind)
+
+        if renderer is None:
+            log.debug("SpiffyTitles: no renderer for cached payload %s" % (kind))
+            return None
+
+        return getattr(self, renderer)(data, channel)
+
+    def render_template_payload(self, data, channel):
+        """
+        Renders the template in the registry setting data["template"] with
+        the variables in data["variables"]
+        """
+        setting = self.registryValue(data["template"], value=False)
+        source = setting.getSpecific(channel=channel, check=False)()
+
+        return templates.get_template(source).render(data["variables"])
+
+    def render_lookup_template(self, setting, variables, channel):
+        """
+        Renders the template in a registry setting for the current lookup,
+        see render_lookup_payload
+        """
+        data = {"template": setting, "variables": variables}
+
+        return self.render_lookup_payload("template", data, channel)
+
+    def render_text_payload(self, data, channel):
+        """
+        Returns a title that does not depend on channel settings
+        """
+        return data["title"]
 
-        if domain in self.handlers:
-            return self.handlers[domain], info, False
+    def get_handler_for_url(self, link):
+        """
+        Returns (handler, is_default_handler) for a Link. Every handler is
+        called with the Link and the channel.
+        """
+        handler = self.handlers.match(link.host)
 
-        base_domain = self.get_base_domain('http://' + domain)
-        if base_domain in self.handlers:
-            return self.handlers[base_domain], info, False
+        if handler is not None:
+            return handler, False
 
         if self.default_handler_enabled:
-            return self.handler_default, info, True
+            return self.handler_default, True
 
-        return None, info, False
+        return None, False
 
     def is_handler_allowed(self, handler, channel):
         handler_whitelist = self.get_handler_whitelist(channel)
@@ -675,19 +1061,22 @@ class SpiffyTitles(callbacks.Plugin):
         return bool(handler_whitelist.intersection(handler_names))
 
     def get_handler_whitelist(self, channel):
-        return set([handler.strip().lower()
-                    for handler in self.registryValue("handlerWhitelist",
-                                                      channel=channel)
-                    if len(handler.strip())])
+        return self.get_channel_policy(channel).handler_whitelist
 
     def get_handler_names(self, handler):
         handler_name = getattr(handler, "__name__", "")
-        names = set(self.handler_whitelist_aliases.get(handler_name, set()))
+        names = self.handler_names.get(handler_name)
 
-        if handler_name.startswith("handler_"):
-            names.add(handler_name[len("handler_"):])
-        elif handler_name:
-            names.add(handler_name)
+        if names is None:
+            names = set(self.handler_whitelist_aliases.get(handler_name, set()))
+
+            if handler_name.startswith("handler_"):
+                names.add(handler_name[len("handler_"):])
+            elif handler_name:
+                names.add(handler_name)
+
+            names = frozenset(names)
+            self.handler_names[handler_name] = names
 
         return names
 
@@ -709,7 +1098,7 @@ class SpiffyTitles(callbacks.Plugin):
 
         try:
             if url:
-                title = self.get_title_by_url(query, channel)
+                title = self.get_title_by_url(query, channel, self.get_message_deadline())
         except:
             pass
 
@@ -722,7 +1111,7 @@ class SpiffyTitles(callbacks.Plugin):
 
     def get_link_from_cache(self, url):
         """
-        Looks for a URL in the link cache and returns info about if it's not stale
+        Looks for a URL in the link cache and returns info about it if it's not stale
         according to the configured cache lifetime, or None.
 
         If linkCacheLifetimeInSeconds is 0, then cache is disabled and we can
@@ -733,36 +1122,106 @@ class SpiffyTitles(callbacks.Plugin):
         if cache_lifetime_in_seconds == 0:
             return
 
-        # No cache yet
-        if len(self.link_cache) == 0:
-            return
-
-        cached_link = None
-        now = datetime.datetime.now()
-        stale = False
-        seconds = 0
+        key = links.Link.of(url).key
+        cached_link = self.link_cache.get(key)
 
-        for link in self.link_cache:
-            if link["url"] == url:
-                cached_link = link
-                break
+        if cached_link is None:
+            cached_link = self.get_link_from_disk_cache(key)
 
-        # Found link, check timestamp
         if cached_link is not None:
-            seconds = (now - cached_link["timestamp"]).total_seconds()
-            stale = seconds >= cache_lifetime_in_seconds
+            if cached_link.get("failure"):
+                log.debug("SpiffyTitles: serving failure from cache: %s (%s)" %
+                          (url, cached_link["failure"]))
+            else:
+                log.debug("SpiffyTitles: serving link from cache: %s" % (url))
+
+        return cached_link
+
+    def get_link_from_disk_cache(self, key):
+        """
+        Looks for a canonical URL in the persistent cache and promotes it to
+        the in-memory cache for the rest of its lifetime.
+        """
+        if self.disk_cache is None:
+            return
+
+        try:
+            entry = self.disk_cache.get(key)
+        except sqlite3.Error as e:
+            log.error("SpiffyTitles: error reading link cache: %s" % (e))
+            return
+
+        if entry is not None:
+            cached_link, expires = entry
+            self.link_cache.put(key, cached_link, expires - time.time())
 
-        if stale:
-            log.debug("SpiffyTitles: %s was sent %s seconds ago" % (url, seconds))
-        else:
-            log.debug("SpiffyTitles: serving link from cache: %s" % (url))
             return cached_link
 
+    def add_link_to_cache(self, url, title, failure=None, lifetime=None, payload=None):
+        """
+        Caches a title for the configured cache lifetime, returning the entry.
+        payload is the (kind, data) the title was rendered from.
+        """
+        if lifetime is None:
+            lifetime = int(self.registryValue("linkCacheLifetimeInSeconds"))
+
+        cached_link = {
+            "url": url,
+            "timestamp": time.time(),
+            "title": title
+        }
+
+        if failure is not None:
+            cached_link["failure"] = failure
+
+        if payload is not None:
+            cached_link["payload"] = payload
+
+        key = links.Link.of(url).key
+
+        log.debug("SpiffyTitles: caching %s as %s" % (url, key))
+        self.link_cache.put(key, cached_link, lifetime)
+
+        if self.disk_cache is not None:
+            try:
+                self.disk_cache.put(key, cached_link, lifetime)
+            except sqlite3.Error as e:
+                log.error("SpiffyTitles: error writing link cache: %s" % (e))
+
+        return cached_link
+
+    def add_failure_to_cache(self, url, reason):
+        """
+        Caches a failed lookup for the shorter negative cache lifetime, so
+        reposts of a dead link don't hit the network again.
+
+        reason is one of "timeout", "connection", "http <status>", "mime",
+        "empty" or "no title". "deadline" and "rate limit" failures only mean
+        the message ran out of time, possibly before the link was even
+        requested, so they are not cached.
+        """
+        if int(self.registryValue("linkCacheLifetimeInSeconds")) == 0:
+            return
+
+        if reason in ("deadline", "rate limit"):
+            return
+
+        lifetime = int(self.registryValue("negativeCacheLifetimeInSeconds"))
+
+        return self.add_link_to_cache(url, None, failure=reason, lifetime=lifetime)
+
+    def set_lookup_failure(self, reason):
+        """
+        Records why the current lookup failed, for the negative cache
+        """
+        self.lookup_state.failure = reason
+
     def add_imdb_handlers(self):
         """
         Enables meta info about IMDB links through IMDb suggestions
         """
         self.handlers["imdb.com"] = self.handler_imdb
+        self.handlers["*.imdb.com"] = self.handler_imdb
 
     def add_youtube_handlers(self):
         """
@@ -770,6 +1229,7 @@ class SpiffyTitles(callbacks.Plugin):
         domain used in the URL.
         """
         self.handlers["youtube.com"] = self.handler_youtube
+        self.handlers["*.youtube.com"] = self.handler_youtube
         self.handlers["youtu.be"] = self.handler_youtube
 
     def is_channel_allowed(self, channel):
@@ -808,71 +1268,56 @@ class SpiffyTitles(callbacks.Plugin):
         """
         Checks domain against a regular expression
         """
-        pattern = self.registryValue("ignoredDomainPattern", channel=channel)
+        pattern = self.get_channel_policy(channel).ignored_domain_pattern
 
         if pattern:
             log.debug("SpiffyTitles: matching %s against %s" % (domain, str(pattern)))
 
-            try:
-                pattern_search_result = re.search(pattern, domain)
-
-                if pattern_search_result is not None:
-                    match = pattern_search_result.group()
+            return self.search_pattern(pattern, domain, channel, "ignoredDomainPattern")
 
-                    return match
-            except re.Error:
-                log.error("SpiffyTitles: invalid regular expression: %s" % (pattern))
+        return False
 
     def is_whitelisted_domain(self, domain, channel):
         """
         Checks domain against a regular expression
         """
-        pattern = self.registryValue("whitelistDomainPattern", channel=channel)
+        pattern = self.get_channel_policy(channel).whitelist_domain_pattern
 
         if pattern:
             log.debug("SpiffyTitles: matching %s against %s" % (domain, str(pattern)))
 
-            try:
-                pattern_search_result = re.search(pattern, domain)
-
-                if pattern_search_result is not None:
-                    match = pattern_search_result.group()
+            return self.search_pattern(pattern, domain, channel, "whitelistDomainPattern")
 
-                    return match
-            except re.Error:
-                log.error("SpiffyTitles: invalid regular expression: %s" % (pattern))
+        return False
 
-    def get_video_id_from_url(self, url: str) -> str | None:
+    def get_video_id_from_url(self, link: links.Link) -> str | None:
         """
-        Extract the YouTube video ID from *url*.
+        Extract the YouTube video ID from *link*.
 
         Returns the 11-character video ID, or None if it can’t be found.
         """
         try:
-            info = urlparse(url)
-            domain = info.netloc.lower()
             video_id: str | None = None
 
             # 1)  youtu.be/<id>
-            if domain == "youtu.be":
+            if link.host == "youtu.be":
                 #  '/abc123' → 'abc123'
-                video_id = info.path.lstrip("/")
+                video_id = link.path.lstrip("/")
 
             # 2)  www.youtube.com/watch?v=<id>&…
             else:
-                query_pairs = parse_qs(info.query)
-                video_id = query_pairs.get("v", [None])[0]
+                video_id = link.params.get("v", [None])[0]
 
             if video_id:
                 return video_id
 
-            log.error("SpiffyTitles: couldn’t get video id from %s", url)
+            log.error("SpiffyTitles: couldn’t get video id from %s", link)
         except Exception as exc:
-            log.error("SpiffyTitles: error getting video id from %s (%s)", url, exc)
+            log.error("SpiffyTitles: error getting video id from %s (%s)", link, exc)
 
         return None
 
-    def handler_youtube(self, url, domain, channel):
+    def handler_youtube(self, link, channel):
         """
         Uses the Youtube API to provide additional meta data about
         Youtube Video links posted.
@@ -888,102 +1333,27 @@ class SpiffyTitles(callbacks.Plugin):
                       for instructions.")
             return None
 
-        log.debug("SpiffyTitles: calling Youtube handler for %s" % (url))
-        video_id = self.get_video_id_from_url(url)
-        yt_template = Template(self.registryValue("youtubeTitleTemplate", channel=channel))
+        log.debug("SpiffyTitles: calling Youtube handler for %s" % (link))
+        video_id = self.get_video_id_from_url(link)
         title = ""
 
         if video_id:
-            options = {
-                "part": "snippet,statistics,contentDetails",
-                "maxResults": 1,
-                "key": developer_key,
-                "id": video_id
-            }
-            encoded_options = urlencode(options)
-            api_url = "https://www.googleapis.com/youtube/v3/videos?%s" % (encoded_options)
-            agent = self.get_user_agent()
-            headers = {
-                "User-Agent": agent
-            }
-
-            log.debug("SpiffyTitles: requesting %s" % (api_url))
+            video = self.youtube_videos.get(video_id)
 
-            request = requests.get(api_url, headers=headers)
-            ok = request.status_code == requests.codes.ok
-
-            if ok:
-                response = json.loads(request.text)
+            if video is None:
+                try:
+                    video = self.youtube_batcher.get(video_id, self.get_remaining_time())
+                except FutureTimeoutError:
+                    log.debug("SpiffyTitles: deadline passed waiting for Youtube video %s" %
+                              (video_id))
+                    self.set_lookup_failure("deadline")
 
-                if response:
-                    try:
-                        if response["pageInfo"]["totalResults"] > 0:
-                            items = response["items"]
-                            video = items[0]
-                            snippet = video["snippet"]
-                            title = snippet["title"]
-                            statistics = video["statistics"]
-                            view_count = 0
-                            like_count = 0
-                            dislike_count = 0
-                            comment_count = 0
-                            favorite_count = 0
-
-                            if "viewCount" in statistics:
-                                view_count = "{:,}".format(int(statistics["viewCount"]))
-
-                            if "likeCount" in statistics:
-                                like_count = "{:,}".format(int(statistics["likeCount"]))
-
-                            if "dislikeCount" in statistics:
-                                dislike_count = "{:,}".format(int(statistics["dislikeCount"]))
-
-                            if "favoriteCount" in statistics:
-                                favorite_count = "{:,}".format(int(statistics["favoriteCount"]))
-
-                            if "commentCount" in statistics:
-                                comment_count = "{:,}".format(int(statistics["commentCount"]))
-
-                            channel_title = snippet["channelTitle"]
-                            video_duration = video["contentDetails"]["duration"]
-                            duration_seconds = self.get_total_seconds_from_duration(video_duration)
-
-                            """
-                            #23 - If duration is zero, then it"s a LIVE video
-                            """
-                            if duration_seconds > 0:
-                                duration = self.get_duration_from_seconds(duration_seconds)
-                            else:
-                                duration = "LIVE"
-
-                            timestamp = self.get_timestamp_from_youtube_url(url)
-                            yt_logo = self.get_youtube_logo()
-
-                            compiled_template = yt_template.render({
-                                "title": title,
-                                "duration": duration,
-                                "timestamp": timestamp,
-                                "view_count": view_count,
-                                "like_count": like_count,
-                                "dislike_count": dislike_count,
-                                "comment_count": comment_count,
-                                "favorite_count": favorite_count,
-                                "channel_title": channel_title,
-                                "yt_logo": yt_logo
-                            })
-
-                            title = compiled_template
-                        else:
-                            log.debug("SpiffyTitles: video appears to be private; no results!")
+                    return None
 
-                    except IndexError as e:
-                        log.error("SpiffyTitles: IndexError parsing Youtube API JSON response: %s" %
-                                  (str(e)))
-                else:
-                    log.error("SpiffyTitles: Error parsing Youtube API JSON response")
+            if video is not None:
+                title = self.get_youtube_title(video, link, channel)
             else:
-                log.error("SpiffyTitles: Youtube API HTTP %s: %s" %
-                          (request.status_code, request.text))
+                log.debug("SpiffyTitles: video appears to be private; no results!")
 
         # If we found a title, return that. otherwise, use default handler
         if title:
@@ -991,7 +1361,130 @@ class SpiffyTitles(callbacks.Plugin):
         else:
             log.debug("SpiffyTitles: falling back to default handler")
 
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
+
+    def prefetch_youtube_videos(self, message_links, channel):
+        """
+        Queues every uncached YouTube video in a message for a single
+        videos.list request, before the handlers ask for them one by one
+        """
+        if not self.registryValue("youtubeHandlerEnabled", channel=channel):
+            return
+
+        if not self.registryValue("youtubeDeveloperKey"):
+            return
+
+        video_ids = []
+
+        for link in message_links:
+            handler, is_default_handler = self.get_handler_for_url(link)
+
+            if handler != self.handler_youtube or self.get_link_from_cache(link) is not None:
+                continue
+
+            video_id = self.get_video_id_from_url(link)
+
+            if video_id and self.youtube_videos.get(video_id) is None:
+                video_ids.append(video_id)
+
+        if len(video_ids) > 1:
+            self.youtube_batcher.submit(video_ids)
+
+    def fetch_youtube_videos(self, video_ids):
+        """
+        Looks up to 50 videos with one videos.list request, returning and
+        caching them by video ID
+        """
+        options = {
+            "part": "snippet,statistics,contentDetails",
+            "key": self.registryValue("youtubeDeveloperKey"),
+            "id": ",".join(video_ids),
+            "fields": self.youtube_fields
+        }
+        encoded_options = urlencode(options)
+        api_url = "https://www.googleapis.com/youtube/v3/videos?%s" % (encoded_options)
+
+        log.debug("SpiffyTitles: requesting %s videos from the Youtube API" % (len(video_ids)))
+
+        request = self.api_get("youtube", api_url)
+
+        if request.status_code != requests.codes.ok:
+            log.error("SpiffyTitles: Youtube API HTTP %s: %s" %
+                      (request.status_code, request.text))
+            return {}
+
+        try:
+            items = json.loads(request.text).get("items", [])
+        except ValueError:
+            log.error("SpiffyTitles: Error parsing Youtube API JSON response")
+            return {}
+
+        lifetime = self.registryValue("linkCacheLifetimeInSeconds")
+        videos = {}
+
+        for video in items:
+            if video.get("id") in video_ids:
+                videos[video["id"]] = video
+                self.youtube_videos.put(video["id"], video, lifetime)
+
+        return videos
+
+    def get_youtube_title(self, video, link, channel):
+        """
+        Renders youtubeTitleTemplate for a video from the API. The timestamp
+        comes from the link, so cached videos are rendered per link.
+        """
+        snippet = video["snippet"]
+        title = snippet["title"]
+        statistics = video.get("statistics", {})
+        view_count = 0
+        like_count = 0
+        dislike_count = 0
+        comment_count = 0
+        favorite_count = 0
+
+        if "viewCount" in statistics:
+            view_count = "{:,}".format(int(statistics["viewCount"]))
+
+        if "likeCount" in statistics:
+            like_count = "{:,}".format(int(statistics["likeCount"]))
+
+        if "dislikeCount" in statistics:
+            dislike_count = "{:,}".format(int(statistics["dislikeCount"]))
+
+        if "favoriteCount" in statistics:
+            favorite_count = "{:,}".format(int(statistics["favoriteCount"]))
+
+        if "commentCount" in statistics:
+            comment_count = "{:,}".format(int(statistics["commentCount"]))
+
+        channel_title = snippet["channelTitle"]
+        video_duration = video["contentDetails"]["duration"]
+        duration_seconds = self.get_total_seconds_from_duration(video_duration)
+
+        """
+        #23 - If duration is zero, then it"s a LIVE video
+        """
+        if duration_seconds > 0:
+            duration = self.get_duration_from_seconds(duration_seconds)
+        else:
+            duration = "LIVE"
+
+        timestamp = self.get_timestamp_from_youtube_url(link)
+        yt_logo = self.get_youtube_logo()
+
+        return self.render_lookup_template("youtubeTitleTemplate", {
+            "title": title,
+            "duration": duration,
+            "timestamp": timestamp,
+            "view_count": view_count,
+            "like_count": like_count,
+            "dislike_count": dislike_count,
+            "comment_count": comment_count,
+            "favorite_count": favorite_count,
+            "channel_title": channel_title,
+            "yt_logo": yt_logo
+        }, channel)
 
     def get_duration_from_seconds(self, duration_seconds):
         m, s = divmod(duration_seconds, 60)
@@ -1021,18 +1514,7 @@ class SpiffyTitles(callbacks.Plugin):
         4 minutes and 41 seconds. This method returns the total seconds
         so that the duration can be parsed as usual.
         """
-        regex = re.compile(r"""
-                   (?P<sign>    -?) P
-                (?:(?P<years>  \d+) Y)?
-                (?:(?P<months> \d+) M)?
-                (?:(?P<days>   \d+) D)?
-            (?:                     T
-                (?:(?P<hours>  \d+) H)?
-                (?:(?P<minutes>\d+) M)?
-                (?:(?P<seconds>\d+) S)?
-            )?
-            """, re.VERBOSE)
-        duration = regex.match(input).groupdict(0)
+        duration = duration_pattern.match(input).groupdict(0)
 
         delta = timedelta(hours=int(duration['hours']),
                           minutes=int(duration['minutes']),
@@ -1040,15 +1522,14 @@ class SpiffyTitles(callbacks.Plugin):
 
         return delta.total_seconds()
 
-    def get_timestamp_from_youtube_url(self, url):
+    def get_timestamp_from_youtube_url(self, link):
         """
         Get YouTube timestamp
         """
-        pattern = r"[?&]t=([^&]+)"
-        match = re.search(pattern, url)
+        timestamp = link.params.get("t", [None])[0]
 
-        if match:
-            timestamp = match.group(1).upper()
+        if timestamp:
+            timestamp = timestamp.upper()
             try:
                 seconds = float(timestamp)
             except ValueError:
@@ -1059,82 +1540,174 @@ class SpiffyTitles(callbacks.Plugin):
         else:
             return ""
 
-    def handler_default(self, url, channel):
+    def handler_default(self, link, channel):
         """
         Default handler for websites
         """
         default_handler_enabled = self.registryValue("defaultHandlerEnabled", channel=channel)
 
         if default_handler_enabled:
-            log.debug("SpiffyTitles: calling default handler for %s" % (url))
-            default_template = Template(self.registryValue("defaultTitleTemplate", channel=channel))
-            (html, is_redirect, real_domain) = self.get_source_by_url(url)
+            log.debug("SpiffyTitles: calling default handler for %s" % (link))
+            source = self.get_source_by_url(link)
+
+            return self.get_default_title(source, channel)
+        else:
+            log.debug("SpiffyTitles: default handler fired but doing nothing because disabled")
 
-            if html is not None and html:
-                title = self.get_title_from_html(html)
+    async def handler_default_async(self, link, channel):
+        """
+        Event loop version of handler_default
+        """
+        default_handler_enabled = self.registryValue("defaultHandlerEnabled", channel=channel)
 
-                if title is not None:
-                    title_template = default_template.render(title=title, redirect=is_redirect, real_domain=real_domain)
+        if default_handler_enabled:
+            log.debug("SpiffyTitles: calling default handler for %s" % (link))
+            source = await self.get_source_by_url_async(link)
 
-                    return title_template
+            # Ambiguous markup falls back to a full HTML parser
+            return await concurrency.run_in_thread(self.get_default_title, source, channel)
         else:
             log.debug("SpiffyTitles: default handler fired but doing nothing because disabled")
 
-    def handler_imdb(self, url, info, channel):
+    def get_default_title(self, source, channel):
         """
-        Handles imdb.com links, querying IMDb suggestions for additional info
-
-        Typical IMDB URL: http://www.imdb.com/title/tt2467372/
+        Renders defaultTitleTemplate from the (html, is_redirect, real_domain)
+        returned by get_source_by_url
         """
-        headers = self.get_headers()
-        result = None
+        (html, is_redirect, real_domain) = source
 
-        if not self.registryValue("imdbHandlerEnabled", channel=channel):
-            log.debug("SpiffyTitles: IMDB handler disabled. Falling back to default handler.")
+        if html is not None and html:
+            title = self.get_title_from_html(html)
 
-            return self.handler_default(url, channel)
+            if title is not None:
+                return self.render_lookup_template("defaultTitleTemplate", {
+                    "title": title,
+                    "redirect": is_redirect,
+                    "real_domain": real_domain
+                }, channel)
+            else:
+                self.set_lookup_failure("no title")
 
-        # Don't care about query strings
-        if "?" in url:
-            url = url.split("?")[0]
+    def handler_shortener(self, link, channel):
+        """
+        Handles link shortener domains. The short link's redirects are followed
+        without downloading the destination, which is then handed to the
+        handler for its domain. Destinations without a handler of their own
+        get the default handler, called on the short link so the title still
+        shows where it redirected to.
+        """
+        target = self.resolve_short_link(link)
 
-        # We can only accommodate a specific format of URL here
-        if "/title/" in url:
-            imdb_id = url.split("/title/")[1].rstrip("/")
-            result = self.get_imdb_title(imdb_id, headers)
+        if target is not None:
+            handler, is_default_handler = self.get_handler_for_url(target)
 
-        if result is not None:
-            return result
-        else:
-            log.debug("SpiffyTitles: IMDB handler failed. calling default handler")
+            if (handler is not None and not is_default_handler and
+                    handler != self.handler_shortener and
+                    self.is_handler_allowed(handler, channel)):
+                log.debug("SpiffyTitles: %s leads to %s" % (link, target))
 
-            return self.handler_default(url, channel)
+                return handler(target, channel)
 
-    def get_imdb_title(self, imdb_id, headers):
-        suggestion_url = "https://v3.sg.media-imdb.com/suggestion/t/%s.json" % (imdb_id)
+        return self.handler_default(link, channel)
 
-        try:
-            request = requests.get(suggestion_url, timeout=10, headers=headers)
+    def resolve_short_link(self, link):
+        """
+        Returns a Link for where a short link leads, or None if it doesn't
+        redirect anywhere. Destinations are cached for
+        shortenerCacheLifetimeInSeconds.
+        """
+        target = self.redirects.get(link.key)
 
-            if request.status_code == requests.codes.ok:
-                response = json.loads(request.text)
-                items = response.get("d", [])
-                match = None
+        if target is None:
+            target = self.get_redirect_target(link)
+            lifetime = self.registryValue("shortenerCacheLifetimeInSeconds")
 
-                for item in items:
-                    if item.get("id") == imdb_id:
-                        match = item
-                        break
+            if target is not None and lifetime > 0:
+                self.redirects.put(link.key, target, lifetime)
 
-                if match:
-                    imdb_template = Template(self.registryValue("imdbTemplate"))
-                    return imdb_template.render({
-                        "Title": match.get("l", ""),
-                        "Year": match.get("y", ""),
+        if target is None or target == link.url:
+            return None
+
+        return links.Link(target)
+
+    def get_redirect_target(self, link):
+        """
+        Follows the redirects of a link with HEAD requests and returns the
+        final URL, or None if that failed
+        """
+        if self.is_deadline_passed(link):
+            return None
+
+        headers = ["%s: %s" % item for item in self.get_headers().items()]
+
+        with self.curl_pool.handle() as curl:
+            curl.setopt(pycurl.URL, link.url)
+            curl.setopt(pycurl.HTTPHEADER, headers)
+            curl.setopt(pycurl.NOBODY, True)
+            curl.setopt(pycurl.FOLLOWLOCATION, True)
+            curl.setopt(pycurl.MAXREDIRS, self.max_shortener_redirects)
+            curl.setopt(pycurl.TIMEOUT_MS, self.get_transfer_timeout_ms())
+            curl.setopt(pycurl.NOSIGNAL, 1)
+
+            try:
+                curl.perform()
+            except pycurl.error as e:
+                log.debug("SpiffyTitles: could not resolve %s: %s" % (link, e))
+
+                return None
+
+            return curl.getinfo(pycurl.EFFECTIVE_URL)
+
+    def handler_imdb(self, link, channel):
+        """
+        Handles imdb.com links, querying IMDb suggestions for additional info
+
+        Typical IMDB URL: http://www.imdb.com/title/tt2467372/
+        """
+        headers = self.get_headers()
+        result = None
+
+        if not self.registryValue("imdbHandlerEnabled", channel=channel):
+            log.debug("SpiffyTitles: IMDB handler disabled. Falling back to default handler.")
+
+            return self.handler_default(link, channel)
+
+        # We can only accommodate a specific format of URL here
+        if "/title/" in link.path:
+            imdb_id = link.path.split("/title/")[1].rstrip("/")
+            result = self.get_imdb_title(imdb_id, headers, channel)
+
+        if result is not None:
+            return result
+        else:
+            log.debug("SpiffyTitles: IMDB handler failed. calling default handler")
+
+            return self.handler_default(link, channel)
+
+    def get_imdb_title(self, imdb_id, headers, channel=None):
+        suggestion_url = "https://v3.sg.media-imdb.com/suggestion/t/%s.json" % (imdb_id)
+
+        try:
+            request = self.api_get("imdb", suggestion_url, headers=headers)
+
+            if request.status_code == requests.codes.ok:
+                response = json.loads(request.text)
+                items = response.get("d", [])
+                match = None
+
+                for item in items:
+                    if item.get("id") == imdb_id:
+                        match = item
+                        break
+
+                if match:
+                    return self.render_lookup_template("imdbTemplate", {
+                        "Title": match.get("l", ""),
+                        "Year": match.get("y", ""),
                         "Type": match.get("q", ""),
                         "Cast": match.get("s", ""),
                         "imdbID": match.get("id", imdb_id)
-                    })
+                    }, channel)
                 else:
                     log.debug("SpiffyTitles: IMDb suggestion returned no match for %s" %
                               (imdb_id))
@@ -1149,221 +1722,445 @@ class SpiffyTitles(callbacks.Plugin):
         except requests.exceptions.HTTPError as e:
             log.error("SpiffyTitles imdb suggestion HTTPError: %s" % (str(e)))
 
-    def handler_wikipedia(self, url, domain, channel):
+    def handler_wikipedia(self, link, channel):
         """
         Queries wikipedia API for article extracts.
         """
         wikipedia_handler_enabled = self.registryValue("wikipedia.enabled", channel=channel)
 
         if not wikipedia_handler_enabled:
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
 
-        self.log.debug("SpiffyTitles: calling Wikipedia handler for %s" % (url))
+        self.log.debug("SpiffyTitles: calling Wikipedia handler for %s" % (link))
 
         pattern = r"/(?:w(?:iki))/(?P<page>[^/]+)$"
-        info = urlparse(url)
-        match = re.search(pattern, info.path)
+        match = re.search(pattern, link.path)
 
         if not match:
             self.log.debug("SpiffyTitles: no title found.")
-            return self.handler_default(url, channel)
-        elif info.fragment and self.registryValue("wikipedia.ignoreSectionLinks", channel=channel):
+            return self.handler_default(link, channel)
+        elif link.fragment and self.registryValue("wikipedia.ignoreSectionLinks", channel=channel):
             self.log.debug("SpiffyTitles: ignoring section link.")
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
         else:
-            page_title = match.groupdict()['page']
-
-        default_api_params = {
-            "format": "json",
-            "action": "query",
-            "prop": "extracts",
-            "exsentences": "2",
-            "exlimit": "1",
-            "exintro": "",
-            "explaintext": ""
-        }
-
-        wiki_api_params = self.registryValue("wikipedia.apiParams", channel=channel)
-        extra_params = dict(parse_qsl('&'.join(wiki_api_params)))
-        title_param = {
-            self.registryValue("wikipedia.titleParam", channel=channel): page_title
-        }
+            page_title = links.wikipedia_title(match.group("page"))
 
-        # merge dicts
-        api_params = default_api_params.copy()
-        api_params.update(extra_params)
-        api_params.update(title_param)
-        param_string = "&".join("%s=%s" % (key, val) for (key, val) in api_params.items())
-        api_url = "https://%s/w/api.php?%s" % (info.netloc, param_string)
+        host = links.wikipedia_host(link.host)
 
-        agent = self.get_user_agent()
-        headers = {
-            "User-Agent": agent
-        }
-        extract = ""
+        if self.registryValue("wikipedia.backend", channel=channel) == "rest":
+            api_params = None
+            settings = ("rest",)
+        else:
+            api_params = {
+                "format": "json",
+                "action": "query",
+                "prop": "extracts",
+                "exsentences": "2",
+                "exlimit": "1",
+                "exintro": "",
+                "explaintext": "",
+                "redirects": "1"
+            }
+            wiki_api_params = self.registryValue("wikipedia.apiParams", channel=channel)
+            api_params.update(parse_qsl('&'.join(wiki_api_params)))
+            title_param = self.registryValue("wikipedia.titleParam", channel=channel)
+            settings = (title_param,) + tuple(sorted(api_params.items()))
+
+        # Redirects and their targets share an extract once the redirect is known
+        page_title = self.wikipedia_titles.get((host, page_title)) or page_title
+        extract = self.wikipedia_extracts.get((host, page_title, settings))
+
+        if extract is None:
+            if api_params is None:
+                extract, resolved_title = self.get_wikipedia_summary(host, page_title)
+            else:
+                extract, resolved_title = self.get_wikipedia_extract(host, page_title, api_params,
+                                                                     title_param)
 
-        self.log.debug("SpiffyTitles: requesting %s" % (api_url))
+            if extract:
+                lifetime = self.registryValue("linkCacheLifetimeInSeconds")
+                resolved_title = links.wikipedia_title(resolved_title or page_title)
 
-        request = requests.get(api_url, headers=headers)
-        ok = request.status_code == requests.codes.ok
+                if resolved_title != page_title:
+                    self.wikipedia_titles.put((host, page_title), resolved_title, lifetime)
 
-        if ok:
-            response = json.loads(request.text)
+                self.wikipedia_extracts.put((host, resolved_title, settings), extract, lifetime)
 
-            if response:
-                try:
-                    extract = list(response['query']['pages'].values())[0]['extract']
-                except KeyError as e:
-                    self.log.error("SpiffyTitles: KeyError parsing Wikipedia API JSON response: \
-                                    %s" % (str(e)))
-            else:
-                self.log.error("SpiffyTitles: Error parsing Wikipedia API JSON response")
+        if extract:
+            return self.render_lookup_payload("wikipedia", {"extract": extract}, channel)
         else:
+            self.log.debug("SpiffyTitles: falling back to default handler")
+
+            return self.handler_default(link, channel)
+
+    def get_wikipedia_extract(self, host, page_title, api_params, title_param):
+        """
+        Queries api.php for the extract of a page, returning it with the
+        title the page resolved to
+        """
+        api_params = dict(api_params)
+        api_params[title_param] = page_title
+        api_url = "https://%s/w/api.php?%s" % (host, urlencode(api_params))
+
+        self.log.debug("SpiffyTitles: requesting %s" % (api_url))
+
+        request = self.api_get("wikipedia", api_url)
+
+        if request.status_code != requests.codes.ok:
             self.log.error("SpiffyTitles: Wikipedia API HTTP %s: %s" %
                            (request.status_code, request.text))
+            return "", None
 
-        if extract:
-            if (self.registryValue("wikipedia.removeParentheses")):
-                extract = re.sub(r' ?\([^)]*\)', '', extract)
-            max_chars = self.registryValue("wikipedia.maxChars", channel=channel)
-            if len(extract) > max_chars:
-                extract = extract[:max_chars - 3].rsplit(' ', 1)[0].rstrip(',.') + '...'
-            extract_template = self.registryValue("wikipedia.extractTemplate", channel=channel)
-            wikipedia_template = Template(extract_template)
-            return wikipedia_template.render({"extract": extract})
-        else:
-            self.log.debug("SpiffyTitles: falling back to default handler")
+        try:
+            page = list(json.loads(request.text)['query']['pages'].values())[0]
+
+            return page['extract'], page.get('title')
+        except (ValueError, KeyError, IndexError) as e:
+            self.log.error("SpiffyTitles: Error parsing Wikipedia API JSON response: %s" %
+                           (str(e)))
 
-            return self.handler_default(url, channel)
+        return "", None
 
-    def handler_reddit(self, url, domain, channel):
+    def get_wikipedia_summary(self, host, page_title):
         """
-        Queries wikipedia API for article extracts.
+        Reads the extract of a page from the REST page summary, returning it
+        with the title the page resolved to
+        """
+        api_url = "https://%s/api/rest_v1/page/summary/%s" % (
+            host, quote(page_title.replace(" ", "_"), safe=""))
+
+        self.log.debug("SpiffyTitles: requesting %s" % (api_url))
+
+        request = self.api_get("wikipedia", api_url)
+
+        if request.status_code != requests.codes.ok:
+            self.log.error("SpiffyTitles: Wikipedia REST API HTTP %s: %s" %
+                           (request.status_code, request.text))
+            return "", None
+
+        try:
+            summary = json.loads(request.text)
+        except ValueError:
+            self.log.error("SpiffyTitles: Error parsing Wikipedia REST API JSON response")
+            return "", None
+
+        resolved_title = summary.get("titles", {}).get("normalized") or summary.get("title")
+
+        return summary.get("extract", ""), resolved_title
+
+    def render_wikipedia_payload(self, data, channel):
+        """
+        Shortens a Wikipedia extract and renders wikipedia.extractTemplate
+        """
+        extract = data["extract"]
+        if (self.registryValue("wikipedia.removeParentheses")):
+            extract = re.sub(r' ?\([^)]*\)', '', extract)
+        max_chars = self.registryValue("wikipedia.maxChars", channel=channel)
+        if len(extract) > max_chars:
+            extract = extract[:max_chars - 3].rsplit(' ', 1)[0].rstrip(',.') + '...'
+        extract_template = self.registryValue("wikipedia.extractTemplate", channel=channel)
+        wikipedia_template = templates.get_template(extract_template)
+        return wikipedia_template.render({"extract": extract})
+
+    def handler_reddit(self, link, channel):
+        """
+        Queries the reddit API for threads, comments and users. Threads and
+        comments are read from api/info, batched with the other posts linked
+        in the same message.
         """
         reddit_handler_enabled = self.registryValue("reddit.enabled", channel=channel)
         if not reddit_handler_enabled:
-            return self.handler_default(url, channel)
-
-        self.log.debug("SpiffyTitles: calling reddit handler for %s" % (url))
-
-        patterns = {
-            "thread": {
-                "pattern": r"^/r/(?P<subreddit>[^/]+)/comments/(?P<thread>[^/]+)(?:/[^/]+/?)?$",
-                "url": "https://www.reddit.com/r/{subreddit}/comments/{thread}.json"
-            },
-            "comment": {
-                "pattern":
-                    r"^/r/(?P<subreddit>[^/]+)/comments/(?P<thread>[^/]+)/[^/]+/(?P<comment>\w+)$",
-                "url": "https://www.reddit.com/r/{subreddit}/comments/{thread}/x/{comment}.json"
-            },
-            "user": {
-                "pattern": r"^/u(?:ser)?/(?P<user>[^/]+)/?$",
-                "url": "https://www.reddit.com/user/{user}/about.json"
-            }
-        }
+            return self.handler_default(link, channel)
 
-        info = urlparse(url)
-        for name in patterns:
-            match = re.search(patterns[name]['pattern'], info.path)
-            if match:
-                link_type = name
-                link_info = match.groupdict()
-                data_url = patterns[name]['url'].format(**link_info)
-                break
+        self.log.debug("SpiffyTitles: calling reddit handler for %s" % (link))
 
-        if not match:
+        link_type, link_info = self.get_reddit_link_info(link)
+
+        if link_type is None:
             self.log.debug("SpiffyTitles: no title found.")
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
 
-        agent = self.get_user_agent()
-        headers = {
-            "User-Agent": agent
-        }
+        # Only checked against the message deadline here, as links batched
+        # into one request must not each count against the rate limit
+        if self.is_reddit_rate_limited():
+            log.debug("SpiffyTitles: reddit rate limit resets after the deadline for %s" %
+                      (link))
+            self.set_lookup_failure("rate limit")
 
-        self.log.debug("SpiffyTitles: requesting %s" % (data_url))
+            return None
 
-        request = requests.get(data_url, headers=headers)
-        ok = request.status_code == requests.codes.ok
-        data = {}
-        extract = ''
+        if link_type == "user":
+            data = self.get_reddit_user(link_info["user"])
+        else:
+            fullnames = self.get_reddit_fullnames(link_type, link_info)
 
-        if ok:
-            response = json.loads(request.text)
+            try:
+                futures = self.reddit_batcher.submit(fullnames)
+                things = [futures[fullname].result(self.get_remaining_time())
+                          for fullname in fullnames]
+            except FutureTimeoutError:
+                log.debug("SpiffyTitles: deadline passed waiting for reddit %s" %
+                          (",".join(fullnames)))
+                self.set_lookup_failure("deadline")
 
-            if response:
-                try:
-                    if link_type == "thread":
-                        data = response[0]['data']['children'][0]['data']
-
-                    if link_type == "comment":
-                        data = response[1]['data']['children'][0]['data']
-                        data['title'] = response[0]['data']['children'][0]['data']['title']
-
-                    if link_type == "user":
-                        data = response['data']
-                except KeyError as e:
-                    self.log.error("SpiffyTitles: KeyError parsing Reddit JSON response: %s" %
-                                   (str(e)))
-            else:
-                self.log.error("SpiffyTitles: Error parsing Reddit JSON response")
-        else:
-            self.log.error("SpiffyTitles: Reddit HTTP %s: %s" % (request.status_code, request.text))
+                return None
+
+            data = things[-1]
+
+            # A comment is shown with the title of its thread
+            if data and link_type == "comment":
+                data = dict(data, title=(things[0] or {}).get("title", ""))
 
         if data:
-            today = datetime.datetime.now(pytz.UTC).date()
-            created = datetime.datetime.fromtimestamp(data['created_utc'], pytz.UTC).date()
-            age_days = (today - created).days
-            if age_days == 0:
-                age = "today"
-            elif age_days == 1:
-                age = "yesterday"
-            else:
-                age = '{}d'.format(age_days % 365)
-                if age_days > 365:
-                    age = '{}y, '.format(age_days / 365) + age
-                age = age + " ago"
-            if link_type == "thread":
-                link_type = "linkThread"
-                if data['is_self']:
-                    link_type = "textThread"
-                    data['url'] = ""
-                    extract = data.get('selftext', '')
-            if link_type == "comment":
-                extract = data.get('body', '')
-            link_type_template = self.registryValue("reddit." + link_type + "Template",
-                                                    channel=channel)
-            reddit_template = Template(link_type_template)
-            template_vars = {
-                "id": data.get('id', ''),
-                "user": data.get('name', ''),
-                "gold": (data.get('is_gold', False) is True),
-                "mod": (data.get('is_mod', False) is True),
-                "author": data.get('author', ''),
-                "subreddit": data.get('subreddit', ''),
-                "url": data.get('url', ''),
-                "title": data.get('title', ''),
-                "domain": data.get('domain', ''),
-                "score": data.get('score', 0),
-                "percent": '{}%'.format(int(data.get('upvote_ratio', 0) * 100)),
-                "comments": '{:,}'.format(data.get('num_comments', 0)),
-                "created": created.strftime('%Y-%m-%d'),
-                "age": age,
-                "link_karma": '{:,}'.format(data.get('link_karma', 0)),
-                "comment_karma": '{:,}'.format(data.get('comment_karma', 0)),
-                "extract": "%%extract%%"
-            }
-            reply = reddit_template.render(template_vars)
-            if extract:
-                max_chars = self.registryValue("reddit.maxChars", channel=channel)
-                max_extract_chars = max_chars + len('%%extract%%') - len(reply)
-                if len(extract) > max_extract_chars:
-                    extract = extract[:max_extract_chars - 3].rsplit(' ', 1)[0].rstrip(',.') + '...'
-            template_vars['extract'] = extract
-            reply = reddit_template.render(template_vars)
-            return reply
+            return self.render_lookup_payload("reddit", {"link_type": link_type, "data": data},
+                                              channel)
         else:
             self.log.debug("SpiffyTitles: falling back to default handler")
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
+
+    def get_reddit_link_info(self, link):
+        """
+        Returns the type of a reddit link and the parts matched from its
+        path, or (None, None) for links the handler can't read
+        """
+        for link_type, pattern in self.reddit_patterns:
+            match = pattern.search(link.path)
+
+            if match:
+                return link_type, match.groupdict()
+
+        return None, None
+
+    def get_reddit_fullnames(self, link_type, link_info):
+        """
+        Returns the fullnames to look up for a thread or comment link, the
+        thread always coming first
+        """
+        fullnames = ["t3_%s" % (link_info["thread"])]
+
+        if link_type == "comment":
+            fullnames.append("t1_%s" % (link_info["comment"]))
+
+        return fullnames
+
+    def prefetch_reddit_things(self, message_links, channel):
+        """
+        Queues every uncached reddit thread and comment in a message for a
+        single api/info request, before the handlers ask for them one by one
+        """
+        if not self.registryValue("reddit.enabled", channel=channel):
+            return
+
+        fullnames = []
+
+        for link in message_links:
+            handler, is_default_handler = self.get_handler_for_url(link)
+
+            if handler != self.handler_reddit or self.get_link_from_cache(link) is not None:
+                continue
+
+            link_type, link_info = self.get_reddit_link_info(link)
+
+            if link_type in ("thread", "comment"):
+                fullnames.extend(self.get_reddit_fullnames(link_type, link_info))
+
+        if len(fullnames) > 1:
+            self.reddit_batcher.submit(fullnames)
+
+    def fetch_reddit_things(self, fullnames):
+        """
+        Looks up to 100 threads and comments with one api/info request,
+        returning the fields the templates read, by fullname
+        """
+        options = {
+            "id": ",".join(fullnames),
+            "raw_json": 1
+        }
+        request = self.reddit_get("/api/info.json?%s" % (urlencode(options)))
+
+        if request.status_code != requests.codes.ok:
+            self.log.error("SpiffyTitles: Reddit HTTP %s: %s" %
+                           (request.status_code, request.text))
+            return {}
+
+        try:
+            children = json.loads(request.text)["data"]["children"]
+        except (ValueError, KeyError, TypeError):
+            self.log.error("SpiffyTitles: Error parsing Reddit JSON response")
+            return {}
+
+        things = {}
+
+        for child in children:
+            data = child.get("data", {})
+
+            if data.get("name") in fullnames:
+                things[data["name"]] = dict((key, data[key]) for key in self.reddit_fields
+                                            if key in data)
+
+        return things
+
+    def get_reddit_user(self, user):
+        """
+        Returns the fields the templates read from a user's about.json
+        """
+        request = self.reddit_get("/user/%s/about.json" % (user))
+
+        if request.status_code != requests.codes.ok:
+            self.log.error("SpiffyTitles: Reddit HTTP %s: %s" %
+                           (request.status_code, request.text))
+            return {}
+
+        try:
+            data = json.loads(request.text)["data"]
+        except (ValueError, KeyError, TypeError):
+            self.log.error("SpiffyTitles: Error parsing Reddit JSON response")
+            return {}
+
+        return dict((key, data[key]) for key in self.reddit_fields if key in data)
+
+    def reddit_get(self, path):
+        """
+        Requests a reddit API path, through oauth.reddit.com when an app is
+        configured. Every attempt waits for the rate limit, whose headers are
+        recorded from the response. A rejected token is retried once, and so
+        is a 429 when the rate limit resets within reddit_max_retry_wait.
+        """
+        for attempt in range(2):
+            self.wait_for_reddit_rate_limit()
+            headers = {
+                "User-Agent": self.get_user_agent()
+            }
+            token = self.get_reddit_token()
+
+            if token:
+                data_url = self.reddit_oauth_url + path
+                headers["Authorization"] = "bearer %s" % (token)
+            else:
+                data_url = self.reddit_public_url + path
+
+            self.log.debug("SpiffyTitles: requesting %s" % (data_url))
+
+            request = self.api_get("reddit", data_url, headers=headers)
+            self.reddit_rate_limit.update(request.headers)
+
+            if request.status_code == 401 and token:
+                self.reddit_token.invalidate()
+            elif request.status_code != 429:
+                break
+            elif self.reddit_rate_limit.delay() > self.reddit_max_retry_wait:
+                break
+
+        return request
+
+    def get_reddit_token(self):
+        """
+        Returns an app-only access token when reddit.clientID and
+        reddit.clientSecret are set, or None to use the public API
+        """
+        credentials = (self.registryValue("reddit.clientID"),
+                       self.registryValue("reddit.clientSecret"))
+
+        if not all(credentials):
+            return None
+
+        if self.reddit_token is None or self.reddit_token.credentials != credentials:
+            self.reddit_token = transport.ClientCredentialsToken(self.api_session,
+                                                                 self.reddit_token_url,
+                                                                 *credentials)
+
+        timeout = self.get_api_timeout("reddit")
+        remaining = self.get_remaining_time()
+
+        if remaining is not None:
+            timeout = min(timeout, max(remaining, 0.001))
+
+        try:
+            return self.reddit_token.get(timeout, headers={"User-Agent": self.get_user_agent()})
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            self.log.error("SpiffyTitles: couldn't get a reddit access token: %s" % (e))
+
+            return None
+
+    def is_reddit_rate_limited(self):
+        """
+        Returns True when the rate limit only allows another reddit request
+        after the message deadline
+        """
+        delay = self.reddit_rate_limit.delay()
+        remaining = self.get_remaining_time()
+
+        return delay > 0 and remaining is not None and delay >= remaining
+
+    def wait_for_reddit_rate_limit(self):
+        """
+        Counts a reddit request against the rate limit, sleeping until it
+        allows one
+        """
+        delay = self.reddit_rate_limit.reserve()
+
+        if delay > 0:
+            self.log.debug("SpiffyTitles: waiting %.2fs for the reddit rate limit" % (delay))
+            time.sleep(delay)
+
+    def render_reddit_payload(self, payload, channel):
+        """
+        Renders the reddit template for a thread, comment or user
+        """
+        link_type = payload["link_type"]
+        data = dict(payload["data"])
+        extract = ''
+        today = datetime.datetime.now(pytz.UTC).date()
+        created = datetime.datetime.fromtimestamp(data['created_utc'], pytz.UTC).date()
+        age_days = (today - created).days
+        if age_days == 0:
+            age = "today"
+        elif age_days == 1:
+            age = "yesterday"
+        else:
+            age = '{}d'.format(age_days % 365)
+            if age_days > 365:
+                age = '{}y, '.format(age_days / 365) + age
+            age = age + " ago"
+        if link_type == "thread":
+            link_type = "linkThread"
+            if data['is_self']:
+                link_type = "textThread"
+                data['url'] = ""
+                extract = data.get('selftext', '')
+        if link_type == "comment":
+            extract = data.get('body', '')
+        link_type_template = self.registryValue("reddit." + link_type + "Template",
+                                                channel=channel)
+        reddit_template = templates.get_template(link_type_template)
+        template_vars = {
+            "id": data.get('id', ''),
+            "user": data.get('name', ''),
+            "gold": (data.get('is_gold', False) is True),
+            "mod": (data.get('is_mod', False) is True),
+            "author": data.get('author', ''),
+            "subreddit": data.get('subreddit', ''),
+            "url": data.get('url', ''),
+            "title": data.get('title', ''),
+            "domain": data.get('domain', ''),
+            "score": data.get('score', 0),
+            "percent": '{}%'.format(int(data.get('upvote_ratio', 0) * 100)),
+            "comments": '{:,}'.format(data.get('num_comments', 0)),
+            "created": created.strftime('%Y-%m-%d'),
+            "age": age,
+            "link_karma": '{:,}'.format(data.get('link_karma', 0)),
+            "comment_karma": '{:,}'.format(data.get('comment_karma', 0)),
+            "extract": "%%extract%%"
+        }
+        reply = reddit_template.render(template_vars)
+        if extract:
+            max_chars = self.registryValue("reddit.maxChars", channel=channel)
+            max_extract_chars = max_chars + len('%%extract%%') - len(reply)
+            if len(extract) > max_extract_chars:
+                extract = extract[:max_extract_chars - 3].rsplit(' ', 1)[0].rstrip(',.') + '...'
+        template_vars['extract'] = extract
+        reply = reddit_template.render(template_vars)
+        return reply
 
     def is_valid_imgur_id(self, input):
         """
@@ -1374,7 +2171,7 @@ class SpiffyTitles(callbacks.Plugin):
 
         return match is not None
 
-    def handler_imgur(self, url, info, channel):
+    def handler_imgur(self, link, channel):
         """
         Queries imgur API for additional information about imgur links.
 
@@ -1382,17 +2179,17 @@ class SpiffyTitles(callbacks.Plugin):
         """
         self.initialize_imgur_client(channel)
 
-        is_album = info.path.startswith("/a/")
+        is_album = link.path.startswith("/a/")
         result = None
 
         if is_album:
-            result = self.handler_imgur_album(url, info, channel)
+            result = self.handler_imgur_album(link, channel)
         else:
-            result = self.handler_default(url, channel)
+            result = self.handler_default(link, channel)
 
         return result
 
-    def handler_imgur_album(self, url, info, channel):
+    def handler_imgur_album(self, link, channel):
         """
         Handles retrieving information about albums from the imgur API.
 
@@ -1403,11 +2200,7 @@ class SpiffyTitles(callbacks.Plugin):
         self.initialize_imgur_client(channel)
 
         if self.imgur_client:
-            album_id = info.path.split("/a/")[1]
-
-            """ If there is a query string appended, remove it """
-            if "?" in album_id:
-                album_id = album_id.split("?")[0]
+            album_id = link.path.split("/a/")[1]
 
             if self.is_valid_imgur_id(album_id):
                 log.debug("SpiffyTitles: found imgur album id %s" % (album_id))
@@ -1416,17 +2209,13 @@ class SpiffyTitles(callbacks.Plugin):
                     album = self.imgur_client.get_album(album_id)
 
                     if album:
-                        album_template = self.registryValue("imgurAlbumTemplate", channel=channel)
-                        imgur_album_template = Template(album_template)
-                        compiled_template = imgur_album_template.render({
+                        return self.render_lookup_template("imgurAlbumTemplate", {
                             "title": album.title,
                             "section": album.section,
                             "view_count": "{:,}".format(album.views),
                             "image_count": "{:,}".format(album.images_count),
                             "nsfw": album.nsfw
-                        })
-
-                        return compiled_template
+                        }, channel)
                     else:
                         log.error("SpiffyTitles: imgur album API returned unexpected results!")
 
@@ -1435,11 +2224,11 @@ class SpiffyTitles(callbacks.Plugin):
                 except ImgurClientError as e:
                     log.error("SpiffyTitles: imgur client error: %s" % (e.error_message))
             else:
-                log.debug("SpiffyTitles: unable to determine album id for %s" % (url))
+                log.debug("SpiffyTitles: unable to determine album id for %s" % (link))
         else:
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
 
-    def handler_imgur_image(self, url, info, channel):
+    def handler_imgur_image(self, link, channel):
         """
         Handles retrieving information about images from the imgur API.
 
@@ -1457,11 +2246,11 @@ class SpiffyTitles(callbacks.Plugin):
             If there is a period in the path, it's a direct link to an image. If not, then
             it's a imgur.com/some_image_id_here type link
             """
-            if "." in info.path:
-                path = info.path.lstrip("/")
+            if "." in link.path:
+                path = link.path.lstrip("/")
                 image_id = path.split(".")[0]
             else:
-                image_id = info.path.lstrip("/")
+                image_id = link.path.lstrip("/")
 
             if self.is_valid_imgur_id(image_id):
                 log.debug("SpiffyTitles: found image id %s" % (image_id))
@@ -1470,10 +2259,8 @@ class SpiffyTitles(callbacks.Plugin):
                     image = self.imgur_client.get_image(image_id)
 
                     if image:
-                        channel_template = self.registryValue("imgurTemplate", channel=channel)
-                        imgur_template = Template(channel_template)
                         readable_file_size = self.get_readable_file_size(image.size)
-                        compiled_template = imgur_template.render({
+                        title = self.render_lookup_template("imgurTemplate", {
                             "title": image.title,
                             "type": image.type,
                             "nsfw": image.nsfw,
@@ -1482,9 +2269,7 @@ class SpiffyTitles(callbacks.Plugin):
                             "view_count": "{:,}".format(image.views),
                             "file_size": readable_file_size,
                             "section": image.section
-                        })
-
-                        title = compiled_template
+                        }, channel)
                     else:
                         log.error("SpiffyTitles: imgur API returned unexpected results!")
                 except ImgurClientRateLimitError as e:
@@ -1492,12 +2277,12 @@ class SpiffyTitles(callbacks.Plugin):
                 except ImgurClientError as e:
                     log.error("SpiffyTitles: imgur client error: %s" % (e.error_message))
             else:
-                log.error("SpiffyTitles: error retrieving image id for %s" % (url))
+                log.error("SpiffyTitles: error retrieving image id for %s" % (link))
 
         if title is not None:
             return title
         else:
-            return self.handler_default(url, channel)
+            return self.handler_default(link, channel)
 
     def get_readable_file_size(self, num, suffix="B"):
         """
@@ -1518,7 +2303,7 @@ class SpiffyTitles(callbacks.Plugin):
         # Replace anywhere in string
         title = title.replace("\n", " ")
         title = title.replace("\t", " ")
-        title = re.sub(" +", " ", title)
+        title = spaces_pattern.sub(" ", title)
 
         if use_bold:
             title = ircutils.bold(title)
@@ -1529,7 +2314,19 @@ class SpiffyTitles(callbacks.Plugin):
 
     def get_title_from_html(self, html):
         """
-        Retrieves value of <title> tag from HTML
+        Retrieves value of <title> tag from HTML, without building a DOM
+        unless the markup is ambiguous
+        """
+        try:
+            return htmltitle.get_title(html)
+        except htmltitle.AmbiguousMarkup as e:
+            log.debug("SpiffyTitles: using full HTML parser: %s" % (e))
+
+        return self.get_title_from_parsed_html(html)
+
+    def get_title_from_parsed_html(self, html):
+        """
+        Retrieves value of <title> tag from HTML using a full parser
         """
         soup = BeautifulSoup(html, "lxml")
 
@@ -1538,7 +2335,7 @@ class SpiffyTitles(callbacks.Plugin):
             Some websites have more than one title tag, so get all of them
             and take the last value.
             """
-            head = soup.find("head")
+            head = soup.find("head") or soup
             titles = head.find_all("title")
 
             if titles is not None and len(titles):
@@ -1549,93 +2346,212 @@ class SpiffyTitles(callbacks.Plugin):
 
     def get_source_by_url(self, url, retries=1):
         """
-        Get the HTML of a website based on a URL.
+        Get the HTML of a website based on a URL or Link.
         """
         max_retries = self.registryValue("maxRetries")
+        link = links.Link.of(url)
 
         if retries is None:
             retries = 1
 
+        if self.is_deadline_passed(link):
+            self.set_lookup_failure("deadline")
+
+            return (None, False, None)
+
         if retries >= max_retries:
-            log.debug("SpiffyTitles: hit maximum retries for %s" % url)
+            log.debug("SpiffyTitles: hit maximum retries for %s" % link)
+            self.set_lookup_failure("timeout")
 
             return (None, False, None)
 
-        if not urlparse(url).scheme:
-            return self.get_source_by_url("http://%s" % url)
+        if not link.scheme:
+            return self.get_source_by_url("http://%s" % link)
 
-        log.debug("SpiffyTitles: pycurl attempt #%s for %s" % (retries, url))
+        log.debug("SpiffyTitles: pycurl attempt #%s for %s" % (retries, link))
 
-        curl = pycurl.Curl()
-        body = io.BytesIO()
+        curl = self.curl_pool.acquire()
 
         try:
-            headers = ["%s: %s" % item for item in self.get_headers().items()]
-            curl.setopt(pycurl.URL, url)
-            curl.setopt(pycurl.HTTPHEADER, headers)
-            curl.setopt(pycurl.WRITEDATA, body)
-            curl.setopt(pycurl.FOLLOWLOCATION, True)
-            curl.setopt(pycurl.TIMEOUT, self.wall_clock_timeout)
-            curl.setopt(pycurl.NOSIGNAL, 1)
-            curl.perform()
+            body = self.prepare_source_request(curl, link)
 
-            final_url = curl.getinfo(pycurl.EFFECTIVE_URL)
-            status_code = curl.getinfo(pycurl.RESPONSE_CODE)
-            is_redirect = False
-            real_domain = None
+            try:
+                curl.perform()
+            except pycurl.error as e:
+                self.check_stopped_download(link, body, e)
 
-            link_domain = self.get_base_domain(url)
-            final_domain = self.get_base_domain(final_url)
-            if link_domain != final_domain:
-                is_redirect = True
-                real_domain = final_domain
+            return self.read_source_response(curl, link, body)
+        except TimeoutError as e:
+            log.debug("SpiffyTitles Timeout: %s" % (str(e)))
 
-            if status_code == requests.codes.ok:
-                content_type = (curl.getinfo(pycurl.CONTENT_TYPE) or "").split(";")[0].strip()
-                acceptable_types = self.registryValue("mimeTypes")
+            return self.get_source_by_url(link, retries + 1)
+        except pycurl.error as e:
+            if self.is_curl_timeout(e):
+                return self.get_source_by_url(link, retries + 1)
+        except ValueError as e:
+            log.error("SpiffyTitles InvalidURL: %s" % (str(e)))
+        finally:
+            self.curl_pool.release(curl)
 
-                log.debug("SpiffyTitles: content type %s" % (content_type))
+        return (None, False, None)
 
-                if content_type in acceptable_types:
-                    text = body.getvalue()
+    async def get_source_by_url_async(self, url, retries=1):
+        """
+        Event loop version of get_source_by_url, running the transfer on the
+        loop's CurlMulti
+        """
+        max_retries = self.registryValue("maxRetries")
+        link = links.Link.of(url)
 
-                    if text:
-                        return (text, is_redirect, real_domain)
-                    else:
-                        log.debug("SpiffyTitles: empty content from %s" % (url))
+        if self.is_deadline_passed(link):
+            self.set_lookup_failure("deadline")
 
-                else:
-                    log.debug("SpiffyTitles: unacceptable mime type %s for url %s" %
-                              (content_type, url))
-            else:
-                log.error("SpiffyTitles HTTP response code %s - %s" %
-                          (status_code, body.getvalue()))
+            return (None, False, None)
 
-        except TimeoutError as e:
-            log.debug("SpiffyTitles Timeout: %s" % (str(e)))
+        if retries >= max_retries:
+            log.debug("SpiffyTitles: hit maximum retries for %s" % link)
+            self.set_lookup_failure("timeout")
 
-            return self.get_source_by_url(url, retries + 1)
-        except pycurl.error as e:
-            error_code = e.args[0] if len(e.args) else None
+            return (None, False, None)
+
+        if not link.scheme:
+            return await self.get_source_by_url_async("http://%s" % link)
+
+        log.debug("SpiffyTitles: pycurl multi attempt #%s for %s" % (retries, link))
 
-            if error_code == pycurl.E_OPERATION_TIMEDOUT:
-                log.debug("SpiffyTitles Timeout: %s" % (str(e)))
+        curl = self.curl_pool.acquire()
 
-                return self.get_source_by_url(url, retries + 1)
+        try:
+            body = self.prepare_source_request(curl, link)
+
+            try:
+                await self.event_loop.perform(curl)
+            except pycurl.error as e:
+                self.check_stopped_download(link, body, e)
 
-            log.debug("SpiffyTitles ConnectionError: %s" % (str(e)))
+            return self.read_source_response(curl, link, body)
+        except pycurl.error as e:
+            if self.is_curl_timeout(e):
+                return await self.get_source_by_url_async(link, retries + 1)
         except ValueError as e:
             log.error("SpiffyTitles InvalidURL: %s" % (str(e)))
         finally:
-            curl.close()
+            self.curl_pool.release(curl)
 
         return (None, False, None)
 
-    def get_base_domain(self, url):
+    def prepare_source_request(self, curl, link):
+        """
+        Sets up a pycurl handle to fetch the start of a page, returning the
+        HeadBuffer the page will be written to
+        """
+        body = transport.HeadBuffer(self.registryValue("maxDownloadSizeInBytes"),
+                                    acceptable_types=self.registryValue("mimeTypes"),
+                                    stop_after_head=self.registryValue("stopDownloadAfterHead"))
+        headers = ["%s: %s" % item for item in self.get_headers().items()]
+        curl.setopt(pycurl.URL, link.url)
+        curl.setopt(pycurl.HTTPHEADER, headers)
+        curl.setopt(pycurl.WRITEFUNCTION, body.write)
+        curl.setopt(pycurl.HEADERFUNCTION, body.header)
+        curl.setopt(pycurl.FOLLOWLOCATION, True)
+        curl.setopt(pycurl.TIMEOUT_MS, self.get_transfer_timeout_ms())
+        curl.setopt(pycurl.NOSIGNAL, 1)
+
+        return body
+
+    def get_transfer_timeout_ms(self):
+        """
+        Returns the pycurl timeout for one transfer: the wall clock timeout,
+        cut short by the message deadline
+        """
+        timeout = self.wall_clock_timeout
+        remaining = self.get_remaining_time()
+
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+
+        return max(1, int(timeout * 1000))
+
+    def is_deadline_passed(self, url):
+        remaining = self.get_remaining_time()
+
+        if remaining is not None and remaining <= 0:
+            log.debug("SpiffyTitles: deadline passed before fetching %s" % (url))
+
+            return True
+
+        return False
+
+    def check_stopped_download(self, url, body, error):
         """
-        Returns the FQDN comprising the top two domain levels
+        Re-raises a transfer's pycurl.error unless the HeadBuffer stopped the
+        transfer on purpose, because the title is in hand or the budget is
+        spent.
         """
-        return '.'.join(urlparse(url).netloc.rsplit('.', 2)[-2:])
+        if not body.stopped:
+            raise error
+
+        log.debug("SpiffyTitles: stopped download of %s after %s bytes" %
+                  (url, len(body.getvalue())))
+
+    def is_curl_timeout(self, error):
+        """
+        Returns whether a failed transfer timed out and should be retried,
+        recording a connection failure otherwise
+        """
+        error_code = error.args[0] if len(error.args) else None
+
+        if error_code == pycurl.E_OPERATION_TIMEDOUT:
+            log.debug("SpiffyTitles Timeout: %s" % (str(error)))
+
+            return True
+
+        log.debug("SpiffyTitles ConnectionError: %s" % (str(error)))
+        self.set_lookup_failure("connection")
+
+        return False
+
+    def read_source_response(self, curl, link, body):
+        """
+        Returns (html, is_redirect, real_domain) for a finished transfer,
+        recording why there is no html when there isn't
+        """
+        acceptable_types = self.registryValue("mimeTypes")
+        final_url = curl.getinfo(pycurl.EFFECTIVE_URL)
+        status_code = curl.getinfo(pycurl.RESPONSE_CODE)
+        is_redirect = False
+        real_domain = None
+
+        link_domain = link.base_domain
+        final_domain = links.Link(final_url).base_domain
+        if link_domain != final_domain:
+            is_redirect = True
+            real_domain = final_domain
+
+        if status_code == requests.codes.ok:
+            content_type = (curl.getinfo(pycurl.CONTENT_TYPE) or "").split(";")[0].strip()
+
+            log.debug("SpiffyTitles: content type %s" % (content_type))
+
+            if content_type in acceptable_types:
+                text = body.getvalue()
+
+                if text:
+                    return (text, is_redirect, real_domain)
+                else:
+                    log.debug("SpiffyTitles: empty content from %s" % (link))
+                    self.set_lookup_failure("empty")
+
+            else:
+                log.debug("SpiffyTitles: unacceptable mime type %s for url %s" %
+                          (content_type, link))
+                self.set_lookup_failure("mime")
+        else:
+            log.error("SpiffyTitles HTTP response code %s - %s" %
+                      (status_code, body.getvalue()))
+            self.set_lookup_failure("http %s" % (status_code))
+
+        return (None, False, None)
 
     def get_headers(self):
         agent = self.get_user_agent()
@@ -1652,12 +2568,73 @@ class SpiffyTitles(callbacks.Plugin):
                        "image/avif,image/webp,*/*;q=0.8"),
             "Accept-Language": ",".join(languages),
             "DNT": "1",
-            "Connection": "close",
             "Upgrade-Insecure-Requests": "1",
         }
 
         return headers
 
+    def api_get(self, provider, url, headers=None):
+        """
+        Requests an API URL through the shared session, using the
+        provider's timeout
+        """
+        if headers is None:
+            headers = {
+                "User-Agent": self.get_user_agent()
+            }
+
+        timeout = self.get_request_timeout(provider, url)
+
+        return self.api_session.get(url, headers=headers, timeout=timeout)
+
+    def get_request_timeout(self, provider, url):
+        """
+        Returns the timeout for a request to a provider's API, cut to the
+        time left before the message deadline
+        """
+        timeout = self.get_api_timeout(provider)
+        remaining = self.get_remaining_time()
+
+        if remaining is not None:
+            if remaining <= 0:
+                raise requests.exceptions.Timeout("message deadline passed before %s" % (url))
+
+            timeout = min(timeout, remaining)
+
+        return timeout
+
+    def get_api_timeout(self, provider):
+        """
+        Returns the timeout for a provider's API, falling back to
+        apiTimeoutInSeconds
+        """
+        overrides = dict(parse_qsl("&".join(self.registryValue("apiTimeouts"))))
+
+        try:
+            return float(overrides[provider])
+        except (KeyError, ValueError):
+            return self.registryValue("apiTimeoutInSeconds")
+
+    def get_message_deadline(self):
+        """
+        Returns the time.monotonic() value by which every lookup for a
+        message must be done, or None without a limit
+        """
+        timeout = self.registryValue("messageTimeoutInSeconds")
+
+        if timeout > 0:
+            return time.monotonic() + timeout
+
+    def get_remaining_time(self):
+        """
+        Returns the seconds left before the current lookup's deadline, or
+        None without a deadline
+        """
+        deadline = self.lookup_state.deadline
+
+        if deadline is not None:
+            return deadline - time.monotonic()
+
     def get_user_agent(self):
         """
         Returns a random user agent from the ones available
@@ -1666,16 +2643,16 @@ class SpiffyTitles(callbacks.Plugin):
 
         return random.choice(agents)
 
-    def message_matches_ignore_pattern(self, input):
+    def message_matches_ignore_pattern(self, input, channel=None):
         """
         Checks message against linkMessageIgnorePattern to determine
         whether the message should be ignored.
         """
         match = False
-        pattern = self.registryValue("linkMessageIgnorePattern")
+        pattern = self.get_channel_policy(channel).message_ignore_pattern
 
         if pattern:
-            match = re.search(pattern, input)
+            match = self.search_pattern(pattern, input, channel, "linkMessageIgnorePattern")
 
         return match
 
@@ -1685,10 +2662,10 @@ class SpiffyTitles(callbacks.Plugin):
         whether the title should be ignored.
         """
         match = False
-        pattern = self.registryValue("ignoredTitlePattern", channel=channel)
+        pattern = self.get_channel_policy(channel).ignored_title_pattern
 
         if pattern:
-            match = re.search(pattern, input)
+            match = self.search_pattern(pattern, input, channel, "ignoredTitlePattern")
 
             if match:
                 log.debug("SpiffyTitles: title %s matches ignoredTitlePattern for %s" %
@@ -1696,6 +2673,29 @@ class SpiffyTitles(callbacks.Plugin):
 
         return match
 
+    def search_pattern(self, pattern, input, channel, setting):
+        """
+        Checks input against an operator-supplied pattern. When
+        patternTimeoutInSeconds is set, the search runs in a subprocess that
+        is killed after that long, so a pattern with catastrophic
+        backtracking can't stall the bot; a timed-out search counts as no
+        match.
+        """
+        timeout = self.get_channel_policy(channel).pattern_timeout
+
+        if timeout <= 0:
+            return pattern.search(input) is not None
+
+        matched = regexp_wrapper(input, pattern, timeout=timeout,
+                                 plugin_name=self.name(), fcn_name=setting)
+
+        if matched is None:
+            log.error("SpiffyTitles: %s %s timed out after %ss; treating it as no match" %
+                      (setting, pattern.pattern, timeout))
+            return False
+
+        return matched
+
     def get_url_from_message(self, input):
         """
         Find the first string that looks like a URL from the message
@@ -1705,19 +2705,27 @@ class SpiffyTitles(callbacks.Plugin):
         if urls:
             return urls[0]
 
-    def get_urls_from_message(self, input):
+    def get_urls_from_message(self, input, channel=None):
         """
-        Find every string that looks like a URL from the message
+        Find every string that looks like a URL from the message, as Links
         """
-        url_re = self.registryValue("urlRegularExpression")
+        url_re = self.get_channel_policy(channel).url_pattern
         urls = []
 
-        for match in re.finditer(url_re, input):
+        if url_re is None:
+            return urls
+
+        for match in url_re.finditer(input):
             raw_url = match.group(0).strip()
             url = self.remove_control_characters(str(raw_url))
 
-            if url:
-                urls.append(url)
+            if not url:
+                continue
+
+            try:
+                urls.append(links.Link(url))
+            except ValueError as e:
+                log.debug("SpiffyTitles: ignoring invalid URL %s: %s" % (url, e))
 
         return urls
 
@@ -1727,7 +2735,7 @@ class SpiffyTitles(callbacks.Plugin):
     def user_has_capability(self, msg):
         channel = msg.args[0]
         mask = msg.prefix
-        required_capability = self.registryValue("requireCapability", channel=channel)
+        required_capability = self.get_channel_policy(channel).required_capability
         cap = ircdb.makeChannelCapability(channel, required_capability)
         has_cap = ircdb.checkCapability(mask, cap, ignoreDefaultAllow=True)
 
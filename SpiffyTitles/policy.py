@@ -0,0 +1,63 @@
+"""
+Per-channel snapshot of the settings SpiffyTitles checks for every message.
+"""
+import threading
+from typing import NamedTuple, Optional, Pattern
+
+
+class ChannelPolicy(NamedTuple):
+    """Immutable, pre-parsed settings for one channel.
+
+    Patterns are compiled and lists are turned into frozensets when the
+    policy is built, so checking a message only reads attributes.
+    """
+    ignore_action_links: bool
+    required_capability: str
+    channel_allowed: bool
+    url_pattern: Optional[Pattern]
+    message_ignore_pattern: Optional[Pattern]
+    ignored_domain_pattern: Optional[Pattern]
+    whitelist_domain_pattern: Optional[Pattern]
+    ignored_title_pattern: Optional[Pattern]
+    pattern_timeout: float
+    handler_whitelist: frozenset
+
+
+class PolicyCache:
+    """Builds a ChannelPolicy per channel on first use and keeps it.
+
+    Call :meth:`invalidate` (typically from a registry callback) when a
+    setting changes; every policy is then rebuilt on its next use.
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._policies = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, channel):
+        policy = self._policies.get(channel)
+
+        if policy is not None:
+            return policy
+
+        with self._lock:
+            generation = self._generation
+
+        policy = self._build(channel)
+
+        with self._lock:
+            # Don't keep a policy built from settings that changed meanwhile
+            if generation == self._generation:
+                self._policies[channel] = policy
+
+        return policy
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._policies.clear()
+
+    def __len__(self):
+        return len(self._policies)
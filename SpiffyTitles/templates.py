@@ -0,0 +1,27 @@
+"""
+Compiled Jinja templates shared by SpiffyTitles.
+"""
+import functools
+
+from jinja2 import Environment, TemplateSyntaxError
+
+# Same settings as a bare jinja2.Template(source)
+environment = Environment()
+
+
+@functools.lru_cache(maxsize=256)
+def get_template(source: str):
+    """Return the compiled template for *source*.
+
+    Compiled templates are cached by their source, so changing a template in
+    the registry simply compiles and caches the new source on its next use.
+    """
+    return environment.from_string(source)
+
+
+def validate(source: str):
+    """Raise TemplateSyntaxError if *source* is not a valid template."""
+    get_template(source)
+
+
+__all__ = ["TemplateSyntaxError", "get_template", "validate"]
@@ -9,19 +9,28 @@ from supybot.test import *
 import datetime
 import json
 import os
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor as RealThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from types import SimpleNamespace
 import unittest
 from unittest.mock import patch
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlparse
 
 import requests
 import timeout_decorator
 
 
-def response(payload, status_code=200):
-    return SimpleNamespace(status_code=status_code, text=json.dumps(payload))
+def link(url):
+    from SpiffyTitles.links import Link
+    return Link(url)
+
+
+def response(payload, status_code=200, headers=None):
+    return SimpleNamespace(status_code=status_code, text=json.dumps(payload),
+                           headers=headers or {})
 
 
 class FakeCurl:
@@ -36,6 +45,8 @@ class FakeCurl:
         self.error = error
         self.options = {}
         self.closed = False
+        self.resets = 0
+        self.chunks_written = 0
 
     def setopt(self, option, value):
         self.options[option] = value
@@ -43,7 +54,21 @@ class FakeCurl:
     def perform(self):
         if self.error:
             raise self.error
-        self.options[self.pycurl.WRITEDATA].write(self.payload)
+
+        header = self.options.get(self.pycurl.HEADERFUNCTION)
+        if header:
+            header(b'HTTP/1.1 %d OK\r\n' % self.status_code)
+            header(b'Content-Type: %s\r\n' % self.content_type.encode())
+
+        if self.options.get(self.pycurl.NOBODY):
+            return
+
+        chunks = self.payload if isinstance(self.payload, list) else [self.payload]
+        for chunk in chunks:
+            written = self.options[self.pycurl.WRITEFUNCTION](chunk)
+            self.chunks_written += 1
+            if written is not None and written != len(chunk):
+                raise self.pycurl.error(self.pycurl.E_WRITE_ERROR, 'write error')
 
     def getinfo(self, info):
         if info == self.pycurl.EFFECTIVE_URL:
@@ -53,6 +78,9 @@ class FakeCurl:
         if info == self.pycurl.CONTENT_TYPE:
             return self.content_type
 
+    def reset(self):
+        self.resets += 1
+
     def close(self):
         self.closed = True
 
@@ -61,14 +89,20 @@ def fake_pycurl(payload=b'', url='https://example.com', error=None):
     fake = SimpleNamespace(
         URL='URL',
         HTTPHEADER='HTTPHEADER',
-        WRITEDATA='WRITEDATA',
+        WRITEFUNCTION='WRITEFUNCTION',
+        HEADERFUNCTION='HEADERFUNCTION',
         FOLLOWLOCATION='FOLLOWLOCATION',
+        NOBODY='NOBODY',
+        MAXREDIRS='MAXREDIRS',
         TIMEOUT='TIMEOUT',
+        TIMEOUT_MS='TIMEOUT_MS',
         NOSIGNAL='NOSIGNAL',
+        SHARE='SHARE',
         EFFECTIVE_URL='EFFECTIVE_URL',
         RESPONSE_CODE='RESPONSE_CODE',
         CONTENT_TYPE='CONTENT_TYPE',
         E_OPERATION_TIMEDOUT=28,
+        E_WRITE_ERROR=23,
     )
     fake.error = type('FakePycurlError', (Exception,), {})
     curl = FakeCurl(fake, payload, url=url, error=error)
@@ -76,6 +110,41 @@ def fake_pycurl(payload=b'', url='https://example.com', error=None):
     return fake, curl
 
 
+@contextmanager
+def patch_pycurl(fake):
+    with patch('SpiffyTitles.plugin.pycurl', fake):
+        with patch('SpiffyTitles.transport.pycurl', fake):
+            yield fake
+
+
+@contextmanager
+def local_http_server(pages, delay=0):
+    """Serve {path: html} from 127.0.0.1, yielding the base URL."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            body = pages.get(self.path)
+            self.send_response(200 if body is not None else 404)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body or b'')))
+            self.end_headers()
+            self.wfile.write(body or b'')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield 'http://127.0.0.1:%s' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 class SpiffyTitlesTestCase(ChannelPluginTestCase):
     plugins = ('SpiffyTitles',)
 
@@ -83,6 +152,8 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
         ChannelPluginTestCase.setUp(self)
         
         self.assertNotError('reload SpiffyTitles')
+        conf.supybot.plugins.SpiffyTitles.handlerWhitelist.get(
+            self.channel).setValue([])
 
     def testGetsAllUrlsFromMessage(self):
         plugin = self.irc.getCallback('SpiffyTitles')
@@ -91,6 +162,66 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
         self.assertEqual(plugin.get_urls_from_message(message),
                          ['https://example.com/a', 'http://example.org/b'])
 
+    def testUrlsFromMessageAreParsedOnce(self):
+        from SpiffyTitles.links import Link
+        plugin = self.irc.getCallback('SpiffyTitles')
+        message = 'see https://www.Example.com/a?id=1&utm_source=irc#top'
+        [url] = plugin.get_urls_from_message(message)
+        seen = []
+
+        self.assertIsInstance(url, Link)
+        self.assertEqual((url.host, url.path, url.fragment), ('www.example.com', '/a', 'top'))
+        self.assertEqual(url.params, {'id': ['1'], 'utm_source': ['irc']})
+        self.assertEqual(url.base_domain, 'example.com')
+        self.assertEqual(url.key, 'https://www.example.com/a?id=1')
+
+        plugin.handlers['www.Example.com'] = lambda link, channel: seen.append(link) or 'Title'
+
+        with patch('SpiffyTitles.links.urlsplit') as urlsplit:
+            plugin.get_titles_by_urls([url], self.channel)
+
+        urlsplit.assert_not_called()
+        self.assertIs(seen[0], url)
+
+    def testHandlerDispatchMatchesMostSpecificDomain(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+
+        for url, handler in [('https://music.youtube.com/watch?v=x', plugin.handler_youtube),
+                             ('https://youtube.com/watch?v=x', plugin.handler_youtube),
+                             ('https://i.imgur.com/abc.jpg', plugin.handler_imgur_image),
+                             ('https://m.imgur.com/a/abc', plugin.handler_imgur),
+                             ('https://en.m.wikipedia.org/wiki/A', plugin.handler_wikipedia),
+                             ('https://wikipedia.org/', plugin.handler_default),
+                             ('https://youtube.com.example.org/', plugin.handler_default)]:
+            self.assertEqual(plugin.get_handler_for_url(link(url))[0], handler, url)
+
+    def testBaseDomainUsesPublicSuffixes(self):
+        from SpiffyTitles.domains import get_base_domain
+
+        self.assertEqual(get_base_domain('www.bbc.co.uk'), 'bbc.co.uk')
+        self.assertEqual(get_base_domain('news.bbc.co.uk'), 'bbc.co.uk')
+        self.assertEqual(get_base_domain('co.uk'), 'co.uk')
+        self.assertEqual(get_base_domain('m.youtube.com'), 'youtube.com')
+        self.assertEqual(get_base_domain('someone.github.io'), 'someone.github.io')
+        self.assertEqual(get_base_domain('a.b.foo.ck'), 'b.foo.ck')
+        self.assertEqual(get_base_domain('127.0.0.1'), '127.0.0.1')
+
+    def testRedirectWithinRegistrableDomainIsNotReported(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        fake, curl = fake_pycurl(b'<title>News</title>', url='https://www.bbc.co.uk/news')
+
+        with patch_pycurl(fake):
+            html, is_redirect, real_domain = plugin.get_source_by_url('https://bbc.co.uk/news')
+
+        self.assertFalse(is_redirect)
+
+        curl.url = 'https://www.itv.co.uk/news'
+
+        with patch_pycurl(fake):
+            html, is_redirect, real_domain = plugin.get_source_by_url('https://bbc.co.uk/news')
+
+        self.assertEqual((is_redirect, real_domain), (True, 'itv.co.uk'))
+
     def testGetUrlFromMessageKeepsFirstUrlBehavior(self):
         plugin = self.irc.getCallback('SpiffyTitles')
         message = 'one https://example.com/a two http://example.org/b'
@@ -114,7 +245,7 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
     def testMultiUrlMessagePreservesIndexWhenMiddleUrlFails(self):
         plugin = self.irc.getCallback('SpiffyTitles')
 
-        def get_title(url, channel):
+        def get_title(url, channel, deadline=None):
             if url == 'https://google.com':
                 time.sleep(0.05)
                 return '^ Google'
@@ -140,28 +271,27 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
 
     def testMultiUrlFetchesWithAtMostFourWorkers(self):
         plugin = self.irc.getCallback('SpiffyTitles')
-        created_workers = []
-
-        class CapturingThreadPoolExecutor(RealThreadPoolExecutor):
-            def __init__(self, *args, **kwargs):
-                if 'max_workers' in kwargs:
-                    created_workers.append(kwargs['max_workers'])
-                elif args:
-                    created_workers.append(args[0])
-                else:
-                    created_workers.append(None)
-
-                super(CapturingThreadPoolExecutor, self).__init__(*args, **kwargs)
-
-        urls = ['https://example.com/%s' % i for i in range(6)]
-
-        with patch('SpiffyTitles.plugin.ThreadPoolExecutor',
-                   CapturingThreadPoolExecutor):
-            with patch.object(plugin, 'get_title_by_message_url',
-                              side_effect=lambda url, channel: '^ ' + url.rsplit('/', 1)[-1]):
-                titles = plugin.get_titles_by_urls(urls, self.channel)
-
-        self.assertEqual(created_workers, [4])
+        lock = threading.Lock()
+        running = []
+        most_running = []
+
+        def get_title(url, channel, deadline=None):
+            with lock:
+                running.append(url)
+                most_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(url)
+            return '^ ' + url.rsplit('/', 1)[-1]
+
+        urls = ['https://%s.example.com/%s' % (i, i) for i in range(6)]
+
+        with patch.object(plugin, 'get_title_by_message_url', side_effect=get_title):
+            titles = plugin.get_titles_by_urls(urls, self.channel)
+            plugin.get_titles_by_urls(urls, self.channel)
+
+        self.assertEqual(max(most_running), 4)
+        self.assertEqual(plugin.title_executor.stats()['workers'], 4)
         self.assertEqual(titles, [
             (1, '^ 0'),
             (2, '^ 1'),
@@ -171,6 +301,275 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             (6, '^ 5'),
         ])
 
+    def testMultiUrlFetchesLimitWorkersPerHost(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        lock = threading.Lock()
+        running = []
+        most_running = []
+
+        def get_title(url, channel, deadline=None):
+            host = urlparse(url).hostname
+            with lock:
+                running.append(host)
+                most_running.append(running.count('slow.example'))
+            time.sleep(0.05)
+            with lock:
+                running.remove(host)
+            return '^ Title'
+
+        urls = ['https://slow.example/%s' % i for i in range(4)] + ['https://fast.example']
+
+        with patch.object(plugin, 'get_title_by_message_url', side_effect=get_title):
+            titles = plugin.get_titles_by_urls(urls, self.channel)
+
+        self.assertEqual(max(most_running), 2)
+        self.assertEqual(len(titles), 5)
+        stats = plugin.title_executor.stats()
+        self.assertEqual((stats['queued'], stats['active'], stats['hosts']), (0, 0, {}))
+
+    def testTitleExecutorRejectsJobsBeyondItsQueue(self):
+        from SpiffyTitles import concurrency
+
+        executor = concurrency.TitleExecutor(max_workers=1, per_host=1, max_queue=1)
+        release = threading.Event()
+
+        try:
+            running = executor.submit('example.com', release.wait, 5)
+            while executor.active_workers == 0:
+                time.sleep(0.01)
+            queued = executor.submit('example.com', lambda: 'queued')
+            self.assertEqual(executor.queue_depth, 1)
+
+            with self.assertRaises(concurrency.QueueFull):
+                executor.submit('example.org', lambda: 'rejected')
+
+            release.set()
+            self.assertTrue(running.result(5))
+            self.assertEqual(queued.result(5), 'queued')
+        finally:
+            release.set()
+            executor.shutdown()
+
+        with self.assertRaises(RuntimeError):
+            executor.submit('example.com', lambda: None)
+
+    def testTitleExecutorStartsWorkersForBurstAfterWarmup(self):
+        from SpiffyTitles import concurrency
+
+        executor = concurrency.TitleExecutor(max_workers=4, per_host=1)
+        release = threading.Event()
+
+        try:
+            self.assertEqual(executor.submit('warmup.example', lambda: 'warm').result(5), 'warm')
+
+            while executor._idle == 0:
+                time.sleep(0.01)
+
+            futures = [executor.submit('host%s.example' % i, release.wait, 5) for i in range(4)]
+            stats = executor.stats()
+
+            self.assertEqual(stats['workers'], 4)
+
+            deadline = time.monotonic() + 5
+            while executor.active_workers < 4 and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            self.assertEqual(executor.active_workers, 4)
+            release.set()
+            self.assertTrue(all(future.result(5) for future in futures))
+        finally:
+            release.set()
+            executor.shutdown()
+
+    def testAsyncioEngineFetchesPagesOnTheEventLoop(self):
+        from SpiffyTitles import eventloop
+
+        plugin = self.irc.getCallback('SpiffyTitles')
+        plugin.event_loop = eventloop.EventLoop('SpiffyTitles-test')
+        pages = {'/%s' % i: b'<html><head><title>Page %d</title></head></html>' % i
+                 for i in range(5)}
+        threads_before = threading.active_count()
+
+        try:
+            with local_http_server(pages, delay=0.2) as base_url:
+                urls = ['%s/%s' % (base_url, i) for i in range(5)]
+                started = time.time()
+                titles = plugin.get_titles_by_urls(urls + ['%s/missing' % base_url],
+                                                   self.channel)
+                elapsed = time.time() - started
+        finally:
+            plugin.event_loop.close()
+            plugin.event_loop = None
+
+        self.assertEqual(titles, [(i + 1, '^ Page %s' % i) for i in range(5)] +
+                         [(6, '^ <bad url>')])
+        self.assertLess(elapsed, 1)
+        self.assertEqual(plugin.title_executor.stats()['workers'], 0)
+        self.assertLessEqual(threading.active_count(), threads_before + 1)
+
+    def testAsyncioEngineKeepsBlockingWorkOffTheLoop(self):
+        from SpiffyTitles import eventloop
+
+        plugin = self.irc.getCallback('SpiffyTitles')
+        plugin.event_loop = eventloop.EventLoop('SpiffyTitles-test')
+        pages = {
+            '/ambiguous': b'<html><head><title>Parsed</title><title>Parsed</title></head></html>',
+            '/untitled': b'<html><head></head><body>No title</body></html>',
+        }
+        thread_names = {}
+
+        def record(name, method):
+            def wrapper(*args, **kwargs):
+                thread_names.setdefault(name, threading.current_thread().name)
+                return method(*args, **kwargs)
+            return wrapper
+
+        try:
+            with local_http_server(pages) as base_url, \
+                    patch.object(plugin, 'get_link_from_cache',
+                                 record('cache read', plugin.get_link_from_cache)), \
+                    patch.object(plugin, 'add_link_to_cache',
+                                 record('cache write', plugin.add_link_to_cache)), \
+                    patch.object(plugin, 'get_title_from_html',
+                                 record('parse', plugin.get_title_from_html)), \
+                    patch.object(plugin, 'is_message_url_allowed',
+                                 record('patterns', plugin.is_message_url_allowed)):
+                titles = plugin.get_titles_by_urls(['%s/ambiguous' % base_url,
+                                                    '%s/untitled' % base_url], self.channel)
+                untitled = plugin.link_cache.get(link('%s/untitled' % base_url).key)
+        finally:
+            plugin.event_loop.close()
+            plugin.event_loop = None
+
+        self.assertEqual(titles[0], (1, '^ Parsed'))
+        self.assertEqual(untitled['failure'], 'no title')
+        self.assertEqual(sorted(thread_names),
+                         ['cache read', 'cache write', 'parse', 'patterns'])
+
+        for name in thread_names.values():
+            self.assertNotEqual(name, 'SpiffyTitles-test')
+
+    def testAsyncioEngineRunsApiHandlersOnWorkerThreads(self):
+        from SpiffyTitles import eventloop
+
+        plugin = self.irc.getCallback('SpiffyTitles')
+        plugin.event_loop = eventloop.EventLoop('SpiffyTitles-test')
+        thread_names = []
+
+        def get_title(url, channel, deadline=None):
+            thread_names.append(threading.current_thread().name)
+            return '^ API title'
+
+        try:
+            with patch.object(plugin, 'get_title_by_url', side_effect=get_title):
+                titles = plugin.get_titles_by_urls(['https://vimeo.com/123456'],
+                                                   self.channel)
+        finally:
+            plugin.event_loop.close()
+            plugin.event_loop = None
+
+        self.assertEqual(titles, [(1, '^ API title')])
+        self.assertTrue(thread_names[0].startswith('SpiffyTitles-'))
+        self.assertNotEqual(thread_names[0], 'SpiffyTitles-test')
+
+    def testMessageDeadlinePostsTitlesThatResolvedInTime(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        conf.supybot.plugins.SpiffyTitles.messageTimeoutInSeconds.setValue(0.3)
+        release = threading.Event()
+
+        def get_title(url, channel, deadline=None):
+            if 'slow' in url:
+                release.wait(5)
+            return '^ ' + urlparse(url).hostname
+
+        try:
+            with patch.object(plugin, 'get_title_by_message_url', side_effect=get_title):
+                started = time.time()
+                titles = plugin.get_titles_by_urls(['https://fast.example',
+                                                    'https://slow.example'], self.channel)
+                elapsed = time.time() - started
+        finally:
+            release.set()
+            conf.supybot.plugins.SpiffyTitles.messageTimeoutInSeconds.setValue(15)
+
+        self.assertLess(elapsed, 2)
+        self.assertEqual(titles, [(1, '^ fast.example'), (2, '^ <bad url>')])
+
+    def testMessageDeadlineLimitsRequestsRetriesAndFallbacks(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        fake, curl = fake_pycurl(b'<title>Example</title>')
+        plugin.lookup_state.deadline = time.monotonic() + 2
+
+        try:
+            with patch.object(plugin.api_session, 'get',
+                              return_value=response({})) as get:
+                plugin.api_get('reddit', 'https://www.reddit.com/api/info.json')
+
+            self.assertLessEqual(get.call_args[1]['timeout'], 2)
+
+            with patch_pycurl(fake):
+                plugin.get_source_by_url('https://example.com')
+
+            self.assertLessEqual(curl.options[fake.TIMEOUT_MS], 2000)
+
+            plugin.lookup_state.deadline = time.monotonic() - 1
+            curl.options.clear()
+
+            with patch_pycurl(fake):
+                self.assertEqual(plugin.get_source_by_url('https://example.com'),
+                                 (None, False, None))
+
+            self.assertEqual(curl.options, {})
+            self.assertEqual(plugin.lookup_state.failure, 'deadline')
+
+            with self.assertRaises(requests.exceptions.Timeout):
+                plugin.api_get('reddit', 'https://www.reddit.com/api/info.json')
+        finally:
+            plugin.lookup_state.deadline = None
+
+    def testDuplicateUrlsInMessageAreFetchedOnce(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+
+        with patch.object(plugin, 'get_title_by_message_url',
+                          return_value='^ Example title') as get_title:
+            titles = plugin.get_titles_by_urls([
+                'https://example.com',
+                'https://example.org',
+                'https://example.com',
+            ], self.channel)
+
+        self.assertEqual(get_title.call_count, 2)
+        self.assertEqual(titles, [
+            (1, '^ Example title'),
+            (2, '^ Example title'),
+            (3, '^ Example title'),
+        ])
+
+    def testConcurrentLookupsOfSameUrlShareOneHandlerCall(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        html = '<html><head><title>Example title</title></head></html>'
+        release = threading.Event()
+        calls = []
+
+        def get_source(url):
+            calls.append(url)
+            release.wait(5)
+            return (html, False, None)
+
+        with patch.object(plugin, 'get_source_by_url', side_effect=get_source):
+            with RealThreadPoolExecutor(max_workers=3) as executor:
+                futures = [executor.submit(plugin.get_title_by_url,
+                                           'https://example.com', self.channel)
+                           for i in range(3)]
+                while plugin.in_flight.in_flight() == 0:
+                    time.sleep(0.01)
+                time.sleep(0.05)
+                release.set()
+                titles = [future.result() for future in futures]
+
+        self.assertEqual(calls, ['https://example.com'])
+        self.assertEqual(titles, ['^ Example title'] * 3)
+
     def testSingleBadUrlStaysQuiet(self):
         plugin = self.irc.getCallback('SpiffyTitles')
 
@@ -185,7 +584,7 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
         fake, curl = fake_pycurl()
         curl.error = fake.error(6, 'no dns')
 
-        with patch('SpiffyTitles.plugin.pycurl', fake):
+        with patch_pycurl(fake):
             with patch('SpiffyTitles.plugin.log.error') as error_log:
                 self.assertEqual(plugin.get_source_by_url('https://dead.example'),
                                  (None, False, None))
@@ -201,6 +600,44 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             self.assertEqual(plugin.handler_default('https://example.com', self.channel),
                              '^ Example title')
 
+    def testFastTitleExtractorMatchesFullParser(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        from SpiffyTitles import htmltitle
+        documents = [
+            b'<html><head><title>Example title</title></head></html>',
+            b'<html><head><title>First</title><title>  Second  </title></head></html>',
+            b'<html><head><title>Last</title><title> </title></head></html>',
+            b'<html><head><title>Fish &amp; Chips &#8212; &eacute;</title></head></html>',
+            b'<html><head><!-- <title>Hidden</title> --><title>Shown</title></head></html>',
+            b'<html><head><script>var t = "<title>No</title>";</script>'
+            b'<title>Yes</title></head><body><title>Body</title></body></html>',
+            b'<html><head><meta charset="iso-8859-1"><title>Caf\xe9</title></head></html>',
+            '<html><head><title>by Amazon Spaghetti Au Blé Complet</title></head></html>'
+            .encode('utf-8'),
+            b'<html><head></head><body>No title</body></html>',
+        ]
+
+        for html in documents:
+            self.assertEqual(htmltitle.get_title(html),
+                             plugin.get_title_from_parsed_html(html), html)
+
+    def testTitleExtractorFallsBackForAmbiguousMarkup(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        from SpiffyTitles import htmltitle
+        html = b'<title>Loose title</title><p>Text</p>'
+
+        with patch.object(htmltitle, 'get_title',
+                          side_effect=htmltitle.AmbiguousMarkup('test')):
+            self.assertEqual(plugin.get_title_from_html(html), 'Loose title')
+
+        self.assertRaises(htmltitle.AmbiguousMarkup, htmltitle.get_title,
+                          b'<html><head><title>Open</head></html>')
+
+    def testFullParserHandlesDocumentWithoutHead(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+
+        self.assertIsNone(plugin.get_title_from_parsed_html(b'<p>Just text</p>'))
+
     def testAmazonUrlUsesDefaultHandlerTitle(self):
         plugin = self.irc.getCallback('SpiffyTitles')
         html = '''
@@ -224,7 +661,7 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
         html = b'<html><head><title>Example title</title></head></html>'
         url = 'https://www.amazon.fr/dp/B0CTH7CVGB'
         fake, curl = fake_pycurl(html, url=url)
-        with patch('SpiffyTitles.plugin.pycurl', fake):
+        with patch_pycurl(fake):
             self.assertEqual(
                 plugin.get_source_by_url(url),
                 (html, False, None))
@@ -236,8 +673,80 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             headers)
         self.assertFalse(any(header.lower().startswith('accept-encoding:')
                              for header in headers))
-        self.assertEqual(curl.options[fake.TIMEOUT], plugin.wall_clock_timeout)
-        self.assertTrue(curl.closed)
+        self.assertEqual(curl.options[fake.TIMEOUT_MS], plugin.wall_clock_timeout * 1000)
+        self.assertFalse(any(header.lower().startswith('connection:')
+                             for header in headers))
+
+    def testSourceFetchReusesPooledCurlHandle(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        html = b'<html><head><title>Example title</title></head></html>'
+        fake, curl = fake_pycurl(html)
+        created = []
+        fake.Curl = lambda: created.append(curl) or curl
+
+        with patch_pycurl(fake):
+            plugin.get_source_by_url('https://example.com/a')
+            plugin.get_source_by_url('https://example.com/b')
+
+        self.assertEqual(len(created), 1)
+        self.assertEqual(curl.resets, 2)
+        self.assertFalse(curl.closed)
+        self.assertIn(fake.SHARE, curl.options)
+
+    def testHeadBufferReadsShortResponsesToTheEnd(self):
+        from SpiffyTitles.transport import HeadBuffer
+        html = b'<html><head><title>Example title</title></head><body></body></html>'
+        body = HeadBuffer(1048576)
+        body.header(b'HTTP/1.1 200 OK\r\n')
+        body.header(b'Content-Length: %d\r\n' % len(html))
+
+        self.assertIsNone(body.write(html))
+        self.assertTrue(body.head_complete)
+        self.assertEqual(body.getvalue(), html)
+
+    def testSourceFetchStopsAfterHead(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        chunks = [
+            b'<html><head><title>Example title</title>',
+            b'</he',
+            b'ad><body>' + b'x' * 100,
+            b'y' * 100,
+        ]
+        fake, curl = fake_pycurl(chunks)
+
+        with patch_pycurl(fake):
+            html, is_redirect, real_domain = plugin.get_source_by_url('https://example.com')
+
+        self.assertEqual(curl.chunks_written, 3)
+        self.assertEqual(plugin.get_title_from_html(html), 'Example title')
+
+    def testSourceFetchStopsAtDownloadBudget(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        conf.supybot.plugins.SpiffyTitles.maxDownloadSizeInBytes.setValue(64)
+        chunks = [b'<html><head><title>Example title</title>', b'x' * 64, b'y' * 64]
+        fake, curl = fake_pycurl(chunks)
+
+        try:
+            with patch_pycurl(fake):
+                html, is_redirect, real_domain = plugin.get_source_by_url(
+                    'https://example.com')
+        finally:
+            conf.supybot.plugins.SpiffyTitles.maxDownloadSizeInBytes.setValue(1048576)
+
+        self.assertEqual(curl.chunks_written, 2)
+        self.assertEqual(plugin.get_title_from_html(html), 'Example title')
+
+    def testSourceFetchRejectsUnacceptableMimeTypeBeforeBody(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        fake, curl = fake_pycurl([b'\x89PNG', b'\x00' * 100])
+        curl.content_type = 'image/png'
+
+        with patch_pycurl(fake):
+            self.assertEqual(plugin.get_source_by_url('https://example.com/a.png'),
+                             (None, False, None))
+
+        self.assertEqual(curl.chunks_written, 1)
+        self.assertEqual(plugin.lookup_state.failure, 'mime')
 
     def testGetHeadersUsesBrowserNavigationHeaders(self):
         plugin = self.irc.getCallback('SpiffyTitles')
@@ -261,6 +770,7 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
         payload = {
             'pageInfo': {'totalResults': 1},
             'items': [{
+                'id': 'abc12345678',
                 'snippet': {
                     'title': 'Video title',
                     'channelTitle': 'Channel name',
@@ -275,10 +785,9 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             }],
         }
 
-        with patch('SpiffyTitles.plugin.requests.get', return_value=response(payload)):
+        with patch.object(plugin.api_session, 'get', return_value=response(payload)):
             title = plugin.handler_youtube(
-                'https://www.youtube.com/watch?v=abc12345678&t=65',
-                urlparse('https://www.youtube.com/watch?v=abc12345678').netloc,
+                link('https://www.youtube.com/watch?v=abc12345678&t=65'),
                 self.channel)
 
         self.assertIn('Video title', title)
@@ -286,6 +795,44 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
         self.assertIn('01:05', title)
         self.assertIn('Views: 1,234', title)
 
+    def testYoutubeVideosAreBatchedAndCachedById(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        conf.supybot.plugins.SpiffyTitles.youtubeDeveloperKey.setValue('test-key')
+
+        def video(video_id, title):
+            return {
+                'id': video_id,
+                'snippet': {'title': title, 'channelTitle': 'Channel'},
+                'statistics': {'viewCount': '10'},
+                'contentDetails': {'duration': 'PT2M'},
+            }
+
+        payload = {'items': [video('aaaaaaaaaaa', 'First'), video('bbbbbbbbbbb', 'Second')]}
+        urls = [
+            'https://www.youtube.com/watch?v=aaaaaaaaaaa',
+            'https://youtu.be/bbbbbbbbbbb',
+            'https://www.youtube.com/watch?v=aaaaaaaaaaa&t=90',
+        ]
+
+        try:
+            with patch.object(plugin.api_session, 'get',
+                              return_value=response(payload)) as get:
+                titles = plugin.get_titles_by_urls(urls, self.channel)
+                title = plugin.handler_youtube(link('https://youtu.be/aaaaaaaaaaa?t=5'),
+                                               self.channel)
+        finally:
+            conf.supybot.plugins.SpiffyTitles.youtubeDeveloperKey.setValue('')
+
+        self.assertEqual(get.call_count, 1)
+        query = parse_qs(urlparse(get.call_args[0][0]).query)
+        self.assertEqual(sorted(query['id'][0].split(',')), ['aaaaaaaaaaa', 'bbbbbbbbbbb'])
+        self.assertIn('items(id,', query['fields'][0])
+        self.assertIn('First', titles[0][1])
+        self.assertNotIn('@', titles[0][1])
+        self.assertIn('Second', titles[1][1])
+        self.assertIn('@ 01:30', titles[2][1])
+        self.assertIn('@ 00:05', title)
+
     def testDailymotionHandler(self):
         plugin = self.irc.getCallback('SpiffyTitles')
         payload = {
@@ -296,10 +843,9 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             'views_total': 1234,
         }
 
-        with patch('SpiffyTitles.plugin.requests.get', return_value=response(payload)):
+        with patch.object(plugin.api_session, 'get', return_value=response(payload)):
             title = plugin.handler_dailymotion(
-                'https://www.dailymotion.com/video/x7abc_slug',
-                urlparse('https://www.dailymotion.com/video/x7abc_slug'),
+                link('https://www.dailymotion.com/video/x7abc_slug'),
                 self.channel)
 
         self.assertEqual(title, '^ [daily-user] Daily title :: Duration: 01:05 :: 1,234 views')
@@ -313,9 +859,8 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             'stats_number_of_comments': 5,
         }]
 
-        with patch('SpiffyTitles.plugin.requests.get', return_value=response(payload)):
-            title = plugin.handler_vimeo('https://vimeo.com/123456',
-                                         'vimeo.com',
+        with patch.object(plugin.api_session, 'get', return_value=response(payload)):
+            title = plugin.handler_vimeo(link('https://vimeo.com/123456'),
                                          self.channel)
 
         self.assertEqual(title, '^ Vimeo title :: Duration: 02:05 :: 1,234 plays :: 5 comments')
@@ -331,9 +876,8 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             'recoubs_count': 3,
         }
 
-        with patch('SpiffyTitles.plugin.requests.get', return_value=response(payload)):
-            title = plugin.handler_coub('https://coub.com/view/abc',
-                                        'coub.com',
+        with patch.object(plugin.api_session, 'get', return_value=response(payload)):
+            title = plugin.handler_coub(link('https://coub.com/view/abc'),
                                         self.channel)
 
         self.assertEqual(title,
@@ -351,9 +895,8 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             }],
         }
 
-        with patch('SpiffyTitles.plugin.requests.get', return_value=response(payload)):
-            title = plugin.handler_imdb('https://www.imdb.com/title/tt1234567/',
-                                        urlparse('https://www.imdb.com/title/tt1234567/'),
+        with patch.object(plugin.api_session, 'get', return_value=response(payload)):
+            title = plugin.handler_imdb(link('https://www.imdb.com/title/tt1234567/'),
                                         self.channel)
 
         self.assertEqual(title,
@@ -370,20 +913,77 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             },
         }
 
-        with patch('SpiffyTitles.plugin.requests.get', return_value=response(payload)):
-            title = plugin.handler_wikipedia('https://en.wikipedia.org/wiki/Article',
-                                             'wikipedia.org',
+        with patch.object(plugin.api_session, 'get', return_value=response(payload)) as get:
+            title = plugin.handler_wikipedia(link('https://en.wikipedia.org/wiki/Article'),
                                              self.channel)
 
         self.assertEqual(title, '^ Article extract with enough text.')
+        query = parse_qs(urlparse(get.call_args[0][0]).query)
+        self.assertEqual(query['titles'], ['Article'])
+        self.assertEqual(query['redirects'], ['1'])
+
+    def testWikipediaExtractsAreCachedByNormalizedTitle(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        payload = {
+            'query': {
+                'redirects': [{'from': 'Foo & bar', 'to': 'Foo and bar'}],
+                'pages': {
+                    '1': {'title': 'Foo and bar', 'extract': 'Foo and bar extract.'},
+                },
+            },
+        }
+        urls = [
+            'https://en.wikipedia.org/wiki/Foo_%26_bar',
+            'https://en.m.wikipedia.org/wiki/foo%20%26%20bar',
+            'https://en.wikipedia.org/wiki/Foo_and_bar',
+        ]
+
+        with patch.object(plugin.api_session, 'get', return_value=response(payload)) as get:
+            titles = [plugin.handler_wikipedia(link(url), self.channel) for url in urls]
+
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(urlparse(get.call_args[0][0]).netloc, 'en.wikipedia.org')
+        self.assertEqual(parse_qs(urlparse(get.call_args[0][0]).query)['titles'], ['Foo & bar'])
+        self.assertEqual(titles, ['^ Foo and bar extract.'] * 3)
+
+    def testWikipediaRestSummaryBackend(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        payload = {
+            'title': 'Foo_and_bar',
+            'titles': {'canonical': 'Foo_and_bar', 'normalized': 'Foo and bar'},
+            'extract': 'Summary extract (ignored) of the page.',
+        }
+        settings = conf.supybot.plugins.SpiffyTitles.wikipedia
+
+        try:
+            settings.backend.get(self.channel).setValue('rest')
+            settings.maxChars.get(self.channel).setValue(20)
+
+            with patch.object(plugin.api_session, 'get',
+                              return_value=response(payload)) as get:
+                title = plugin.handler_wikipedia(link('https://de.wikipedia.org/wiki/Foo_%26_bar'),
+                                                 self.channel)
+                plugin.handler_wikipedia(link('https://de.wikipedia.org/wiki/Foo_and_bar'),
+                                         self.channel)
+        finally:
+            settings.backend.get(self.channel).setValue('action')
+            settings.maxChars.get(self.channel).setValue(240)
+
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(get.call_args[0][0],
+                         'https://de.wikipedia.org/api/rest_v1/page/summary/Foo_%26_bar')
+        self.assertEqual(title, '^ Summary extract...')
 
     def testRedditThreadHandler(self):
         plugin = self.irc.getCallback('SpiffyTitles')
-        payload = [{
+        payload = {
+            'kind': 'Listing',
             'data': {
                 'children': [{
+                    'kind': 't3',
                     'data': {
                         'id': 'abc',
+                        'name': 't3_abc',
                         'created_utc': datetime.datetime.now().timestamp(),
                         'is_self': False,
                         'author': 'poster',
@@ -397,18 +997,287 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
                     },
                 }],
             },
-        }]
+        }
 
-        with patch('SpiffyTitles.plugin.requests.get', return_value=response(payload)):
+        with patch.object(plugin.api_session, 'get', return_value=response(payload)) as get:
             title = plugin.handler_reddit(
-                'https://www.reddit.com/r/testing/comments/abc/reddit_title/',
-                'reddit.com',
+                link('https://www.reddit.com/r/testing/comments/abc/reddit_title/'),
                 self.channel)
 
+        self.assertEqual(get.call_args[0][0],
+                         'https://www.reddit.com/api/info.json?id=t3_abc&raw_json=1')
         self.assertIn('/r/testing :: Reddit title :: 42 points (91%)', title)
         self.assertIn('7 comments', title)
         self.assertIn('https://example.com/item (example.com)', title)
 
+    def testRedditPostsAreBatchedThroughApiInfo(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        created = datetime.datetime.now().timestamp()
+
+        def thing(kind, thing_id, **fields):
+            data = dict(fields, id=thing_id, name='%s_%s' % (kind, thing_id),
+                        created_utc=created, subreddit='testing', author='poster', score=3)
+
+            return {'kind': kind, 'data': data}
+
+        payload = {
+            'kind': 'Listing',
+            'data': {
+                'children': [
+                    thing('t3', 'aaa', title='First thread', is_self=True, selftext='Text'),
+                    thing('t3', 'bbb', title='Second thread', is_self=True, selftext=''),
+                    thing('t1', 'ccc', body='A comment body'),
+                ],
+            },
+        }
+        urls = [
+            'https://www.reddit.com/r/testing/comments/aaa/first/',
+            'https://www.reddit.com/r/testing/comments/bbb/second/ccc',
+        ]
+
+        with patch.object(plugin.api_session, 'get', return_value=response(payload)) as get:
+            titles = plugin.get_titles_by_urls(urls, self.channel)
+
+        self.assertEqual(get.call_count, 1)
+        query = parse_qs(urlparse(get.call_args[0][0]).query)
+        self.assertEqual(urlparse(get.call_args[0][0]).path, '/api/info.json')
+        self.assertEqual(sorted(query['id'][0].split(',')), ['t1_ccc', 't3_aaa', 't3_bbb'])
+        self.assertEqual(query['raw_json'], ['1'])
+        self.assertIn('First thread', titles[0][1])
+        self.assertIn('Second thread', titles[1][1])
+        self.assertIn('A comment body', titles[1][1])
+
+    def testRedditOAuthModeUsesCachedTokenAgainstLocalServer(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, payload, status=200, headers=()):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+
+                for name, value in headers:
+                    self.send_header(name, value)
+
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                form = parse_qs(self.rfile.read(length).decode('ascii'))
+                requests_seen.append(('POST', self.path, self.headers['Authorization'], form))
+                self.reply({'access_token': 'local-token', 'token_type': 'bearer',
+                            'expires_in': 3600})
+
+            def do_GET(self):
+                requests_seen.append(('GET', self.path, self.headers['Authorization'], None))
+                thread = parse_qs(urlparse(self.path).query)['id'][0]
+                data = {'id': thread[3:], 'name': thread, 'title': 'Title ' + thread,
+                        'created_utc': time.time(), 'subreddit': 'testing', 'is_self': True}
+                self.reply({'kind': 'Listing', 'data': {'children': [{'data': data}]}},
+                           headers=[('X-Ratelimit-Remaining', '95.0'),
+                                    ('X-Ratelimit-Reset', '300')])
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:%s' % server.server_address[1]
+        conf.supybot.plugins.SpiffyTitles.reddit.clientID.setValue('client-id')
+        conf.supybot.plugins.SpiffyTitles.reddit.clientSecret.setValue('client-secret')
+
+        try:
+            with patch.object(plugin, 'reddit_oauth_url', base_url), \
+                    patch.object(plugin, 'reddit_token_url', base_url + '/api/v1/access_token'):
+                first = plugin.handler_reddit(
+                    link('https://www.reddit.com/r/testing/comments/aaa/first/'), self.channel)
+                second = plugin.handler_reddit(
+                    link('https://www.reddit.com/r/testing/comments/bbb/second/'), self.channel)
+        finally:
+            conf.supybot.plugins.SpiffyTitles.reddit.clientID.setValue('')
+            conf.supybot.plugins.SpiffyTitles.reddit.clientSecret.setValue('')
+            server.shutdown()
+            server.server_close()
+
+        self.assertIn('Title t3_aaa', first)
+        self.assertIn('Title t3_bbb', second)
+        self.assertEqual([request[0] for request in requests_seen], ['POST', 'GET', 'GET'])
+        self.assertEqual(requests_seen[0][1], '/api/v1/access_token')
+        self.assertTrue(requests_seen[0][2].startswith('Basic '))
+        self.assertEqual(requests_seen[0][3], {'grant_type': ['client_credentials']})
+        self.assertEqual(requests_seen[1][2], 'bearer local-token')
+        self.assertTrue(requests_seen[2][1].startswith('/api/info.json?id=t3_bbb'))
+
+    def testRedditRequestsArePacedByRateLimitHeaders(self):
+        from SpiffyTitles.transport import RateLimitPacer
+        now = [0.0]
+        pacer = RateLimitPacer(reserve=10, clock=lambda: now[0])
+
+        self.assertEqual(pacer.reserve(), 0)
+        pacer.update({'X-Ratelimit-Remaining': '50.0', 'X-Ratelimit-Reset': '100'})
+        self.assertEqual(pacer.reserve(), 0)
+        pacer.update({'X-Ratelimit-Remaining': '4', 'X-Ratelimit-Reset': '100'})
+        self.assertEqual(pacer.reserve(), 0)
+        self.assertEqual(pacer.delay(), 25)
+        self.assertEqual(pacer.reserve(), 25)
+
+        pacer.update({'X-Ratelimit-Remaining': '0', 'X-Ratelimit-Reset': '30'})
+        self.assertEqual(pacer.reserve(), 30)
+        now[0] = 31.0
+        self.assertEqual(pacer.reserve(), 0)
+
+    def testRedditRetriesAfterRateLimitResponse(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        limited = response({}, 429, {'X-Ratelimit-Remaining': '0', 'X-Ratelimit-Reset': '0.01'})
+        ok = response({'data': {'name': 'someone', 'created_utc': time.time()}})
+
+        with patch.object(plugin.api_session, 'get', side_effect=[limited, ok]) as get:
+            title = plugin.handler_reddit(link('https://www.reddit.com/user/someone'),
+                                          self.channel)
+
+        self.assertEqual(get.call_count, 2)
+        self.assertIn('/u/someone', title)
+
+    def testRedditRateLimitWaitIsCheckedAgainstTheDeadline(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        url = 'https://www.reddit.com/r/testing/comments/abc/reddit_title/'
+        plugin.reddit_rate_limit.update({'X-Ratelimit-Remaining': '0',
+                                         'X-Ratelimit-Reset': '300'})
+
+        try:
+            with patch.object(plugin.api_session, 'get') as get:
+                started = time.monotonic()
+                entry = plugin.fetch_title_by_url(plugin.handler_reddit, link(url),
+                                                  self.channel, time.monotonic() + 2)
+                elapsed = time.monotonic() - started
+        finally:
+            plugin.lookup_state.deadline = None
+
+        self.assertIsNone(entry)
+        self.assertLess(elapsed, 1)
+        self.assertEqual(get.call_count, 0)
+        self.assertEqual(plugin.lookup_state.failure, 'rate limit')
+        self.assertIsNone(plugin.get_link_from_cache(url))
+        self.assertEqual(plugin.reddit_batcher._sent, {})
+
+    def testRedditBatchCountsOnceAgainstTheRateLimit(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        created = datetime.datetime.now().timestamp()
+        children = [
+            {'kind': kind, 'data': {'id': thing_id, 'name': '%s_%s' % (kind, thing_id),
+                                    'title': 'Title %s' % (thing_id), 'body': 'Body',
+                                    'is_self': True, 'selftext': '',
+                                    'created_utc': created, 'subreddit': 'testing',
+                                    'author': 'poster', 'score': 3}}
+            for kind, thing_id in [('t3', 'aaa'), ('t3', 'bbb'), ('t1', 'ccc'), ('t3', 'ddd')]
+        ]
+        urls = [
+            'https://www.reddit.com/r/testing/comments/aaa/first/',
+            'https://www.reddit.com/r/testing/comments/bbb/second/ccc',
+            'https://www.reddit.com/r/testing/comments/ddd/third/',
+        ]
+        plugin.reddit_rate_limit.update({'X-Ratelimit-Remaining': '5',
+                                         'X-Ratelimit-Reset': '100'})
+        payload = {'kind': 'Listing', 'data': {'children': children}}
+
+        # Every handler runs while the batch is waiting
+        with patch.object(plugin.title_executor, 'per_host', len(urls)), \
+                patch.object(plugin.api_session, 'get', return_value=response(payload)) as get:
+            started = time.monotonic()
+            titles = plugin.get_titles_by_urls(urls, self.channel)
+            elapsed = time.monotonic() - started
+
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(urlparse(get.call_args[0][0]).path, '/api/info.json')
+        self.assertLess(elapsed, 5)
+        self.assertEqual(plugin.reddit_rate_limit._remaining, 4)
+        self.assertIn('Title aaa', titles[0][1])
+        self.assertIn('Title bbb', titles[1][1])
+        self.assertIn('Title ddd', titles[2][1])
+
+    def testApiRequestsUsePerProviderTimeouts(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        conf.supybot.plugins.SpiffyTitles.apiTimeouts.setValue(['vimeo=2.5', 'coub=bogus'])
+        payload = [{'title': 'Vimeo title', 'duration': 125}]
+
+        try:
+            with patch.object(plugin.api_session, 'get',
+                              return_value=response(payload)) as get:
+                plugin.handler_vimeo(link('https://vimeo.com/123456'), self.channel)
+                plugin.api_get('coub', 'http://coub.com/api/v2/coubs/abc')
+        finally:
+            conf.supybot.plugins.SpiffyTitles.apiTimeouts.setValue([])
+
+        self.assertEqual(get.call_args_list[0][1]['timeout'], 2.5)
+        self.assertEqual(get.call_args_list[1][1]['timeout'],
+                         conf.supybot.plugins.SpiffyTitles.apiTimeoutInSeconds())
+        self.assertIn('User-Agent', get.call_args_list[1][1]['headers'])
+
+    def testApiSessionRequiresTimeout(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+
+        with self.assertRaises(ValueError):
+            plugin.api_session.get('https://example.com')
+
+    def testApiTimeoutIsNegativelyCached(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        url = 'https://vimeo.com/123456'
+
+        with patch.object(plugin.api_session, 'get',
+                          side_effect=requests.exceptions.ReadTimeout('slow')):
+            self.assertIsNone(plugin.get_title_by_url(url, self.channel))
+
+        self.assertEqual(plugin.get_link_from_cache(url)['failure'], 'timeout')
+
+    def testLookupCutShortByDeadlineIsNotNegativelyCached(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        vimeo_url = 'https://vimeo.com/123456'
+        page_url = 'https://example.com/queued'
+        fake, curl = fake_pycurl(b'<title>Example</title>')
+        deadline = time.monotonic() - 1
+
+        try:
+            with patch.object(plugin.api_session, 'get') as get:
+                self.assertIsNone(plugin.fetch_title_by_url(plugin.handler_vimeo,
+                                                            link(vimeo_url), self.channel,
+                                                            deadline))
+
+            self.assertEqual(get.call_count, 0)
+            self.assertEqual(plugin.lookup_state.failure, 'deadline')
+
+            with patch_pycurl(fake):
+                self.assertIsNone(plugin.fetch_title_by_url(plugin.handler_default,
+                                                            link(page_url), self.channel,
+                                                            deadline))
+
+            self.assertEqual(plugin.lookup_state.failure, 'deadline')
+        finally:
+            plugin.lookup_state.deadline = None
+
+        self.assertIsNone(plugin.get_link_from_cache(vimeo_url))
+        self.assertIsNone(plugin.get_link_from_cache(page_url))
+
+    def testTemplatesAreCompiledOncePerSource(self):
+        from SpiffyTitles import templates
+
+        template = templates.get_template('^ {{title}}')
+
+        self.assertIs(templates.get_template('^ {{title}}'), template)
+        self.assertIsNot(templates.get_template('^ {{title}}!'), template)
+        self.assertEqual(template.render({'title': 'Example'}), '^ Example')
+
+    def testInvalidTemplateIsRejected(self):
+        value = conf.supybot.plugins.SpiffyTitles.defaultTitleTemplate
+        original = value()
+
+        with self.assertRaises(registry.InvalidRegistryValue):
+            value.set('^ {{title')
+
+        self.assertEqual(value(), original)
+
     def testImgurAlbumHandler(self):
         plugin = self.irc.getCallback('SpiffyTitles')
         plugin.imgur_client = SimpleNamespace(
@@ -421,8 +1290,7 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             )
         )
 
-        title = plugin.handler_imgur_album('https://imgur.com/a/abc',
-                                           urlparse('https://imgur.com/a/abc'),
+        title = plugin.handler_imgur_album(link('https://imgur.com/a/abc'),
                                            self.channel)
 
         self.assertIn('Album title', title)
@@ -433,8 +1301,7 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
         plugin = self.irc.getCallback('SpiffyTitles')
 
         with patch.object(plugin, 'handler_imgur_album', return_value='album title') as handler:
-            title = plugin.handler_imgur('https://imgur.com/a/abc',
-                                         urlparse('https://imgur.com/a/abc'),
+            title = plugin.handler_imgur(link('https://imgur.com/a/abc'),
                                          self.channel)
 
         self.assertEqual(title, 'album title')
@@ -455,8 +1322,7 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
             )
         )
 
-        title = plugin.handler_imgur_image('https://i.imgur.com/abc.jpg',
-                                           urlparse('https://i.imgur.com/abc.jpg'),
+        title = plugin.handler_imgur_image(link('https://i.imgur.com/abc.jpg'),
                                            self.channel)
 
         self.assertIn('Image title', title)
@@ -475,16 +1341,163 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
         plugin.api_apl = api
 
         self.assertEqual(plugin.handler_redacted(
-            'https://redacted.sh/torrents.php?id=123',
-            urlparse('https://redacted.sh/torrents.php?id=123'),
+            link('https://redacted.sh/torrents.php?id=123'),
             self.channel),
             '^ Gazelle title')
         self.assertEqual(plugin.handler_apl(
-            'https://orpheus.network/torrents.php?id=123',
-            urlparse('https://orpheus.network/torrents.php?id=123'),
+            link('https://orpheus.network/torrents.php?id=123'),
             self.channel),
             '^ Gazelle title')
 
+    @contextmanager
+    def gazelle_api(self, **kwargs):
+        from SpiffyTitles import gazapi
+        import tempfile
+
+        with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as config:
+            config.write('[site]\nurl = https://tracker.example/\napi_token = token\n'
+                         'rate_limit = 2\nrate_period = 10\n')
+
+        try:
+            yield gazapi.GazAPI(config.name, 'site', **kwargs)
+        finally:
+            os.unlink(config.name)
+
+    def testGazelleApiCachesTrimmedResponsesOnPooledSession(self):
+        from SpiffyTitles import cache
+        group = {
+            'status': 'success',
+            'response': {
+                'group': {
+                    'id': 7,
+                    'name': 'Album',
+                    'year': 2001,
+                    'categoryName': 'Music',
+                    'tags': ['rock'],
+                    'wikiBody': 'x' * 1000,
+                    'musicInfo': {'artists': [{'id': 1, 'name': 'Band'}], 'with': []},
+                },
+                'torrents': [{'id': 70}],
+            },
+        }
+
+        with self.gazelle_api(cache=cache.LinkCache(10)) as api:
+            with patch.object(api.session, 'get',
+                              return_value=SimpleNamespace(json=lambda: group)) as get:
+                first = api.request('torrentgroup', id='7')
+                second = api.request('torrentgroup', id='7')
+
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(get.call_args[1]['params'], {'action': 'torrentgroup', 'id': '7'})
+        self.assertEqual(api.session.headers['Authorization'], 'token')
+        self.assertEqual(first, {'group': {
+            'id': 7, 'name': 'Album', 'year': 2001, 'categoryName': 'Music', 'tags': ['rock'],
+            'musicInfo': {'artists': [{'name': 'Band'}]}}})
+        self.assertIs(second, first)
+
+    def testGazelleCallsAreBoundedByTheMessageDeadline(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        payload = {'status': 'success', 'response': {'name': 'Artist'}}
+        now = [0.0]
+
+        with self.gazelle_api() as api:
+            api.bucket.clock = lambda: now[0]
+            api.bucket.sleep = lambda seconds: time.sleep(0.2)
+            api.bucket._tokens = 0.0
+            api.bucket._updated = 0.0
+            plugin.lookup_state.deadline = time.monotonic() + 10
+
+            try:
+                with patch.object(api.session, 'get',
+                                  return_value=SimpleNamespace(json=lambda: payload)) as get:
+                    title = plugin.gazelle_info({'action': 'artist', 'id': '1'}, api)
+
+                plugin.lookup_state.deadline = time.monotonic() - 1
+
+                with self.assertRaises(requests.exceptions.Timeout):
+                    plugin.gazelle_info({'action': 'artist', 'id': '2'}, api)
+            finally:
+                plugin.lookup_state.deadline = None
+
+        self.assertEqual(title, "Artist's page for Artist")
+        self.assertLessEqual(get.call_args[1]['timeout'],
+                             conf.supybot.plugins.SpiffyTitles.apiTimeoutInSeconds() - 0.2)
+
+    def testGazelleTorrentLinksReuseCachedGroups(self):
+        from SpiffyTitles import cache
+
+        def reply(params):
+            group = {'id': 7, 'name': 'Album', 'categoryName': 'Movies'}
+
+            if params['action'] == 'torrent':
+                group = {'id': 8, 'name': 'Other', 'categoryName': 'Movies'}
+                payload = {'group': group, 'torrent': {'id': params['id']}}
+            else:
+                payload = {'group': group, 'torrents': [{'id': 70}, {'id': 71}]}
+
+            return SimpleNamespace(json=lambda: {'status': 'success', 'response': payload})
+
+        with self.gazelle_api(cache=cache.LinkCache(10)) as api:
+            with patch.object(api.session, 'get',
+                              side_effect=lambda url, params, **kwargs: reply(params)) as get:
+                group = api.request('torrentgroup', id='7')
+                torrent = api.request('torrent', id='71')
+                other = api.request('torrent', id='80')
+                other_group = api.request('torrentgroup', id='8')
+
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual([call[1]['params']['action'] for call in get.call_args_list],
+                         ['torrentgroup', 'torrent'])
+        self.assertIs(torrent, group)
+        self.assertIs(other_group, other)
+
+    def testGazelleConcurrentLookupsShareOneRequest(self):
+        release = threading.Event()
+        payload = {'status': 'success', 'response': {'group': {'id': 7, 'name': 'Album'}}}
+
+        def slow_get(url, params, **kwargs):
+            release.wait(5)
+            return SimpleNamespace(json=lambda: payload)
+
+        with self.gazelle_api() as api:
+            with patch.object(api.session, 'get', side_effect=slow_get) as get:
+                with RealThreadPoolExecutor(4) as pool:
+                    futures = [pool.submit(api.request, 'torrentgroup', id='7')
+                               for _ in range(4)]
+
+                    while api.in_flight.in_flight() == 0:
+                        time.sleep(0.01)
+
+                    time.sleep(0.05)
+                    release.set()
+                    results = [future.result(5) for future in futures]
+
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(results, [payload['response']] * 4)
+
+    def testGazelleTokenBucketQueuesCallsBeyondTheLimit(self):
+        from SpiffyTitles.gazapi import RequestException, TokenBucket
+        now = [0.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(2, 10, clock=lambda: now[0], sleep=sleep)
+
+        bucket.acquire(30)
+        bucket.acquire(30)
+        bucket.acquire(30)
+        self.assertEqual(waits, [5.0])
+
+        with self.assertRaises(RequestException):
+            bucket.acquire(1)
+
+        now[0] += 5
+        bucket.acquire(30)
+        self.assertEqual(waits, [5.0])
+
     def testHandlerWhitelistAllowsGazelleAlias(self):
         plugin = self.irc.getCallback('SpiffyTitles')
         conf.supybot.plugins.SpiffyTitles.handlerWhitelist.get(
@@ -505,15 +1518,268 @@ class SpiffyTitlesTestCase(ChannelPluginTestCase):
         plugin = self.irc.getCallback('SpiffyTitles')
         conf.supybot.plugins.SpiffyTitles.handlerWhitelist.get(
             self.channel).setValue(['gazelle'])
-        plugin.link_cache.append({
-            'url': 'https://youtube.com/watch?v=abc12345678',
-            'timestamp': datetime.datetime.now(),
-            'title': '^ Cached YouTube title',
-        })
+        plugin.add_link_to_cache('https://youtube.com/watch?v=abc12345678',
+                                 '^ Cached YouTube title')
 
         self.assertIsNone(plugin.get_title_by_url(
             'https://youtube.com/watch?v=abc12345678', self.channel))
 
+    def testChannelPolicyIsRebuiltWhenSettingsChange(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        group = conf.supybot.plugins.SpiffyTitles
+        policy = plugin.get_channel_policy(self.channel)
+
+        self.assertIs(plugin.get_channel_policy(self.channel), policy)
+        self.assertEqual(policy.handler_whitelist, frozenset())
+
+        try:
+            group.handlerWhitelist.get(self.channel).setValue([' YouTube ', ''])
+            policy = plugin.get_channel_policy(self.channel)
+            self.assertEqual(policy.handler_whitelist, frozenset(['youtube']))
+
+            group.channelBlacklist.setValue([self.channel])
+            self.assertFalse(plugin.get_channel_policy(self.channel).channel_allowed)
+        finally:
+            group.handlerWhitelist.get(self.channel).setValue([])
+            group.channelBlacklist.setValue([])
+
+        self.assertTrue(plugin.get_channel_policy(self.channel).channel_allowed)
+
+    def testChannelPolicyCallbacksAreRemovedOnUnload(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        plugin.get_channel_policy(self.channel)
+        value = conf.supybot.plugins.SpiffyTitles.handlerWhitelist.get(self.channel)
+
+        self.assertIn(plugin.invalidate_policies,
+                      [callback for (callback, args, kwargs) in value._callbacks])
+
+        self.assertNotError('unload SpiffyTitles')
+
+        self.assertNotIn(plugin.invalidate_policies,
+                         [callback for (callback, args, kwargs) in value._callbacks])
+
+    def testPatternTimeoutGuardsOperatorPatterns(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        group = conf.supybot.plugins.SpiffyTitles
+        group.ignoredTitlePattern.get(self.channel).set('m/^(a+)+$/')
+        group.patternTimeoutInSeconds.setValue(0.5)
+        title = 'a' * 40 + '!'
+
+        try:
+            started = time.time()
+            self.assertFalse(plugin.title_matches_ignore_pattern(title, self.channel))
+            self.assertLess(time.time() - started, 5)
+            self.assertTrue(plugin.title_matches_ignore_pattern('aaa', self.channel))
+        finally:
+            group.ignoredTitlePattern.get(self.channel).set('')
+            group.patternTimeoutInSeconds.setValue(0)
+
+    def testLinkCacheServesCachedTitle(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        html = '<html><head><title>Example title</title></head></html>'
+
+        with patch.object(plugin, 'get_source_by_url',
+                          return_value=(html, False, None)) as source:
+            self.assertEqual(plugin.get_title_by_url('https://example.com', self.channel),
+                             '^ Example title')
+            self.assertEqual(plugin.get_title_by_url('https://example.com', self.channel),
+                             '^ Example title')
+
+        source.assert_called_once()
+
+    def testLinkCacheEvictsLeastRecentlyUsedLink(self):
+        from SpiffyTitles.cache import LinkCache
+        link_cache = LinkCache(max_entries=2)
+
+        link_cache.put('a', 'A', 60)
+        link_cache.put('b', 'B', 60)
+        self.assertEqual(link_cache.get('a'), 'A')
+        link_cache.put('c', 'C', 60)
+
+        self.assertEqual(link_cache.get('a'), 'A')
+        self.assertIsNone(link_cache.get('b'))
+        self.assertEqual(link_cache.get('c'), 'C')
+        self.assertEqual(len(link_cache), 2)
+
+    def testLinkCacheStaleEntryDoesNotMaskFreshOne(self):
+        from SpiffyTitles.cache import LinkCache
+        link_cache = LinkCache()
+
+        with patch('SpiffyTitles.cache.time.time', return_value=1000):
+            link_cache.put('a', 'old', 60)
+
+        with patch('SpiffyTitles.cache.time.time', return_value=1100):
+            self.assertIsNone(link_cache.get('a'))
+            link_cache.put('a', 'new', 60)
+            self.assertEqual(link_cache.get('a'), 'new')
+
+    def testLinkVariantsShareCacheEntry(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        plugin.add_link_to_cache('https://example.com/article', '^ Example title')
+
+        for url in ['https://EXAMPLE.com/article/',
+                    'https://example.com:443/article#comments',
+                    'https://example.com/article?utm_source=irc&fbclid=abc']:
+            self.assertEqual(plugin.get_link_from_cache(url)['title'], '^ Example title')
+
+        self.assertIsNone(plugin.get_link_from_cache('https://example.com/article?page=2'))
+        self.assertIsNone(plugin.get_link_from_cache('http://example.com:8080/article'))
+
+    def testCanonicalizeProviderLinks(self):
+        from SpiffyTitles.links import canonicalize
+
+        self.assertEqual(canonicalize('https://youtu.be/dQw4w9WgXcQ?si=abc&t=42'),
+                         'https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42')
+        self.assertEqual(canonicalize('https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ'),
+                         'https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+        self.assertEqual(canonicalize('https://old.reddit.com/r/Python/comments/abc123/a_title/'),
+                         'https://www.reddit.com/r/python/comments/abc123/')
+        self.assertEqual(canonicalize('https://en.m.wikipedia.org/wiki/monty%20Python'),
+                         'https://en.wikipedia.org/wiki/Monty_Python')
+        self.assertEqual(canonicalize('https://redacted.sh/torrents.php?torrentid=5&id=1&hash=x'),
+                         'https://redacted.sh/torrents.php?id=1')
+        self.assertEqual(canonicalize('http://[::1]:8080/a/'), 'http://[::1]:8080/a')
+
+    def testDuplicateLinksInMessageAreLookedUpOnce(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        urls = ['https://example.com/a?utm_medium=x', 'https://Example.com/a']
+
+        with patch.object(plugin, 'get_title_by_message_url',
+                          return_value='^ A') as get_title:
+            self.assertEqual(plugin.get_titles_by_urls(urls, self.channel),
+                             [(1, '^ A'), (2, '^ A')])
+
+        get_title.assert_called_once()
+
+    def testShortLinkIsResolvedWithoutBodyAndRedispatched(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        fake, curl = fake_pycurl(b'<title>YouTube</title>' * 1000,
+                                 url='https://www.youtube.com/watch?v=abcdefghijk')
+        seen = []
+        plugin.handlers['www.youtube.com'] = lambda link, channel: seen.append(link) or '^ Video'
+
+        with patch_pycurl(fake):
+            self.assertEqual(plugin.get_title_by_url('https://bit.ly/abc', self.channel),
+                             '^ Video')
+            self.assertEqual(plugin.resolve_short_link(link('https://bit.ly/abc')),
+                             'https://www.youtube.com/watch?v=abcdefghijk')
+
+        self.assertEqual(seen, ['https://www.youtube.com/watch?v=abcdefghijk'])
+        self.assertTrue(curl.options[fake.NOBODY])
+        self.assertEqual(curl.chunks_written, 0)
+        self.assertEqual(plugin.get_link_from_cache('https://bit.ly/abc')['title'], '^ Video')
+
+    def testShortLinkToPageUsesDefaultHandler(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        html = '<html><head><title>Article</title></head></html>'
+
+        with patch.object(plugin, 'get_redirect_target',
+                          return_value='https://example.org/article'):
+            with patch.object(plugin, 'get_source_by_url',
+                              return_value=(html, True, 'example.org')) as source:
+                self.assertEqual(plugin.get_title_by_url('https://t.co/abc', self.channel),
+                                 '(example.org) ^ Article')
+
+        self.assertEqual(source.call_args[0][0], 'https://t.co/abc')
+
+    def testCachedLinkIsRenderedPerChannel(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        group = conf.supybot.plugins.SpiffyTitles
+        html = '<html><head><title>Example title</title></head></html>'
+        group.defaultTitleTemplate.get('#other').setValue('{{title}} on {{real_domain}}')
+        group.useBold.get('#other').setValue(True)
+
+        try:
+            with patch.object(plugin, 'get_source_by_url',
+                              return_value=(html, True, 'example.org')) as source:
+                self.assertEqual(plugin.get_title_by_url('https://example.com', self.channel),
+                                 '(example.org) ^ Example title')
+                self.assertEqual(plugin.get_title_by_url('https://example.com', '#other'),
+                                 ircutils.bold('Example title on example.org'))
+
+                group.defaultTitleTemplate.get(self.channel).setValue('[{{title}}]')
+                self.assertEqual(plugin.get_title_by_url('https://example.com', self.channel),
+                                 '[Example title]')
+        finally:
+            group.defaultTitleTemplate.get(self.channel).setValue(
+                group.defaultTitleTemplate())
+            group.defaultTitleTemplate.get('#other').setValue(group.defaultTitleTemplate())
+            group.useBold.get('#other').setValue(False)
+
+        source.assert_called_once()
+        self.assertEqual(plugin.get_link_from_cache('https://example.com')['payload'][0],
+                         'template')
+
+    def testPersistentLinkCacheSurvivesReload(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        plugin.add_link_to_cache('https://example.com', '^ Example title')
+
+        self.assertNotError('reload SpiffyTitles')
+        plugin = self.irc.getCallback('SpiffyTitles')
+
+        self.assertEqual(len(plugin.link_cache), 0)
+        with patch.object(plugin, 'get_source_by_url') as source:
+            self.assertEqual(plugin.get_title_by_url('https://example.com', self.channel),
+                             '^ Example title')
+
+        source.assert_not_called()
+        self.assertEqual(len(plugin.link_cache), 1)
+
+    def testPersistentLinkCacheIgnoresExpiredEntries(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+
+        with patch('SpiffyTitles.cache.time.time', return_value=1000):
+            plugin.disk_cache.put('https://example.com', {'title': 'old'}, 60)
+
+        self.assertIsNone(plugin.disk_cache.get('https://example.com'))
+        plugin.disk_cache.put('https://example.com', {'title': 'new'}, 60)
+        self.assertEqual(plugin.disk_cache.get('https://example.com')[0],
+                         {'title': 'new'})
+
+    def testFailedLookupIsNegativelyCached(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        fake, curl = fake_pycurl(b'Not found')
+        curl.status_code = 404
+
+        with patch_pycurl(fake):
+            self.assertIsNone(plugin.get_title_by_url('https://example.com/gone',
+                                                      self.channel))
+
+        self.assertEqual(plugin.get_link_from_cache('https://example.com/gone')['failure'],
+                         'http 404')
+
+        with patch.object(plugin, 'get_source_by_url') as source:
+            self.assertEqual(plugin.get_titles_by_urls([
+                'https://example.com/gone',
+                'https://example.com/gone',
+            ], self.channel), [
+                (1, '^ <bad url>'),
+                (2, '^ <bad url>'),
+            ])
+
+        source.assert_not_called()
+
+    def testPageWithoutTitleIsNegativelyCached(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        html = '<html><head></head><body>No title</body></html>'
+
+        with patch.object(plugin, 'get_source_by_url',
+                          return_value=(html, False, None)):
+            self.assertIsNone(plugin.get_title_by_url('https://example.com', self.channel))
+
+        self.assertEqual(plugin.get_link_from_cache('https://example.com')['failure'],
+                         'no title')
+
+    def testLinkCacheDisabledWithZeroLifetime(self):
+        plugin = self.irc.getCallback('SpiffyTitles')
+        conf.supybot.plugins.SpiffyTitles.linkCacheLifetimeInSeconds.setValue(0)
+
+        try:
+            plugin.add_link_to_cache('https://example.com', '^ Example title')
+            self.assertIsNone(plugin.get_link_from_cache('https://example.com'))
+        finally:
+            conf.supybot.plugins.SpiffyTitles.linkCacheLifetimeInSeconds.setValue(60)
+
 
 class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
     plugins = ('SpiffyTitles',)
@@ -565,7 +1831,7 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
         plugin = self.irc.getCallback('SpiffyTitles')
         url = self.live_url('YOUTUBE', 'https://www.youtube.com/watch?v=dQw4w9WgXcQ')
 
-        title = self.live_call(lambda: plugin.handler_youtube(url, urlparse(url).netloc,
+        title = self.live_call(lambda: plugin.handler_youtube(link(url),
                                                               self.channel))
 
         self.assertLiveTitleContains(title, 'Duration:', 'Views:')
@@ -574,7 +1840,7 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
         plugin = self.irc.getCallback('SpiffyTitles')
         url = self.live_url('DAILYMOTION', 'https://www.dailymotion.com/video/x8a0e9g')
 
-        title = self.live_call(lambda: plugin.handler_dailymotion(url, urlparse(url),
+        title = self.live_call(lambda: plugin.handler_dailymotion(link(url),
                                                                   self.channel))
 
         self.assertLiveTitleContains(title, 'Duration:', 'views')
@@ -583,7 +1849,7 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
         plugin = self.irc.getCallback('SpiffyTitles')
         url = self.live_url('VIMEO', 'https://vimeo.com/76979871')
 
-        title = self.live_call(lambda: plugin.handler_vimeo(url, urlparse(url).netloc,
+        title = self.live_call(lambda: plugin.handler_vimeo(link(url),
                                                             self.channel))
 
         self.assertLiveTitleContains(title, 'Duration:', 'plays')
@@ -592,7 +1858,7 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
         plugin = self.irc.getCallback('SpiffyTitles')
         url = self.live_url('COUB', 'https://coub.com/view/g1s3x')
 
-        title = self.live_call(lambda: plugin.handler_coub(url, urlparse(url).netloc,
+        title = self.live_call(lambda: plugin.handler_coub(link(url),
                                                            self.channel))
 
         self.assertLiveTitleContains(title, 'views', 'likes', 'recoubs')
@@ -601,7 +1867,7 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
         plugin = self.irc.getCallback('SpiffyTitles')
         url = self.live_url('IMDB', 'https://www.imdb.com/title/tt0111161/')
 
-        title = self.live_call(lambda: plugin.handler_imdb(url, urlparse(url), self.channel))
+        title = self.live_call(lambda: plugin.handler_imdb(link(url), self.channel))
 
         self.assertLiveTitleContains(title, 'The Shawshank Redemption')
 
@@ -610,7 +1876,7 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
         url = self.live_url('WIKIPEDIA',
                             'https://en.wikipedia.org/wiki/Python_(programming_language)')
 
-        title = self.live_call(lambda: plugin.handler_wikipedia(url, urlparse(url).netloc,
+        title = self.live_call(lambda: plugin.handler_wikipedia(link(url),
                                                                 self.channel))
 
         self.assertLiveTitleContains(title, 'programming language')
@@ -619,7 +1885,7 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
         plugin = self.irc.getCallback('SpiffyTitles')
         url = self.live_url('REDDIT', 'https://www.reddit.com/user/spez/')
 
-        title = self.live_call(lambda: plugin.handler_reddit(url, urlparse(url).netloc,
+        title = self.live_call(lambda: plugin.handler_reddit(link(url),
                                                              self.channel))
 
         self.assertLiveTitleContains(title, 'Link karma:', 'Comment karma:')
@@ -635,7 +1901,7 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
             raise unittest.SkipTest('set SPIFFYTITLES_LIVE_IMGUR_ALBUM_URL')
 
         plugin = self.irc.getCallback('SpiffyTitles')
-        title = self.live_call(lambda: plugin.handler_imgur_album(url, urlparse(url),
+        title = self.live_call(lambda: plugin.handler_imgur_album(link(url),
                                                                   self.channel))
 
         self.assertLiveTitleContains(title, 'images', 'views')
@@ -651,7 +1917,7 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
             raise unittest.SkipTest('set SPIFFYTITLES_LIVE_IMGUR_IMAGE_URL')
 
         plugin = self.irc.getCallback('SpiffyTitles')
-        title = self.live_call(lambda: plugin.handler_imgur_image(url, urlparse(url),
+        title = self.live_call(lambda: plugin.handler_imgur_image(link(url),
                                                                   self.channel))
 
         self.assertLiveTitleContains(title, 'views')
@@ -668,14 +1934,12 @@ class SpiffyTitlesLiveTestCase(ChannelPluginTestCase):
             raise unittest.SkipTest('gazelle.conf is not configured')
 
         if redacted_url:
-            title = self.live_call(lambda: plugin.handler_redacted(redacted_url,
-                                                                   urlparse(redacted_url),
+            title = self.live_call(lambda: plugin.handler_redacted(link(redacted_url),
                                                                    self.channel))
             self.assertTrue(title)
 
         if orpheus_url:
-            title = self.live_call(lambda: plugin.handler_apl(orpheus_url,
-                                                              urlparse(orpheus_url),
+            title = self.live_call(lambda: plugin.handler_apl(link(orpheus_url),
                                                               self.channel))
             self.assertTrue(title)
 
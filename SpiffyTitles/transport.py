@@ -0,0 +1,296 @@
+"""
+Network plumbing used by SpiffyTitles to fetch pages.
+"""
+import io
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import pycurl
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HeadBuffer:
+    """pycurl write target that only keeps the start of a document.
+
+    Passed as ``WRITEFUNCTION``. It stops the transfer once the end of the
+    document head has arrived, once *max_bytes* have been received, or as
+    soon as the response headers show an unacceptable content type. Stopping
+    makes pycurl raise ``E_WRITE_ERROR``; check :attr:`stopped` to tell that
+    apart from a real error.
+    """
+
+    head_end_pattern = re.compile(rb"</head\s*>|<body[\s>]", re.IGNORECASE)
+
+    # Bytes kept from the previous chunk, so a marker split across two
+    # chunks is still found.
+    overlap = 8
+
+    # Once the head is complete, a response with at most this many bytes
+    # left is read to the end instead of being aborted, so that its
+    # connection can be kept alive for the next transfer.
+    drain_limit = 65536
+
+    def __init__(self, max_bytes, acceptable_types=None, stop_after_head=True):
+        self.max_bytes = max_bytes
+        self.acceptable_types = acceptable_types
+        self.stop_after_head = stop_after_head
+        self.body = io.BytesIO()
+        self.content_type = None
+        self.content_length = None
+        self.head_complete = False
+        self.truncated = False
+        self.rejected = False
+        self._tail = b""
+
+    @property
+    def stopped(self):
+        return self.head_complete or self.truncated or self.rejected
+
+    def header(self, line):
+        """``HEADERFUNCTION`` callback, tracks the final response's content type."""
+        line = line.decode("iso-8859-1").strip()
+
+        if line.startswith("HTTP/"):
+            # A new response (after a redirect) starts over
+            self.content_type = None
+            self.content_length = None
+        elif line.lower().startswith("content-type:"):
+            self.content_type = line.split(":", 1)[1].split(";")[0].strip()
+        elif line.lower().startswith("content-length:"):
+            try:
+                self.content_length = int(line.split(":", 1)[1])
+            except ValueError:
+                pass
+
+    def write(self, data):
+        if self.head_complete:
+            # Draining the rest of a short response
+            return None
+
+        if self.acceptable_types is not None and self.content_type is not None:
+            if self.content_type not in self.acceptable_types:
+                self.rejected = True
+                return 0
+
+        self.body.write(data)
+
+        if self.stop_after_head:
+            window = self._tail + data
+            self._tail = window[-self.overlap:]
+
+            if self.head_end_pattern.search(window):
+                self.head_complete = True
+
+                if self.content_length is not None:
+                    if self.content_length - self.body.tell() <= self.drain_limit:
+                        return None
+
+                return 0
+
+        if self.body.tell() >= self.max_bytes:
+            self.truncated = True
+            return 0
+
+    def getvalue(self):
+        return self.body.getvalue()
+
+
+class CurlPool:
+    """Pool of reusable pycurl handles.
+
+    The handles are tied together by a ``CurlShare`` holding the DNS cache and
+    TLS sessions. Each handle also keeps its own live connections between
+    transfers, so repeated links to the same host skip the TCP and TLS
+    handshakes. libcurl does not support sharing one connection cache between
+    handles used from several threads at once, so that part stays per handle.
+    """
+
+    def __init__(self, max_idle: int = 8):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._share = pycurl.CurlShare()
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+    @contextmanager
+    def handle(self):
+        """Check out a handle for the duration of a ``with`` block."""
+        curl = self.acquire()
+
+        try:
+            yield curl
+        finally:
+            self.release(curl)
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.SHARE, self._share)
+
+        return curl
+
+    def release(self, curl):
+        """Return a handle to the pool, keeping its connections alive."""
+        # reset() clears options but keeps connections, caches and the share
+        curl.reset()
+
+        with self._lock:
+            if not self._closed and len(self._idle) < self.max_idle:
+                self._idle.append(curl)
+                return
+
+        curl.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+
+        for curl in idle:
+            curl.close()
+
+        self._share.close()
+
+
+class ApiSession(requests.Session):
+    """``requests`` session shared by the API handlers.
+
+    Connections are pooled per host and kept alive between lookups, and
+    responses are requested gzip-compressed. Every request must carry a
+    timeout so one hung API host cannot pin a worker thread.
+    """
+
+    def __init__(self, pool_size: int = 10):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if timeout is None:
+            raise ValueError("API requests need a timeout")
+
+        return super().request(method, url, timeout=timeout, **kwargs)
+
+
+class ClientCredentialsToken:
+    """OAuth2 app-only access token, fetched with the client credentials grant.
+
+    The token is kept until *refresh_margin* seconds before it expires, then
+    the next caller fetches a new one. Callers waiting at the same time share
+    that one token request.
+    """
+
+    def __init__(self, session, token_url, client_id, client_secret,
+                 refresh_margin: float = 60, clock=time.monotonic):
+        self.session = session
+        self.token_url = token_url
+        self.credentials = (client_id, client_secret)
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+
+    def get(self, timeout, headers=None):
+        """Return a valid access token, fetching one first if needed."""
+        with self._lock:
+            if self._token is None or self.clock() >= self._expires_at:
+                self._fetch(timeout, headers)
+
+            return self._token
+
+    def invalidate(self):
+        """Forget the token, e.g. after the API rejected it."""
+        with self._lock:
+            self._token = None
+
+    def _fetch(self, timeout, headers):
+        response = self.session.post(self.token_url, auth=self.credentials,
+                                     data={"grant_type": "client_credentials"},
+                                     headers=headers, timeout=timeout)
+        response.raise_for_status()
+        payload = response.json()
+        token = payload["access_token"]
+        expires_in = float(payload.get("expires_in", 3600))
+
+        self._token = token
+        self._expires_at = self.clock() + max(expires_in - self.refresh_margin, 0)
+
+
+class RateLimitPacer:
+    """Spreads requests over the window of an API's rate limit.
+
+    :meth:`update` reads the ``X-Ratelimit-Remaining`` and
+    ``X-Ratelimit-Reset`` headers of every response. :meth:`reserve` then
+    says how long to wait before the next request: nothing while more than
+    *reserve* requests are left, an even share of the rest of the window
+    once fewer are, and the whole rest of the window when none are.
+    """
+
+    def __init__(self, reserve: int = 10, clock=time.monotonic):
+        self.reserve_requests = reserve
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._remaining = None
+        self._reset_at = 0
+        self._next_at = 0
+
+    def update(self, headers):
+        """Record the rate limit state sent with a response."""
+        try:
+            remaining = float(headers["X-Ratelimit-Remaining"])
+            reset = float(headers["X-Ratelimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self._lock:
+            self._remaining = remaining
+            self._reset_at = self.clock() + reset
+
+    def delay(self):
+        """Return the seconds :meth:`reserve` would wait, without counting a request."""
+        with self._lock:
+            now = self.clock()
+
+            if self._remaining is None or now >= self._reset_at:
+                return 0
+
+            if self._remaining < 1:
+                return self._reset_at - now
+
+            if self._remaining <= self.reserve_requests:
+                return max(now, self._next_at) - now
+
+            return 0
+
+    def reserve(self):
+        """Count one request against the limit, returning seconds to wait first."""
+        with self._lock:
+            now = self.clock()
+
+            if self._remaining is None or now >= self._reset_at:
+                return 0
+
+            if self._remaining < 1:
+                return self._reset_at - now
+
+            delay = 0
+
+            if self._remaining <= self.reserve_requests:
+                start = max(now, self._next_at)
+                self._next_at = start + (self._reset_at - now) / self._remaining
+                delay = start - now
+
+            self._remaining -= 1
+
+            return delay
+